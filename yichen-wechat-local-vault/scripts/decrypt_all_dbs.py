@@ -8,32 +8,41 @@ Input:
 
 Output:
   ~/Library/Application Support/wechat-local-vault/decrypted/current/<relative db path>
+  ~/Library/Application Support/wechat-local-vault/decrypted/current/derived/table_catalog.json
   ~/Library/Application Support/wechat-local-vault/manifests/decrypt-*.json
 """
 
 from __future__ import annotations
 
 import argparse
+from contextlib import contextmanager
 from datetime import datetime
+import fcntl
 import hashlib
 import json
 import os
 import sqlite3
-import struct
 import shutil
 from pathlib import Path
 
-from Crypto.Cipher import AES
-
-PAGE_SIZE = 4096
-RESERVE = 80
-IV_SIZE = 16
+from table_catalog import CATALOG_NAME, SHARD_RE, catalog_summary, load_table_catalog
+from wechat_crypto import (
+    PAGE_SIZE,
+    TOKEN_SIZE,
+    changed_pages,
+    decrypt_database,
+    page_tokens,
+    patch_database,
+)
 
 CONFIG_FILE = Path("~/.config/wechat-local-vault.json").expanduser()
 KEYS_FILE = Path("~/.config/wechat-keys.json").expanduser()
 DEFAULT_VAULT_DIR = Path("~/Library/Application Support/wechat-local-vault").expanduser()
 DEFAULT_OUTPUT_DIR = DEFAULT_VAULT_DIR / "decrypted/current"
 DECRYPT_STATE_FILE = DEFAULT_VAULT_DIR / "state/decrypt_state.json"
+PAGE_MAP_DIR = DEFAULT_VAULT_DIR / "state/page_maps"
+LOCK_FILE = DEFAULT_VAULT_DIR / "state/decrypt.lock"
+PAGE_MAP_MAGIC = b"WXPAGEMAP1"
 
 ALIAS_TO_REL = {
     "message_0": "message/message_0.db",
@@ -110,37 +119,79 @@ def key_name_to_rel(name: str) -> str | None:
     return None
 
 
-def decrypt_db(src: Path, dst: Path, key_hex: str) -> None:
-    key = bytes.fromhex(key_hex)
-    if len(key) != 32:
-        raise ValueError("key must be 32 bytes")
-
-    data = src.read_bytes()
-    total_pages = len(data) // PAGE_SIZE
-    if total_pages == 0:
-        raise ValueError("database is smaller than one page")
-
-    result = bytearray()
-    for pn in range(total_pages):
-        page = data[pn * PAGE_SIZE : (pn + 1) * PAGE_SIZE]
-        enc_start = 16 if pn == 0 else 0
-        enc_size = PAGE_SIZE - RESERVE - enc_start
-        iv = page[PAGE_SIZE - RESERVE : PAGE_SIZE - RESERVE + IV_SIZE]
-        dec = AES.new(key, AES.MODE_CBC, iv).decrypt(
-            page[enc_start : enc_start + enc_size]
-        )
-
-        out_page = bytearray(PAGE_SIZE)
-        if pn == 0:
-            out_page[:16] = b"SQLite format 3\x00"
-            out_page[16 : 16 + len(dec)] = dec
-            out_page[16:18] = struct.pack(">H", PAGE_SIZE)
-        else:
-            out_page[: len(dec)] = dec
-        result.extend(out_page)
+def decrypt_db(src: Path, dst: Path, key_hex: str, jobs: int | None = None) -> dict:
+    return decrypt_database(src, dst, key_hex, jobs=jobs, with_tokens=True)
+
+
+@contextmanager
+def decrypt_lock():
+    """Serialise vault writers across processes (CLI, watch, digest, search_sns)."""
+    ensure_private_dir(LOCK_FILE.parent)
+    with LOCK_FILE.open("a") as handle:
+        fcntl.flock(handle, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(handle, fcntl.LOCK_UN)
+
+
+def page_map_path(rel: str) -> Path:
+    return PAGE_MAP_DIR / (rel.replace("/", "__") + ".pagemap")
+
+
+def page_map_header(dst: Path, key_hex: str) -> bytes:
+    digest = hashlib.sha256(f"{key_hex}\0{dst}".encode()).digest()[:16]
+    return PAGE_MAP_MAGIC + digest
+
+
+def load_page_map(rel: str, dst: Path, key_hex: str) -> bytes | None:
+    path = page_map_path(rel)
+    if not path.exists() or not dst.exists():
+        return None
+    data = path.read_bytes()
+    header = page_map_header(dst, key_hex)
+    if not data.startswith(header):
+        return None
+    tokens = data[len(header) :]
+    if len(tokens) % TOKEN_SIZE or dst.stat().st_size != len(tokens) // TOKEN_SIZE * PAGE_SIZE:
+        return None
+    return tokens
+
+
+def save_page_map(rel: str, dst: Path, key_hex: str, tokens: bytes) -> None:
+    ensure_private_dir(PAGE_MAP_DIR)
+    path = page_map_path(rel)
+    partial = path.with_name(path.name + ".partial")
+    partial.write_bytes(page_map_header(dst, key_hex) + tokens)
+    os.chmod(partial, 0o600)
+    os.replace(partial, path)
+
+
+def drop_page_map(rel: str) -> None:
+    try:
+        page_map_path(rel).unlink()
+    except OSError:
+        pass
 
-    dst.parent.mkdir(parents=True, exist_ok=True)
-    dst.write_bytes(result)
+
+def refresh_db(src: Path, dst: Path, rel: str, key_hex: str, mode: str, jobs: int | None = None) -> dict:
+    """Decrypt `src`, or in incremental mode patch only pages whose ciphertext changed.
+
+    A full decrypt collects the page map while it reads, so only the incremental
+    path makes a separate checksum pass over the source.
+    """
+    with decrypt_lock():
+        previous = load_page_map(rel, dst, key_hex) if mode == "incremental" else None
+        if previous is None:
+            stats = decrypt_db(src, dst, key_hex, jobs)
+            tokens = stats.pop("page_tokens")
+            stats["pages_patched"] = stats["pages"]
+        else:
+            tokens = page_tokens(src)
+            pages = changed_pages(previous, tokens)
+            stats = patch_database(src, dst, key_hex, pages, len(tokens) // TOKEN_SIZE, jobs=jobs)
+        save_page_map(rel, dst, key_hex, tokens)
+    return stats
 
 
 def sqlite_table_count(path: Path) -> int:
@@ -151,7 +202,7 @@ def sqlite_table_count(path: Path) -> int:
         con.close()
 
 
-def write_manifest(out_base: Path, records: list[dict]) -> Path:
+def write_manifest(out_base: Path, records: list[dict], catalog: dict[str, dict]) -> Path:
     manifest_dir = DEFAULT_VAULT_DIR / "manifests"
     ensure_private_dir(manifest_dir)
     manifest_path = manifest_dir / f"decrypt-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json"
@@ -160,6 +211,10 @@ def write_manifest(out_base: Path, records: list[dict]) -> Path:
         "decrypted_dir": str(out_base),
         "database_count": sum(1 for item in records if item.get("status") == "ok"),
         "records": records,
+        "table_catalog": {
+            "path": str(out_base / CATALOG_NAME),
+            "shards": catalog_summary(catalog),
+        },
         "privacy": {
             "contains_plaintext_wechat_data": True,
             "do_not_sync_or_share": True,
@@ -196,7 +251,36 @@ def unchanged(src: Path, dst: Path, key_hex: str, state: dict, rel: str) -> bool
     return previous == source_fingerprint(src, key_hex)
 
 
-def main() -> None:
+def load_sources() -> dict[str, tuple[Path, str]]:
+    """rel path -> (source DB, key) for every keyed database."""
+    db_base = resolve_db_base()
+    sources = {}
+    for name, key_hex in load_json(KEYS_FILE).items():
+        rel = key_name_to_rel(name)
+        if rel:
+            sources[rel] = (db_base / rel, key_hex)
+    return sources
+
+
+def refresh_sources(sources: dict[str, tuple[Path, str]], out_base: Path = DEFAULT_OUTPUT_DIR, jobs: int | None = None) -> dict[str, dict]:
+    """Incrementally refresh `sources` into `out_base` and record them in the decrypt state."""
+    state = load_json(DECRYPT_STATE_FILE)
+    results = {}
+    for rel, (src, key_hex) in sorted(sources.items()):
+        dst = out_base / rel
+        if not src.exists() or unchanged(src, dst, key_hex, state, rel):
+            continue
+        fingerprint = source_fingerprint(src, key_hex)
+        results[rel] = refresh_db(src, dst, rel, key_hex, "incremental", jobs)
+        state[rel] = fingerprint
+    if results:
+        save_json(DECRYPT_STATE_FILE, state)
+    if any(SHARD_RE.fullmatch(Path(rel).name) for rel in results):
+        load_table_catalog(out_base)
+    return results
+
+
+def main(argv: list[str] | None = None) -> None:
     parser = argparse.ArgumentParser(description="Decrypt all known WeChat DB keys.")
     parser.add_argument(
         "-o",
@@ -213,14 +297,19 @@ def main() -> None:
         "--mode",
         choices=["full", "incremental"],
         default="full",
-        help="full decrypts every keyed DB; incremental skips unchanged sources",
+        help="full decrypts every keyed DB; incremental skips unchanged sources and re-decrypts only changed pages",
     )
     parser.add_argument(
         "--no-manifest",
         action="store_true",
         help="do not write a decrypt manifest",
     )
-    args = parser.parse_args()
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        help="worker processes for page decryption; default is the CPU count",
+    )
+    args = parser.parse_args(argv)
 
     db_base = resolve_db_base()
     keys = load_json(KEYS_FILE)
@@ -256,11 +345,13 @@ def main() -> None:
             records.append({"name": name, "rel": rel, "status": "unchanged"})
             continue
         try:
-            decrypt_db(src, dst, key_hex)
+            fingerprint = source_fingerprint(src, key_hex)
+            stats = refresh_db(src, dst, rel, key_hex, args.mode, args.jobs)
             count = sqlite_table_count(dst)
             size = dst.stat().st_size
-            state[rel] = source_fingerprint(src, key_hex)
-            print(f"OK   {name:24s} -> {dst} ({count} tables)")
+            state[rel] = fingerprint
+            detail = f"{stats['pages_patched']}/{stats['pages']} pages, {stats['pages_per_second']} pages/s"
+            print(f"OK   {name:24s} -> {dst} ({count} tables, {detail})")
             passed += 1
             records.append({
                 "name": name,
@@ -268,6 +359,7 @@ def main() -> None:
                 "status": "ok",
                 "tables": count,
                 "bytes": size,
+                **stats,
             })
         except Exception as exc:
             try:
@@ -275,14 +367,17 @@ def main() -> None:
                     dst.unlink()
             except OSError:
                 pass
+            drop_page_map(rel)
+            state.pop(rel, None)
             print(f"MISS {name:24s}: {exc}")
             failed += 1
             records.append({"name": name, "rel": rel, "status": "miss", "reason": str(exc)})
 
     update_config_paths(out_base)
     save_json(DECRYPT_STATE_FILE, state)
+    catalog = load_table_catalog(out_base)
     if not args.no_manifest:
-        manifest_path = write_manifest(out_base, records)
+        manifest_path = write_manifest(out_base, records, catalog)
         print(f"Manifest: {manifest_path}")
     print(f"Done: {passed} decrypted, {failed} failed, {skipped} skipped")
 
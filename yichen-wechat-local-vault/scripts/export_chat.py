@@ -9,33 +9,37 @@ Examples:
   python3 export_chat.py --contact "联系人备注"
   python3 export_chat.py --contact "联系人备注" --mode incremental
   python3 export_chat.py --chat-id contact_username --since 2025-01-01
+  python3 export_chat.py --batch chats.txt --since 2025-01-01 --jobs 4
+  python3 export_chat.py --active-since 2025-01-01 --mode incremental
 """
 
 from __future__ import annotations
 
 import argparse
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
-import hashlib
+import heapq
 import json
 import os
 from pathlib import Path
 import re
+import shutil
 import sqlite3
+import sys
+import tempfile
+import time
 import zstandard as zstd
 
+from contact_resolver import CONTACT_COLUMNS, ContactIndex
+from table_catalog import chat_shards, load_table_catalog
+from table_owners import message_table, table_hash, vault_owner_map
+
 CONFIG_FILE = Path("~/.config/wechat-local-vault.json").expanduser()
 DEFAULT_VAULT_DIR = Path("~/Library/Application Support/wechat-local-vault").expanduser()
 DEFAULT_DECRYPTED_DIR = DEFAULT_VAULT_DIR / "decrypted/current"
 DEFAULT_EXPORTS_DIR = Path("~/Documents/wechat-local-vault/exports").expanduser()
 EXPORT_STATE_FILE = DEFAULT_VAULT_DIR / "state/export_chat_state.json"
 
-MESSAGE_DBS = [
-    "message/message_0.db",
-    "message/message_1.db",
-    "message/message_2.db",
-    "message/message_3.db",
-]
-
 TYPE_LABELS = {
     1: "文字",
     3: "图片",
@@ -112,7 +116,7 @@ def load_contacts(decrypted_dir: Path) -> list[dict]:
     con = sqlite3.connect(contact_db)
     con.row_factory = sqlite3.Row
     columns = {row["name"] for row in con.execute("PRAGMA table_info(contact)")}
-    wanted = [col for col in ["username", "userName", "remark", "nick_name", "alias", "type"] if col in columns]
+    wanted = [col for col in [*CONTACT_COLUMNS, "type"] if col in columns]
     rows = [dict(row) for row in con.execute(f"SELECT {','.join(wanted)} FROM contact")]
     con.close()
     return rows
@@ -126,18 +130,9 @@ def contact_display(contact: dict) -> str:
     return "unknown"
 
 
-def find_contact(contacts: list[dict], query: str) -> dict:
-    q = query.lower()
-    exact = []
-    fuzzy = []
-    for contact in contacts:
-        fields = [str(contact.get(field) or "") for field in ["username", "userName", "remark", "nick_name", "alias"]]
-        lowered = [field.lower() for field in fields]
-        if q in lowered:
-            exact.append(contact)
-        elif any(q in field for field in lowered):
-            fuzzy.append(contact)
-    matches = exact or fuzzy
+def find_contact(contacts: list[dict], query: str, index: ContactIndex | None = None) -> dict:
+    by_username = {str(contact.get("username") or contact.get("userName")): contact for contact in contacts}
+    matches = [by_username[username] for username in (index or ContactIndex(contacts)).search(query)]
     if not matches:
         raise SystemExit(f"No contact matched: {query}")
     if len(matches) > 1:
@@ -164,16 +159,15 @@ def parse_since(value: str | None) -> int | None:
     raise SystemExit(f"Unsupported --since value: {value}")
 
 
-def message_table_for(chat_id: str) -> str:
-    return "Msg_" + hashlib.md5(chat_id.encode()).hexdigest()
-
-
-def table_exists(con: sqlite3.Connection, table: str) -> bool:
-    row = con.execute(
-        "SELECT 1 FROM sqlite_master WHERE type='table' AND name=?",
-        (table,),
-    ).fetchone()
-    return bool(row)
+def resolve_chat_id(decrypted_dir: Path, value: str) -> str:
+    """Accept a username, or the Msg_<md5> table name / bare hash shown by search output."""
+    digest = table_hash(value)
+    if re.fullmatch(r"[0-9a-f]{32}", digest):
+        owner = vault_owner_map(decrypted_dir).get(digest)
+        if not owner:
+            raise SystemExit(f"No chat owns message table: {value}")
+        return owner
+    return value
 
 
 def normalize_content(local_type: int, content: str) -> str:
@@ -198,61 +192,82 @@ def normalize_content(local_type: int, content: str) -> str:
     return content.strip()
 
 
-def collect_messages(decrypted_dir: Path, chat_id: str, display: str, since_ts: int | None) -> list[dict]:
-    table = message_table_for(chat_id)
-    rows: list[dict] = []
-    for rel in MESSAGE_DBS:
-        db_path = decrypted_dir / rel
-        if not db_path.exists():
-            continue
-        con = connect(db_path)
-        try:
-            if not table_exists(con, table):
+def shard_messages(con: sqlite3.Connection, db_name: str, table: str, display: str, since_ts: int | None):
+    """One shard's rows of a chat, in (create_time, local_id) order straight off the cursor."""
+    sql = (
+        f"SELECT local_id, server_id, local_type, real_sender_id, create_time, "
+        f"message_content, compress_content FROM [{table}]"
+    )
+    params: tuple = ()
+    if since_ts is not None:
+        sql += " WHERE create_time > ?"
+        params = (since_ts,)
+    sql += " ORDER BY create_time, local_id"
+    for local_id, server_id, local_type, sender_id, ts, content, compressed in con.execute(sql, params):
+        decoded = decode_value(content) or decode_value(compressed)
+        sender = "我" if sender_id == 2 else display
+        if local_type == 10000:
+            sender = "系统"
+        yield {
+            "db": db_name,
+            "local_id": local_id,
+            "server_id": server_id,
+            "type": local_type,
+            "label": TYPE_LABELS.get(local_type, f"类型{local_type}"),
+            "sender": sender,
+            "ts": int(ts),
+            "time": datetime.fromtimestamp(ts).strftime("%Y-%m-%d %H:%M:%S"),
+            "content": normalize_content(local_type, decoded),
+        }
+
+
+def collect_messages(
+    decrypted_dir: Path,
+    chat_id: str,
+    display: str,
+    since_ts: int | None,
+    catalog: dict[str, dict] | None = None,
+    shards: dict[str, sqlite3.Connection] | None = None,
+):
+    """Messages of one chat, oldest first, merged lazily across shards.
+
+    Each shard is read through its own ordered cursor and heapq.merge interleaves them, so memory
+    stays flat however long the chat is. Duplicates across shards share a timestamp, so the dedupe
+    set only ever holds the current second. `shards` keeps one open connection per shard across calls.
+    """
+    table = message_table(chat_id)
+    start_ts = since_ts + 1 if since_ts is not None else None
+    if catalog is None:
+        catalog = load_table_catalog(decrypted_dir)
+    opened = []
+    streams = []
+    try:
+        for name in chat_shards(catalog, table, start_ts):
+            db_path = decrypted_dir / "message" / name
+            if shards is None:
+                con = connect(db_path)
+                opened.append(con)
+            else:
+                con = shards.get(name) or shards.setdefault(name, connect(db_path))
+            if catalog[name].get("unknown") and not con.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (table,)).fetchone():
                 continue
-            sql = (
-                f"SELECT local_id, server_id, local_type, real_sender_id, create_time, "
-                f"message_content, compress_content FROM [{table}]"
-            )
-            params: tuple = ()
-            if since_ts is not None:
-                sql += " WHERE create_time > ?"
-                params = (since_ts,)
-            sql += " ORDER BY create_time, local_id"
-            for local_id, server_id, local_type, sender_id, ts, content, compressed in con.execute(sql, params):
-                decoded = decode_value(content) or decode_value(compressed)
-                sender = "我" if sender_id == 2 else display
-                if local_type == 10000:
-                    sender = "系统"
-                rows.append({
-                    "db": db_path.name,
-                    "local_id": local_id,
-                    "server_id": server_id,
-                    "type": local_type,
-                    "label": TYPE_LABELS.get(local_type, f"类型{local_type}"),
-                    "sender": sender,
-                    "ts": int(ts),
-                    "time": datetime.fromtimestamp(ts).strftime("%Y-%m-%d %H:%M:%S"),
-                    "content": normalize_content(local_type, decoded),
-                })
-        finally:
+            streams.append(shard_messages(con, db_path.name, table, display, since_ts))
+        current_ts, seen = None, set()
+        for item in heapq.merge(*streams, key=lambda item: (item["ts"], item["db"], item["local_id"])):
+            if item["ts"] != current_ts:
+                current_ts, seen = item["ts"], set()
+            key = (item["sender"], item["type"], item["content"])
+            if key in seen:
+                continue
+            seen.add(key)
+            yield item
+    finally:
+        for con in opened:
             con.close()
-    rows.sort(key=lambda item: (item["ts"], item["db"], item["local_id"]))
-    deduped = []
-    seen = set()
-    for item in rows:
-        key = (item["ts"], item["sender"], item["type"], item["content"])
-        if key in seen:
-            continue
-        seen.add(key)
-        deduped.append(item)
-    return deduped
 
 
-def render_markdown(chat_id: str, display: str, rows: list[dict], mode: str, since_ts: int | None) -> str:
-    if rows:
-        time_range = f"{rows[0]['time']} 至 {rows[-1]['time']}"
-    else:
-        time_range = "无新增消息"
+def markdown_header(chat_id: str, display: str, mode: str, since_ts: int | None, count: int, first: str | None, last: str | None) -> str:
+    time_range = f"{first} 至 {last}" if count else "无新增消息"
     lines = [
         f"# {display} 聊天记录导出",
         "",
@@ -261,36 +276,185 @@ def render_markdown(chat_id: str, display: str, rows: list[dict], mode: str, sin
         f"- 会话 ID：{chat_id}",
         f"- 模式：{mode}",
         f"- 起始时间：{datetime.fromtimestamp(since_ts).strftime('%Y-%m-%d %H:%M:%S') if since_ts else '全部'}",
-        f"- 消息数：{len(rows)}",
+        f"- 消息数：{count}",
         f"- 时间范围：{time_range}",
         "",
         "## 时间线",
         "",
     ]
-    for index, item in enumerate(rows, 1):
-        content = item["content"].replace("\n", "\n    ")
-        lines.append(f"{index:02d}. {item['time']} [{item['sender']}｜{item['label']}] {content}")
-    return "\n".join(lines).rstrip() + "\n"
+    if not count:
+        return "\n".join(lines).rstrip() + "\n"
+    return "\n".join(lines) + "\n"
+
+
+def write_markdown(out_path: Path, chat_id: str, display: str, rows, mode: str, since_ts: int | None, write_empty: bool = True) -> dict:
+    """Stream `rows` into the export; the header counts are only known after the body, so it is spooled first.
+
+    Returns the message count and last timestamp; nothing is written when there are no rows and not `write_empty`.
+    """
+    count, first, last, last_ts = 0, None, None, None
+    with tempfile.TemporaryFile("w+", encoding="utf-8") as body:
+        pending = None
+        for item in rows:
+            if pending is not None:
+                body.write(pending + "\n")
+            count += 1
+            first = first or item["time"]
+            last, last_ts = item["time"], item["ts"]
+            content = item["content"].replace("\n", "\n    ")
+            pending = f"{count:02d}. {item['time']} [{item['sender']}｜{item['label']}] {content}"
+        if pending is not None:
+            body.write(pending.rstrip() + "\n")
+        if count or write_empty:
+            out_path.parent.mkdir(parents=True, exist_ok=True)
+            with out_path.open("w", encoding="utf-8") as f:
+                f.write(markdown_header(chat_id, display, mode, since_ts, count, first, last))
+                body.seek(0)
+                shutil.copyfileobj(body, f)
+    return {"messages": count, "last_ts": last_ts}
+
+
+_WORKER: dict = {}
+
+
+def init_worker(decrypted_dir: Path, catalog: dict[str, dict]) -> None:
+    _WORKER.update(decrypted_dir=decrypted_dir, catalog=catalog, shards={})
+
+
+def export_one(job: dict) -> dict:
+    """Batch worker: extract one chat over the worker's shard connections and stream it to disk."""
+    started = time.perf_counter()
+    rows = collect_messages(_WORKER["decrypted_dir"], job["chat_id"], job["display"], job["since_ts"], _WORKER["catalog"], _WORKER["shards"])
+    written = write_markdown(Path(job["out_path"]), job["chat_id"], job["display"], rows, job["mode"], job["since_ts"], job["write_empty"])
+    result = {"chat_id": job["chat_id"], "display": job["display"], "messages": written["messages"], "path": None, "last_ts": written["last_ts"]}
+    if written["messages"] or job["write_empty"]:
+        result["path"] = job["out_path"]
+    result["seconds"] = round(time.perf_counter() - started, 3)
+    return result
+
+
+def active_chats(decrypted_dir: Path, catalog: dict[str, dict], since_ts: int) -> list[str]:
+    """Usernames whose message tables have rows after `since_ts`, most recent first."""
+    latest: dict[str, int] = {}
+    for entry in catalog.values():
+        for table, info in entry["tables"].items():
+            if info[0] and info[2] is not None and info[2] > since_ts:
+                latest[table_hash(table)] = max(latest.get(table_hash(table), 0), info[2])
+    owners = vault_owner_map(decrypted_dir)
+    return [owners[digest] for digest in sorted(latest, key=latest.get, reverse=True) if digest in owners]
+
+
+def read_chat_list(path: str) -> list[str]:
+    text = sys.stdin.read() if path == "-" else Path(path).expanduser().read_text(encoding="utf-8")
+    return [line.strip() for line in text.splitlines() if line.strip() and not line.lstrip().startswith("#")]
+
+
+def run_batch(args: argparse.Namespace, decrypted_dir: Path, exports_dir: Path, contacts: list[dict]) -> None:
+    started = time.perf_counter()
+    catalog = load_table_catalog(decrypted_dir)
+    by_username = {str(item.get("username") or item.get("userName")): item for item in contacts}
+    index = ContactIndex(contacts)
+    targets: dict[str, dict] = {}
+    failures = []
+    for entry in read_chat_list(args.batch) if args.batch else []:
+        try:
+            chat_id = resolve_chat_id(decrypted_dir, entry)
+            if chat_id in by_username:
+                contact = by_username[chat_id]
+            elif chat_shards(catalog, message_table(chat_id), include_unknown=False):
+                contact = {"username": chat_id}
+            else:
+                contact = find_contact(contacts, entry, index)
+        except SystemExit as exc:
+            failures.append({"query": entry, "error": str(exc)})
+            continue
+        targets.setdefault(str(contact.get("username") or contact.get("userName")), contact)
+    if args.active_since:
+        for chat_id in active_chats(decrypted_dir, catalog, parse_since(args.active_since)):
+            targets.setdefault(chat_id, by_username.get(chat_id, {"username": chat_id}))
+
+    state = load_json(EXPORT_STATE_FILE)
+    since_ts = parse_since(args.since) or parse_since(args.active_since)
+    stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+    jobs, used_paths = [], set()
+    for chat_id, contact in targets.items():
+        display = contact_display(contact)
+        chat_since = since_ts
+        if args.mode == "incremental" and args.since is None:
+            chat_since = state.get(f"chat:{chat_id}", {}).get("last_ts", since_ts)
+        out_path = exports_dir / "chats" / safe_name(display) / f"{stamp}-{args.mode}.md"
+        if out_path in used_paths:
+            out_path = out_path.with_name(f"{stamp}-{args.mode}-{safe_name(chat_id)}.md")
+        used_paths.add(out_path)
+        jobs.append({
+            "chat_id": chat_id,
+            "display": display,
+            "since_ts": chat_since,
+            "mode": args.mode,
+            "out_path": str(out_path),
+            "write_empty": args.write_empty,
+        })
+
+    results = []
+    with ProcessPoolExecutor(max_workers=args.jobs or None, initializer=init_worker, initargs=(decrypted_dir, catalog)) as pool:
+        for result in pool.map(export_one, jobs):
+            results.append(result)
+            if result["last_ts"] is not None:
+                state[f"chat:{result['chat_id']}"] = {"last_ts": result["last_ts"], "display": result["display"]}
+            print(f"{result['messages']:6d}  {result['display']}  {result['path'] or '(no new messages)'}")
+    if any(result["last_ts"] is not None for result in results):
+        save_json(EXPORT_STATE_FILE, state)
+
+    manifest_path = Path(args.manifest).expanduser() if args.manifest else exports_dir / "batches" / f"{stamp}-{args.mode}.json"
+    save_json(manifest_path, {
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "mode": args.mode,
+        "since": args.since or args.active_since,
+        "chats": len(results),
+        "exported": sum(1 for result in results if result["path"]),
+        "messages": sum(result["messages"] for result in results),
+        "seconds": round(time.perf_counter() - started, 3),
+        "results": [{key: value for key, value in result.items() if key != "last_ts"} for result in results],
+        "unresolved": failures,
+    })
+    for failure in failures:
+        print(f"SKIP {failure['query']}: {failure['error']}")
+    print(manifest_path)
+    print(f"Exported {sum(result['messages'] for result in results)} messages from {len(results)} chats.")
 
 
 def main() -> None:
     parser = argparse.ArgumentParser(description="Export one decrypted WeChat conversation.")
     parser.add_argument("--contact", help="contact remark/nickname/userName fuzzy query")
-    parser.add_argument("--chat-id", help="exact WeChat userName/chatroom id")
+    parser.add_argument("--chat-id", help="exact WeChat userName/chatroom id, or its Msg_<md5> table name")
     parser.add_argument("--mode", choices=["full", "incremental"], default="full")
     parser.add_argument("--since", help="start time, e.g. 2025-01-01 or '2025-01-01 12:00:00'")
     parser.add_argument("--decrypted-dir", help="override decrypted DB directory")
     parser.add_argument("--exports-dir", help="override export directory")
     parser.add_argument("--output", help="explicit output markdown path")
     parser.add_argument("--write-empty", action="store_true", help="write a report even if no new messages")
+    parser.add_argument("--batch", help="file with one contact query or chat id per line ('-' reads stdin)")
+    parser.add_argument("--active-since", help="batch-export every chat with messages after this time")
+    parser.add_argument("--jobs", type=int, help="batch worker processes; default is the CPU count")
+    parser.add_argument("--manifest", help="batch summary JSON path; default exports_dir/batches/<stamp>-<mode>.json")
     args = parser.parse_args()
 
-    if not args.contact and not args.chat_id:
-        raise SystemExit("Use --contact or --chat-id")
+    batch = bool(args.batch or args.active_since)
+    if batch and (args.contact or args.chat_id or args.output):
+        raise SystemExit("--batch/--active-since cannot be combined with --contact, --chat-id or --output")
+    if not batch and not args.contact and not args.chat_id:
+        raise SystemExit("Use --contact, --chat-id, --batch or --active-since")
 
     decrypted_dir, exports_dir = resolve_dirs(args)
     contacts = load_contacts(decrypted_dir)
-    contact = {"username": args.chat_id} if args.chat_id else find_contact(contacts, args.contact)
+    if batch:
+        run_batch(args, decrypted_dir, exports_dir, contacts)
+        return
+    if args.chat_id:
+        chat_id = resolve_chat_id(decrypted_dir, args.chat_id)
+        contact = next((item for item in contacts if chat_id in (item.get("username"), item.get("userName"))), {"username": chat_id})
+    else:
+        contact = find_contact(contacts, args.contact)
     chat_id = str(contact.get("username") or contact.get("userName"))
     display = contact_display(contact)
 
@@ -300,24 +464,22 @@ def main() -> None:
     if args.mode == "incremental" and since_ts is None:
         since_ts = state.get(state_key, {}).get("last_ts")
 
-    rows = collect_messages(decrypted_dir, chat_id, display, since_ts)
-    if not rows and not args.write_empty:
-        print(f"No messages to export for {display}.")
-        return
-
     if args.output:
         out_path = Path(args.output).expanduser()
     else:
         stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
         out_path = exports_dir / "chats" / safe_name(display) / f"{stamp}-{args.mode}.md"
-    out_path.parent.mkdir(parents=True, exist_ok=True)
-    out_path.write_text(render_markdown(chat_id, display, rows, args.mode, since_ts), encoding="utf-8")
+    rows = collect_messages(decrypted_dir, chat_id, display, since_ts)
+    written = write_markdown(out_path, chat_id, display, rows, args.mode, since_ts, args.write_empty)
+    if not written["messages"] and not args.write_empty:
+        print(f"No messages to export for {display}.")
+        return
 
-    if rows:
-        state[state_key] = {"last_ts": max(item["ts"] for item in rows), "display": display}
+    if written["messages"]:
+        state[state_key] = {"last_ts": written["last_ts"], "display": display}
         save_json(EXPORT_STATE_FILE, state)
     print(out_path)
-    print(f"Exported {len(rows)} messages for {display}.")
+    print(f"Exported {written['messages']} messages for {display}.")
 
 
 if __name__ == "__main__":
@@ -3,14 +3,14 @@
 列出所有群聊和联系人，供用户选择监控对象
 用法: python3 list_contacts.py [--config CONFIG_PATH]
 """
-import sqlite3, struct, os, json, hashlib, argparse
+import sqlite3, os, json, argparse
 from datetime import datetime, timedelta
-from Crypto.Cipher import AES
+from pathlib import Path
 import zstandard as zstd
 
-PAGE_SIZE = 4096
-RESERVE = 80
-IV_SIZE = 16
+from table_owners import build_owner_map
+from wechat_crypto import decrypt_database
+
 KEYS_FILE = os.path.expanduser("~/.config/wechat-keys.json")
 CONFIG_FILE = os.path.expanduser("~/.config/wechat-local-vault.json")
 TMP_DIR = os.path.expanduser("~/Library/Application Support/wechat-local-vault/tmp")
@@ -44,29 +44,7 @@ def load_keys():
 
 
 def decrypt_db(db_path, key_hex, out_path):
-    key = bytes.fromhex(key_hex)
-    with open(db_path, "rb") as f:
-        data = f.read()
-    total_pages = len(data) // PAGE_SIZE
-    result = bytearray()
-    for pn in range(total_pages):
-        page = data[pn * PAGE_SIZE:(pn + 1) * PAGE_SIZE]
-        enc_start = 16 if pn == 0 else 0
-        enc_size = PAGE_SIZE - RESERVE - enc_start
-        iv = page[PAGE_SIZE - RESERVE:PAGE_SIZE - RESERVE + IV_SIZE]
-        cipher = AES.new(key, AES.MODE_CBC, iv)
-        dec = cipher.decrypt(page[enc_start:enc_start + enc_size])
-        dp = bytearray(PAGE_SIZE)
-        if pn == 0:
-            dp[:16] = page[:16]
-            dp[16:16 + len(dec)] = dec
-        else:
-            dp[:len(dec)] = dec
-        result.extend(dp)
-    result[:16] = b"SQLite format 3\x00"
-    result[16:18] = struct.pack(">H", PAGE_SIZE)
-    with open(out_path, "wb") as f:
-        f.write(result)
+    decrypt_database(Path(db_path), Path(out_path), key_hex)
 
 
 def get_contact_map(db_path):
@@ -79,12 +57,9 @@ def get_contact_map(db_path):
 
 
 def get_hash_map(db_path):
-    db = sqlite3.connect(db_path)
-    mapping = {}
-    for row in db.execute("SELECT user_name FROM Name2Id"):
-        mapping[hashlib.md5(row[0].encode()).hexdigest()] = row[0]
-    db.close()
-    return mapping
+    # The temp copies are re-decrypted on every run, so a cache next to them could never hit.
+    db_path = Path(db_path)
+    return build_owner_map(db_path.parent / "contact.db", [db_path])
 
 
 def main(config_path=None):
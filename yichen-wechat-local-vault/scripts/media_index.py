@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+"""
+Index of WeChat's local media cache for `--media` history/export.
+
+WeChat Mac 4.x keeps received files under msg/file/<YYYY-MM>/, image caches
+under msg/attach/<md5(chat)>/<YYYY-MM>/Img/ and videos under
+msg/video/<YYYY-MM>/, next to db_storage. Instead of probing the disk once per
+message, the tree is listed into derived/media_index.db keyed by name, size and
+month. Refreshes only re-list directories whose mtime changed, and lookups are
+dictionary hits that also try neighbouring months.
+"""
+
+from __future__ import annotations
+
+import json
+import os
+from pathlib import Path
+import re
+import sqlite3
+
+INDEX_NAME = "derived/media_index.db"
+INDEX_VERSION = "1"
+MONTH_RE = re.compile(r"^(\d{4})-(\d{2})$")
+IMAGE_VARIANTS = ("", "_h", "_t")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta(key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS dirs(path TEXT PRIMARY KEY, mtime_ns INTEGER, subdirs TEXT);
+CREATE TABLE IF NOT EXISTS files(
+    dir TEXT, name TEXT, kind TEXT, chat_hash TEXT, month TEXT, stem TEXT, size INTEGER,
+    PRIMARY KEY(dir, name)
+);
+"""
+
+ROOTS = {"file": "msg/file", "image": "msg/attach", "video": "msg/video"}
+
+
+def month_number(month: str) -> int | None:
+    match = MONTH_RE.match(month or "")
+    return int(match.group(1)) * 12 + int(match.group(2)) if match else None
+
+
+def classify(kind: str, parts: tuple[str, ...], name: str) -> tuple[str, str, str, str] | None:
+    """(kind, chat hash, month, stem) for a file at `parts` below its root, or None to skip it."""
+    if name.startswith("."):
+        return None
+    if kind == "file":
+        return ("file", "", parts[0] if parts else "", name)
+    if kind == "image":
+        if len(parts) < 3 or parts[2] != "Img" or not name.endswith(".dat"):
+            return None
+        stem = name[:-4]
+        for variant in IMAGE_VARIANTS[1:]:
+            if stem.endswith(variant):
+                stem = stem[: -len(variant)]
+                break
+        return ("image", parts[0], parts[1], stem)
+    if kind == "video":
+        if not name.endswith(".mp4"):
+            return None
+        return ("video", "", parts[0] if parts else "", name[:-4])
+    return None
+
+
+def _open(path: Path, account_dir: Path, rebuild: bool = False) -> sqlite3.Connection:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        os.chmod(path.parent, 0o700)
+    except OSError:
+        pass
+    con = sqlite3.connect(path)
+    try:
+        os.chmod(path, 0o600)
+    except OSError:
+        pass
+    con.executescript(SCHEMA)
+    meta = dict(con.execute("SELECT key, value FROM meta"))
+    if rebuild or meta.get("version") != INDEX_VERSION or meta.get("account_dir") != str(account_dir):
+        with con:
+            con.execute("DELETE FROM files")
+            con.execute("DELETE FROM dirs")
+            con.execute("INSERT OR REPLACE INTO meta(key, value) VALUES ('version', ?)", (INDEX_VERSION,))
+            con.execute("INSERT OR REPLACE INTO meta(key, value) VALUES ('account_dir', ?)", (str(account_dir),))
+    return con
+
+
+def _forget(con: sqlite3.Connection, rel: str) -> None:
+    prefix = rel + "/"
+    con.execute("DELETE FROM files WHERE dir = ? OR substr(dir, 1, ?) = ?", (rel, len(prefix), prefix))
+    con.execute("DELETE FROM dirs WHERE path = ? OR substr(path, 1, ?) = ?", (rel, len(prefix), prefix))
+
+
+def _visit(con: sqlite3.Connection, account_dir: Path, kind: str, rel: str, parts: tuple[str, ...], stats: dict) -> None:
+    try:
+        mtime_ns = (account_dir / rel).stat().st_mtime_ns
+    except OSError:
+        _forget(con, rel)
+        return
+    seen = con.execute("SELECT mtime_ns, subdirs FROM dirs WHERE path = ?", (rel,)).fetchone()
+    if seen and seen[0] == mtime_ns:
+        subdirs = json.loads(seen[1])
+    else:
+        stats["dirs_scanned"] += 1
+        subdirs, rows = [], []
+        try:
+            entries = list(os.scandir(account_dir / rel))
+        except OSError:
+            entries = []
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.name)
+                elif entry.is_file(follow_symlinks=False):
+                    info = classify(kind, parts, entry.name)
+                    if info:
+                        rows.append((rel, entry.name, *info, entry.stat().st_size))
+            except OSError:
+                continue
+        previous = set(json.loads(seen[1])) if seen else set()
+        for gone in previous - set(subdirs):
+            _forget(con, f"{rel}/{gone}")
+        con.execute("DELETE FROM files WHERE dir = ?", (rel,))
+        con.executemany("INSERT INTO files(dir, name, kind, chat_hash, month, stem, size) VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+        con.execute(
+            "INSERT OR REPLACE INTO dirs(path, mtime_ns, subdirs) VALUES (?, ?, ?)",
+            (rel, mtime_ns, json.dumps(sorted(subdirs))),
+        )
+        stats["files_indexed"] += len(rows)
+    for name in subdirs:
+        _visit(con, account_dir, kind, f"{rel}/{name}", parts + (name,), stats)
+
+
+def update_media_index(decrypted_dir: Path, account_dir: Path, rebuild: bool = False) -> dict:
+    """Re-list the media directories whose mtime changed since the last run."""
+    stats = {"dirs_scanned": 0, "files_indexed": 0}
+    con = _open(decrypted_dir / INDEX_NAME, account_dir, rebuild)
+    try:
+        with con:
+            for kind, rel in ROOTS.items():
+                _visit(con, account_dir, kind, rel, (), stats)
+        stats["indexed_files"] = con.execute("SELECT count(*) FROM files").fetchone()[0]
+    finally:
+        con.close()
+    return stats
+
+
+class MediaIndex:
+    """In-memory lookups over the media index; paths are returned absolute."""
+
+    def __init__(self, account_dir: Path, rows) -> None:
+        self.account_dir = account_dir
+        self.by_name: dict[str, list[tuple]] = {}
+        self.by_stem: dict[tuple[str, str], list[tuple]] = {}
+        self.by_size: dict[tuple[str, int], list[tuple]] = {}
+        for directory, name, kind, chat_hash, month, stem, size in rows:
+            item = (month_number(month), chat_hash, size, f"{directory}/{name}", name)
+            if kind == "file":
+                self.by_name.setdefault(name, []).append(item)
+            else:
+                self.by_stem.setdefault((kind, stem), []).append(item)
+                self.by_size.setdefault((kind, size), []).append(item)
+
+    def _nearest(self, items: list[tuple], month: int | None, window: int | None = None) -> Path | None:
+        best = None
+        for item in items:
+            distance = abs(item[0] - month) if item[0] is not None and month is not None else 0
+            if window is not None and distance > window:
+                continue
+            if best is None or distance < best[0]:
+                best = (distance, item)
+        return self.account_dir / best[1][3] if best else None
+
+    def file(self, title: str, size: int | None, month: str) -> Path | None:
+        items = self.by_name.get(title, [])
+        if size:
+            # A known size that matches nothing means the right copy is not on disk.
+            items = [item for item in items if item[2] == size]
+        return self._nearest(items, month_number(month), window=1)
+
+    def image(self, md5: str, chat_hash: str, month: str) -> Path | None:
+        items = self.by_stem.get(("image", md5), [])
+        items = [item for item in items if item[1] == chat_hash] or items
+        # Prefer the original over the _h / _t variants of the same image.
+        for variant in IMAGE_VARIANTS:
+            matches = [item for item in items if item[4] == f"{md5}{variant}.dat"]
+            if matches:
+                return self._nearest(matches, month_number(month))
+        return None
+
+    def video(self, md5: str, size: int | None, month: str) -> Path | None:
+        found = self._nearest(self.by_stem.get(("video", md5), []), month_number(month))
+        if found is None and size:
+            found = self._nearest(self.by_size.get(("video", size), []), month_number(month), window=1)
+        return found
+
+
+def load_media_index(decrypted_dir: Path, account_dir: Path | None) -> MediaIndex | None:
+    """Refresh and load the index; None when the WeChat account directory is unknown."""
+    if account_dir is None or not account_dir.exists():
+        return None
+    update_media_index(decrypted_dir, account_dir)
+    con = sqlite3.connect(decrypted_dir / INDEX_NAME)
+    try:
+        rows = con.execute("SELECT dir, name, kind, chat_hash, month, stem, size FROM files").fetchall()
+    finally:
+        con.close()
+    return MediaIndex(account_dir, rows)
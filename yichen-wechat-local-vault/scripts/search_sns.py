@@ -2,6 +2,9 @@
 """
 查询微信 Mac 4.x 本地朋友圈数据库。
 
+读取 decrypt_all_dbs.py 维护的明文 vault，帖子解析结果缓存在
+derived/sns_posts.db（与 vault_cli.py moments 共用）。
+
 用法示例：
   python3 search_sns.py --name "好友备注" --start 2026-04-01 --end 2026-05-03
   python3 search_sns.py --name "好友备注" --keyword "招聘" --limit 20
@@ -10,21 +13,17 @@
 import argparse
 import json
 import os
-import re
 import sqlite3
-import struct
-from datetime import datetime, timedelta
-from xml.etree import ElementTree as ET
-
-from Crypto.Cipher import AES
+from datetime import datetime
+from pathlib import Path
 
+from contact_resolver import ContactIndex
+import decrypt_all_dbs
+from vault_cli import query_sns_index
 
-PAGE_SIZE = 4096
-RESERVE = 80
-IV_SIZE = 16
-KEYS_FILE = os.path.expanduser("~/.config/wechat-keys.json")
 CONFIG_FILE = os.path.expanduser("~/.config/wechat-local-vault.json")
-TMP_DIR = os.path.expanduser("~/Library/Application Support/wechat-local-vault/tmp")
+DEFAULT_DECRYPTED_DIR = os.path.expanduser("~/Library/Application Support/wechat-local-vault/decrypted/current")
+SNS_SOURCES = ("contact/contact.db", "sns/sns.db")
 
 
 def load_json(path):
@@ -39,62 +38,27 @@ def load_config(config_path=None):
     return {}
 
 
-def get_db_base(config):
-    if config.get("db_base_path"):
-        return os.path.expanduser(config["db_base_path"])
-    if config.get("wxid"):
-        return os.path.expanduser(
-            f"~/Library/Containers/com.tencent.xinWeChat/Data/Documents/"
-            f"xwechat_files/{config['wxid']}/db_storage"
-        )
-    raise SystemExit("[ERROR] 未配置 wxid 或 db_base_path，请先运行 extract_keys.py")
-
-
-def decrypt_db(db_path, key_hex, out_path):
-    key = bytes.fromhex(key_hex)
-    with open(db_path, "rb") as f:
-        data = f.read()
-
-    result = bytearray()
-    for pn in range(len(data) // PAGE_SIZE):
-        page = data[pn * PAGE_SIZE:(pn + 1) * PAGE_SIZE]
-        enc_start = 16 if pn == 0 else 0
-        enc_size = PAGE_SIZE - RESERVE - enc_start
-        iv = page[PAGE_SIZE - RESERVE:PAGE_SIZE - RESERVE + IV_SIZE]
-        dec = AES.new(key, AES.MODE_CBC, iv).decrypt(page[enc_start:enc_start + enc_size])
-        dp = bytearray(PAGE_SIZE)
-        if pn == 0:
-            dp[:16] = page[:16]
-            dp[16:16 + len(dec)] = dec
-        else:
-            dp[:len(dec)] = dec
-        result.extend(dp)
-
-    result[:16] = b"SQLite format 3\x00"
-    result[16:18] = struct.pack(">H", PAGE_SIZE)
-    with open(out_path, "wb") as f:
-        f.write(result)
-
-
-def ensure_decrypted(config):
-    keys = load_json(KEYS_FILE)
-    db_base = get_db_base(config)
-    tmp_dir = TMP_DIR
-    os.makedirs(tmp_dir, exist_ok=True)
-
-    paths = {
-        "contact": os.path.join(db_base, "contact", "contact.db"),
-        "sns": os.path.join(db_base, "sns", "sns.db"),
-    }
-    for name, path in paths.items():
-        if not os.path.exists(path):
-            raise SystemExit(f"[ERROR] 数据库不存在: {path}")
-        key_hex = keys.get(name)
-        if not key_hex:
-            raise SystemExit(f"[ERROR] 缺少 {name} 密钥，请先运行 extract_keys.py --targets {name}")
-        decrypt_db(path, key_hex, os.path.join(tmp_dir, f"{name}.db"))
-
-    return os.path.join(tmp_dir, "contact.db"), os.path.join(tmp_dir, "sns.db")
+def get_decrypted_dir(config):
+    return Path(os.path.expanduser(config.get("decrypted_dir") or DEFAULT_DECRYPTED_DIR))
+
+
+def ensure_decrypted(config, refresh=True):
+    """返回共享 vault 中的 contact.db 和 sns.db；默认先只给这两个库增量补齐变化的页"""
+    decrypted_dir = get_decrypted_dir(config)
+    if refresh:
+        try:
+            sources = {rel: item for rel, item in decrypt_all_dbs.load_sources().items() if rel in SNS_SOURCES}
+            decrypt_all_dbs.refresh_sources(sources, decrypted_dir)
+        except (SystemExit, OSError, ValueError) as exc:
+            print(f"[WARN] 增量解密失败，继续使用现有 vault: {exc}")
+    paths = tuple(decrypted_dir / rel for rel in SNS_SOURCES)
+    for path in paths:
+        if not path.exists():
+            raise SystemExit(f"[ERROR] 明文数据库不存在: {path}，请先运行 decrypt_all_dbs.py")
+    return paths
+
+
+CONTACT_ROW_FIELDS = ("username", "alias", "remark", "nick_name", "quan_pin", "remark_quan_pin")
 
 
 def contact_rows(contact_db):
@@ -115,15 +79,11 @@ def display_name(row):
     return remark or nick_name or alias or username
 
 
-def row_matches(row, query):
-    query = query.lower()
-    return any(query in str(value or "").lower() for value in row)
-
-
 def find_contacts(contact_db, query):
-    rows = [row for row in contact_rows(contact_db) if row_matches(row, query)]
-    rows.sort(key=lambda row: (display_name(row).lower(), row[0]))
-    return rows
+    """按 contact_resolver 的统一排序返回匹配联系人：完全匹配、前缀、包含"""
+    rows = {row[0]: row for row in contact_rows(contact_db)}
+    index = ContactIndex(dict(zip(CONTACT_ROW_FIELDS, row)) for row in rows.values())
+    return [rows[username] for username in index.search(query)]
 
 
 def parse_date(value, end_of_day=False):
@@ -141,90 +101,22 @@ def parse_date(value, end_of_day=False):
     raise SystemExit(f"[ERROR] 无法解析日期: {value}")
 
 
-def text_of(root, path):
-    node = root.find(path)
-    return (node.text or "").strip() if node is not None else ""
-
-
-def parse_content(xml_text):
-    try:
-        root = ET.fromstring(xml_text)
-    except ET.ParseError:
-        root = ET.fromstring(re.sub(r"[\x00-\x08\x0b\x0c\x0e-\x1f]", "", xml_text))
-
-    timeline = root.find("TimelineObject") if root.tag != "TimelineObject" else root
-    if timeline is None:
-        timeline = root
-
-    create_time = text_of(timeline, "createTime")
-    content = text_of(timeline, "contentDesc")
-    post_id = text_of(timeline, "id")
-    username = text_of(timeline, "username")
-    nickname = text_of(timeline, "nickname")
-    post_type = text_of(timeline, "ContentObject/contentStyle") or text_of(timeline, "ContentObject/contentSubStyle")
-
-    media = []
-    for item in timeline.findall(".//media"):
-        media_type = text_of(item, "type")
-        url = text_of(item, "url")
-        thumb = text_of(item, "thumb")
-        media.append({"type": media_type, "url": url, "thumb": thumb})
-
-    links = []
-    for path in ("ContentObject/contentUrl", ".//url"):
-        for node in timeline.findall(path):
-            if node.text and node.text.strip():
-                links.append(node.text.strip())
-
-    return {
-        "id": post_id,
-        "username": username,
-        "nickname": nickname,
-        "create_time": int(create_time) if create_time.isdigit() else None,
-        "content": content,
-        "type": post_type,
-        "media": media,
-        "links": sorted(set(links)),
-    }
-
-
-def query_posts(sns_db, usernames, start_ts=None, end_ts=None, keyword=None, limit=50):
-    db = sqlite3.connect(sns_db)
-    placeholders = ",".join("?" for _ in usernames)
-    sql = f"SELECT tid, user_name, content FROM SnsTimeLine WHERE user_name IN ({placeholders})"
-    rows = db.execute(sql, list(usernames)).fetchall()
-    db.close()
-
+def query_posts(decrypted_dir, usernames, start_ts=None, end_ts=None, keyword=None, limit=50):
     posts = []
-    for tid, user_name, content in rows:
-        if not content:
-            continue
-        try:
-            post = parse_content(content)
-        except Exception as exc:
-            post = {
-                "id": str(tid),
-                "username": user_name,
-                "nickname": "",
-                "create_time": None,
-                "content": f"[无法解析 XML: {exc}]",
-                "type": "",
-                "media": [],
-                "links": [],
-            }
-        post["db_user_name"] = user_name
-        post["tid"] = tid
-        ct = post.get("create_time")
-        if start_ts and (ct is None or ct < start_ts):
-            continue
-        if end_ts and (ct is None or ct > end_ts):
-            continue
-        if keyword and keyword.lower() not in post.get("content", "").lower() and keyword.lower() not in json.dumps(post.get("links", []), ensure_ascii=False).lower():
-            continue
-        posts.append(post)
-
-    posts.sort(key=lambda post: post.get("create_time") or 0, reverse=True)
-    return posts[:limit]
+    for post in query_sns_index(decrypted_dir, usernames, start_ts, end_ts, keyword, limit):
+        posts.append({
+            "id": post["id"],
+            "username": post["username"],
+            "nickname": post["nickname"],
+            "create_time": post["timestamp"] or None,
+            "content": post["content"],
+            "type": post["type"],
+            "media": post["media"],
+            "links": post["links"],
+            "db_user_name": post["db_user"],
+            "tid": post["tid"],
+        })
+    return posts
 
 
 def print_contacts(rows):
@@ -278,10 +170,11 @@ def main():
     parser.add_argument("--limit", type=int, default=50, help="最多输出条数，默认 50")
     parser.add_argument("--json", action="store_true", help="以 JSON 输出")
     parser.add_argument("--config", default=None, help="配置文件路径")
+    parser.add_argument("--no-refresh", action="store_true", help="不先增量解密，直接读取现有 vault")
     args = parser.parse_args()
 
     config = load_config(args.config)
-    contact_db, sns_db = ensure_decrypted(config)
+    contact_db, sns_db = ensure_decrypted(config, refresh=not args.no_refresh)
 
     if args.list_query:
         print_contacts(find_contacts(contact_db, args.list_query))
@@ -300,7 +193,7 @@ def main():
     usernames = sorted(set(usernames))
     name_map = {row[0]: display_name(row) for row in contact_rows(contact_db)}
     posts = query_posts(
-        sns_db,
+        get_decrypted_dir(config),
         usernames,
         start_ts=parse_date(args.start),
         end_ts=parse_date(args.end, end_of_day=True),
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+"""
+Catalog of Msg_<md5> tables across the decrypted message_N.db shards.
+
+For every chat table the catalog records which shard holds it, its row count
+and its min/max create_time, so readers open only the shards that contain a
+chat within the requested time range instead of probing sqlite_master of
+every shard. It is cached as derived/table_catalog.json next to the decrypted
+DBs; decrypt_all_dbs.py refreshes it after each run, and readers re-scan any
+shard whose size or mtime no longer matches. A shard that cannot be scanned is
+kept as "unknown" and returned for every chat until a later scan succeeds, so
+readers never silently lose its messages.
+"""
+
+from __future__ import annotations
+
+import json
+import os
+from pathlib import Path
+import re
+import sqlite3
+import sys
+
+CATALOG_NAME = "derived/table_catalog.json"
+CATALOG_VERSION = 1
+SHARD_RE = re.compile(r"message_\d+\.db")
+
+
+def shard_paths(decrypted_dir: Path) -> list[Path]:
+    return sorted(path for path in (decrypted_dir / "message").glob("message_*.db") if SHARD_RE.fullmatch(path.name))
+
+
+def _signature(path: Path) -> list[int]:
+    stat = path.stat()
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def scan_shard(db_path: Path) -> dict[str, list]:
+    """{table: [rows, min create_time, max create_time, max rowid]} for one shard."""
+    tables = {}
+    con = sqlite3.connect(db_path.resolve().as_uri() + "?mode=ro", uri=True)
+    try:
+        names = [row[0] for row in con.execute("SELECT name FROM sqlite_master WHERE type='table' AND name LIKE 'Msg_%'")]
+        for table in names:
+            try:
+                bounds = list(con.execute(f"SELECT min(create_time), max(create_time), max(rowid) FROM [{table}]").fetchone())
+            except sqlite3.Error:
+                bounds = [None, None, con.execute(f"SELECT max(rowid) FROM [{table}]").fetchone()[0]]
+            rows = con.execute(f"SELECT count(*) FROM [{table}]").fetchone()[0]
+            tables[table] = [rows, *bounds]
+    finally:
+        con.close()
+    return tables
+
+
+def _save(path: Path, data: dict) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        os.chmod(path.parent, 0o700)
+    except OSError:
+        pass
+    partial = path.with_name(path.name + ".partial")
+    with partial.open("w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.chmod(partial, 0o600)
+    os.replace(partial, path)
+
+
+def load_table_catalog(decrypted_dir: Path) -> dict[str, dict]:
+    """{shard name: {"signature": [size, mtime_ns], "tables": {...}}}, re-scanning stale shards.
+
+    A shard whose scan fails gets {"signature": None, "unknown": True} plus its last known
+    tables, so the next load retries it and chat_shards keeps returning it meanwhile.
+    """
+    path = decrypted_dir / CATALOG_NAME
+    try:
+        with path.open(encoding="utf-8") as f:
+            cached = json.load(f)
+        shards = cached["shards"] if cached.get("version") == CATALOG_VERSION else {}
+    except (OSError, ValueError, KeyError):
+        shards = {}
+    current = {}
+    changed = False
+    for db_path in shard_paths(decrypted_dir):
+        try:
+            sig = _signature(db_path)
+        except OSError:
+            continue
+        entry = shards.get(db_path.name)
+        if entry and entry.get("signature") == sig:
+            current[db_path.name] = entry
+            continue
+        try:
+            current[db_path.name] = {"signature": sig, "tables": scan_shard(db_path)}
+        except sqlite3.Error as exc:
+            print(f"[WARN] 无法扫描 {db_path.name}，查询时将直接打开该分片: {exc}", file=sys.stderr)
+            current[db_path.name] = {"signature": None, "unknown": True, "tables": entry.get("tables", {}) if entry else {}}
+        changed = True
+    if changed or current.keys() != shards.keys():
+        try:
+            _save(path, {"version": CATALOG_VERSION, "shards": current})
+        except OSError:
+            pass
+    return current
+
+
+def chat_shards(catalog: dict[str, dict], table: str, start_ts: int | None = None, end_ts: int | None = None, include_unknown: bool = True) -> list[str]:
+    """Shards holding rows of `table` that may fall inside [start_ts, end_ts].
+
+    Unknown shards are always included; callers must check the table exists there.
+    """
+    found = []
+    for name, entry in sorted(catalog.items()):
+        if entry.get("unknown"):
+            if include_unknown:
+                found.append(name)
+            continue
+        info = entry["tables"].get(table)
+        if not info or not info[0]:
+            continue
+        low, high = info[1], info[2]
+        if low is not None and end_ts is not None and low > end_ts:
+            continue
+        if high is not None and start_ts is not None and high < start_ts:
+            continue
+        found.append(name)
+    return found
+
+
+def catalog_summary(catalog: dict[str, dict]) -> dict[str, dict]:
+    """Per-shard table count, row count and create_time span, for the decrypt manifest."""
+    summary = {}
+    for name, entry in sorted(catalog.items()):
+        tables = entry["tables"].values()
+        lows = [info[1] for info in tables if info[1] is not None]
+        highs = [info[2] for info in tables if info[2] is not None]
+        summary[name] = {
+            "tables": len(entry["tables"]),
+            "rows": sum(info[0] for info in tables),
+            "min_create_time": min(lows) if lows else None,
+            "max_create_time": max(highs) if highs else None,
+        }
+        if entry.get("unknown"):
+            summary[name]["unknown"] = True
+    return summary
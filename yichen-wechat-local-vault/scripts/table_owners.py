@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+"""
+Msg_<md5(username)> -> username reverse map for decrypted WeChat message DBs.
+
+Message tables are named after the MD5 of the chat username, so finding the
+chat behind a table means hashing every known username. The map is built from
+contact.db and every message DB's Name2Id table and cached per source as
+derived/table_owners.json next to the decrypted DBs. While no file changed size
+or mtime, checking it costs a few stat calls and never opens a database. A
+message DB that did change is only re-read when its Name2Id row count or
+max(rowid) moved, so new messages alone do not rebuild the map.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+from pathlib import Path
+import sqlite3
+
+CACHE_NAME = "derived/table_owners.json"
+CACHE_VERSION = 3
+
+
+def message_table(username: str) -> str:
+    return "Msg_" + hashlib.md5(username.encode()).hexdigest()
+
+
+def table_hash(table: str) -> str:
+    return table[4:] if table.startswith("Msg_") else table
+
+
+def _connect(db_path: Path) -> sqlite3.Connection:
+    return sqlite3.connect(db_path.resolve().as_uri() + "?mode=ro", uri=True)
+
+
+def _contact_usernames(contact_db: Path) -> set[str]:
+    con = _connect(contact_db)
+    try:
+        columns = {row[1] for row in con.execute("PRAGMA table_info(contact)")}
+        column = "username" if "username" in columns else "userName" if "userName" in columns else None
+        if not column:
+            return set()
+        return {str(row[0]) for row in con.execute(f"SELECT {column} FROM contact") if row[0]}
+    except sqlite3.Error:
+        return set()
+    finally:
+        con.close()
+
+
+def _name2id(con: sqlite3.Connection) -> set[str]:
+    try:
+        return {str(row[0]) for row in con.execute("SELECT user_name FROM Name2Id") if row[0]}
+    except sqlite3.Error:
+        return set()
+
+
+def _file_signature(db_path: Path) -> list[int]:
+    stat = db_path.stat()
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def _name2id_key(con: sqlite3.Connection) -> list | None:
+    try:
+        return list(con.execute("SELECT count(*), max(rowid) FROM Name2Id").fetchone())
+    except sqlite3.Error:
+        return None
+
+
+def _owners(usernames) -> dict[str, str]:
+    return {hashlib.md5(username.encode()).hexdigest(): username for username in sorted(usernames)}
+
+
+def build_owner_map(contact_db: Path | None, message_dbs: list[Path]) -> dict[str, str]:
+    usernames = _contact_usernames(contact_db) if contact_db and contact_db.exists() else set()
+    for db_path in message_dbs:
+        con = _connect(db_path)
+        try:
+            usernames |= _name2id(con)
+        finally:
+            con.close()
+    return _owners(usernames)
+
+
+def _save(path: Path, data: dict) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        os.chmod(path.parent, 0o700)
+    except OSError:
+        pass
+    partial = path.with_name(path.name + ".partial")
+    with partial.open("w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.chmod(partial, 0o600)
+    os.replace(partial, path)
+
+
+def load_owner_map(contact_db: Path | None, message_dbs: list[Path], cache_path: Path) -> dict[str, str]:
+    """Return {md5 hex: username}, re-reading only the sources whose contents changed."""
+    try:
+        with cache_path.open(encoding="utf-8") as f:
+            cached = json.load(f)
+        if cached.get("version") != CACHE_VERSION:
+            cached = {}
+    except (OSError, ValueError):
+        cached = {}
+    sources = cached.get("sources", {})
+    fresh: dict[str, dict] = {}
+    changed = False
+    if contact_db and contact_db.exists():
+        sig = _file_signature(contact_db)
+        entry = sources.get("contact")
+        if not entry or entry.get("signature") != sig:
+            entry = {"signature": sig, "usernames": sorted(_contact_usernames(contact_db))}
+            changed = True
+        fresh["contact"] = entry
+    for db_path in message_dbs:
+        sig = _file_signature(db_path)
+        entry = sources.get(db_path.name)
+        if not entry or entry.get("signature") != sig:
+            con = _connect(db_path)
+            try:
+                key = _name2id_key(con)
+                if not entry or key is None or entry.get("name2id") != key:
+                    entry = {"name2id": key, "usernames": sorted(_name2id(con))}
+                    changed = True
+            finally:
+                con.close()
+            entry = {**entry, "signature": sig}
+        fresh[db_path.name] = entry
+    if not changed and fresh.keys() == sources.keys() and "owners" in cached:
+        owners = cached["owners"]
+    else:
+        owners = _owners(set().union(*(entry["usernames"] for entry in fresh.values())))
+    if fresh != sources or "owners" not in cached:
+        try:
+            _save(cache_path, {"version": CACHE_VERSION, "sources": fresh, "owners": owners})
+        except OSError:
+            pass
+    return owners
+
+
+def vault_owner_map(decrypted_dir: Path) -> dict[str, str]:
+    message_dbs = sorted((decrypted_dir / "message").glob("message_*.db"))
+    return load_owner_map(decrypted_dir / "contact/contact.db", message_dbs, decrypted_dir / CACHE_NAME)
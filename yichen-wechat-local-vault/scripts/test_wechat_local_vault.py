@@ -0,0 +1,445 @@
+#!/usr/bin/env python3
+"""Offline unit tests; no WeChat process or user database is touched."""
+
+from __future__ import annotations
+
+import argparse
+import hashlib
+import json
+import os
+import socket
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest
+from contextlib import closing
+from pathlib import Path
+from unittest import mock
+
+from Crypto.Cipher import AES
+
+import decrypt_all_dbs
+import export_chat
+from media_index import MediaIndex
+import table_catalog
+import table_owners
+import vault_cli
+import vault_daemon
+from vault_cli import (
+    STATS_ROLLUP,
+    local_hour_start,
+    query_sns_index,
+    search_message_index,
+    update_message_index,
+    update_sns_index,
+    update_stats_rollup,
+)
+from wechat_crypto import IV_SIZE, PAGE_SIZE, RESERVE, decrypt_database, page_tokens
+
+CHAT = "wxid_friend"
+TABLE = "Msg_" + hashlib.md5(CHAT.encode()).hexdigest()
+KEY_HEX = "00112233445566778899aabbccddeeff" * 2
+
+
+def search_args(keyword: str) -> argparse.Namespace:
+    return argparse.Namespace(keyword=keyword, type=None, sort="time", limit=100, offset=0)
+
+
+def encrypt_page(plain: bytes, page_index: int) -> bytes:
+    """SQLCipher 4 page layout: salt on page one, CBC body, then IV and HMAC in the reserve."""
+    start = 16 if page_index == 0 else 0
+    iv = os.urandom(IV_SIZE)
+    body = AES.new(bytes.fromhex(KEY_HEX), AES.MODE_CBC, iv).encrypt(plain[start : PAGE_SIZE - RESERVE])
+    return plain[:start] + body + iv + os.urandom(RESERVE - IV_SIZE)
+
+
+class CryptoTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = Path(self.tmp.name)
+        self.src = self.root / "source.db"
+        self.encrypted = [b""] * 12
+        for index in range(12):
+            self.rewrite(index)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def rewrite(self, index: int) -> None:
+        plain = os.urandom(PAGE_SIZE - RESERVE) + bytes(RESERVE)
+        if index == len(self.encrypted):
+            self.encrypted.append(b"")
+        self.encrypted[index] = encrypt_page(plain, index)
+        self.src.write_bytes(b"".join(self.encrypted))
+
+    def test_full_decrypt_collects_page_map(self):
+        stats = decrypt_database(self.src, self.root / "plain.db", KEY_HEX, jobs=1, with_tokens=True)
+        self.assertEqual(stats["page_tokens"], page_tokens(self.src))
+
+    def test_incremental_patch_matches_full_decrypt(self):
+        dst = self.root / "current/message/message_0.db"
+        reference = self.root / "reference.db"
+        state = self.root / "state"
+        with mock.patch.object(decrypt_all_dbs, "PAGE_MAP_DIR", state / "page_maps"), mock.patch.object(decrypt_all_dbs, "LOCK_FILE", state / "decrypt.lock"):
+            decrypt_all_dbs.refresh_db(self.src, dst, "message/message_0.db", KEY_HEX, "full", jobs=1)
+            for index in (3, 7, 12):
+                self.rewrite(index)
+            stats = decrypt_all_dbs.refresh_db(self.src, dst, "message/message_0.db", KEY_HEX, "incremental", jobs=1)
+        decrypt_database(self.src, reference, KEY_HEX, jobs=1)
+        self.assertEqual((stats["pages_patched"], stats["pages"]), (3, 13))
+        self.assertEqual(dst.read_bytes(), reference.read_bytes())
+
+
+class VaultFixture(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.vault = Path(self.tmp.name)
+        (self.vault / "message").mkdir()
+        self.db = self.vault / "message/message_0.db"
+        with closing(sqlite3.connect(self.db)) as con, con:
+            con.execute("CREATE TABLE Name2Id(user_name TEXT PRIMARY KEY)")
+            con.executemany("INSERT INTO Name2Id(user_name) VALUES (?)", [(CHAT,), ("wxid_me",)])
+            con.execute(
+                f"CREATE TABLE [{TABLE}](local_id INTEGER PRIMARY KEY AUTOINCREMENT, server_id INTEGER, local_type INTEGER, "
+                "real_sender_id INTEGER, create_time INTEGER, message_content TEXT, WCDB_CT_message_content INTEGER)"
+            )
+        self.insert([(1000, "hello there"), (1010, "明天开会"), (1020, "yellow card")])
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def insert(self, rows: list[tuple[int, str]]) -> None:
+        with closing(sqlite3.connect(self.db)) as con, con:
+            con.executemany(
+                f"INSERT INTO [{TABLE}](server_id, local_type, real_sender_id, create_time, message_content, WCDB_CT_message_content) "
+                "VALUES (1, 1, 1, ?, ?, 0)",
+                rows,
+            )
+        self.touch()
+
+    def touch(self) -> None:
+        # Same-tick writes can leave mtime_ns unchanged; the refresh keys on it.
+        stat = self.db.stat()
+        os.utime(self.db, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+
+
+class MessageIndexTests(VaultFixture):
+    def found(self, keyword: str) -> list[str]:
+        rows = search_message_index(self.vault, {}, search_args(keyword), [], None, None)
+        return sorted(row["content"] for row in rows)
+
+    def test_index_build_matches_substrings(self):
+        stats = update_message_index(self.vault)
+        self.assertEqual(stats["messages_added"], 3)
+        self.assertEqual(self.found("ell"), ["hello there", "yellow card"])
+        self.assertEqual(self.found("HELLO"), ["hello there"])
+        self.assertEqual(self.found("开会"), ["明天开会"])
+        self.assertEqual(self.found("lo"), ["hello there", "yellow card"])
+        self.assertEqual(self.found("%"), [])
+
+    def test_incremental_refresh_adds_only_new_rows(self):
+        update_message_index(self.vault)
+        self.insert([(1030, "hello again")])
+        stats = update_message_index(self.vault)
+        self.assertEqual((stats["messages_added"], stats["indexed_messages"]), (1, 4))
+        self.assertEqual(update_message_index(self.vault)["databases_scanned"], 0)
+        self.assertEqual(self.found("hello"), ["hello again", "hello there"])
+
+    def test_late_row_with_older_create_time_is_indexed(self):
+        update_message_index(self.vault)
+        self.insert([(500, "late hello")])
+        self.assertEqual(update_message_index(self.vault)["messages_added"], 1)
+        self.assertEqual(self.found("hello"), ["hello there", "late hello"])
+
+    def test_changed_row_is_reindexed(self):
+        update_message_index(self.vault)
+        with closing(sqlite3.connect(self.db)) as con, con:
+            con.execute(f"UPDATE [{TABLE}] SET local_type=10000, message_content='撤回了一条消息' WHERE create_time=1000")
+        self.touch()
+        stats = update_message_index(self.vault)
+        self.assertEqual((stats["tables_rebuilt"], stats["indexed_messages"]), (1, 3))
+        self.assertEqual(self.found("hello"), [])
+        self.assertEqual(self.found("撤回了"), ["撤回了一条消息"])
+
+
+class HistoryCursorTests(VaultFixture):
+    def test_cursor_pages_match_one_query_across_tied_shards(self):
+        self.insert([(1010, "tie a"), (1010, "tie b"), (1020, "tie c")])
+        other = self.vault / "message/message_1.db"
+        with closing(sqlite3.connect(self.db)) as src, closing(sqlite3.connect(other)) as dst, dst:
+            for (sql,) in src.execute("SELECT sql FROM sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite_%'"):
+                dst.execute(sql)
+            dst.execute("INSERT INTO Name2Id(user_name) VALUES (?)", (CHAT,))
+            dst.executemany(
+                f"INSERT INTO [{TABLE}](server_id, local_type, real_sender_id, create_time, message_content, WCDB_CT_message_content) "
+                "VALUES (2, 1, 1, ?, ?, 0)",
+                [(1000, "other 1000"), (1010, "other 1010 a"), (1010, "other 1010 b"), (1020, "other 1020"), (1030, "other 1030")],
+            )
+        chat = {"username": CHAT, "display_name": CHAT, "is_group": False}
+        everything = [row["cursor"] for row in vault_cli.collect_history(self.vault, chat, None, None, 100, 0, None)]
+        self.assertEqual(len(everything), 11)
+        walked, cursor = [], None
+        while True:
+            page = vault_cli.collect_history(self.vault, chat, None, None, 2, 0, None, cursor=cursor)
+            walked = [row["cursor"] for row in page] + walked
+            if len(page) < 2:
+                break
+            cursor = page[0]["cursor"]
+        self.assertEqual(walked, everything)
+
+
+class SidecarCheckTests(VaultFixture):
+    def test_changed_shard_is_summed_once_for_both_sidecars(self):
+        vault_cli.refresh_message_sidecars(self.vault)
+        self.insert([(1030, "hello again")])
+        with mock.patch.object(vault_cli, "table_checksum", wraps=vault_cli.table_checksum) as checksum:
+            vault_cli.refresh_message_sidecars(self.vault)
+        full_scans = [call for call in checksum.call_args_list if call.args[3] is None]
+        self.assertEqual(len(full_scans), 1)
+        self.assertEqual(self.found_in_both(), (4, 4))
+
+    def found_in_both(self) -> tuple[int, int]:
+        with closing(sqlite3.connect(self.vault / vault_cli.MESSAGE_INDEX)) as index, closing(sqlite3.connect(self.vault / STATS_ROLLUP)) as rollup:
+            return index.execute("SELECT count(*) FROM message_fts").fetchone()[0], rollup.execute("SELECT sum(count) FROM hourly_counts").fetchone()[0]
+
+
+class TableCatalogTests(VaultFixture):
+    def test_middle_delete_is_recounted(self):
+        self.assertEqual(table_catalog.load_table_catalog(self.vault)["message_0.db"]["tables"][TABLE][0], 3)
+        with closing(sqlite3.connect(self.db)) as con, con:
+            con.execute(f"DELETE FROM [{TABLE}] WHERE create_time=1010")
+        self.touch()
+        self.assertEqual(table_catalog.load_table_catalog(self.vault)["message_0.db"]["tables"][TABLE][0], 2)
+
+    def test_unscannable_shard_is_kept_as_unknown(self):
+        table_catalog.load_table_catalog(self.vault)
+        self.touch()
+        with mock.patch.object(table_catalog, "scan_shard", side_effect=sqlite3.DatabaseError("locked")), mock.patch("sys.stderr"):
+            catalog = table_catalog.load_table_catalog(self.vault)
+        self.assertTrue(catalog["message_0.db"]["unknown"])
+        self.assertEqual(table_catalog.chat_shards(catalog, "Msg_" + "0" * 32), ["message_0.db"])
+        self.assertEqual(table_catalog.chat_shards(catalog, "Msg_" + "0" * 32, include_unknown=False), [])
+        self.assertTrue(table_catalog.catalog_summary(catalog)["message_0.db"]["unknown"])
+        self.assertIsNone(table_catalog.load_table_catalog(self.vault)["message_0.db"].get("unknown"))
+
+
+class TableOwnerTests(VaultFixture):
+    def test_cache_is_checked_without_opening_databases(self):
+        hashed = TABLE[4:]
+        self.assertEqual(table_owners.vault_owner_map(self.vault)[hashed], CHAT)
+        with mock.patch.object(table_owners.sqlite3, "connect", side_effect=AssertionError("opened")):
+            self.assertEqual(table_owners.vault_owner_map(self.vault)[hashed], CHAT)
+        with closing(sqlite3.connect(self.db)) as con, con:
+            con.execute("INSERT INTO Name2Id(user_name) VALUES ('wxid_new')")
+        self.touch()
+        self.assertIn("wxid_new", table_owners.vault_owner_map(self.vault).values())
+
+    def test_new_messages_do_not_reread_name2id(self):
+        table_owners.vault_owner_map(self.vault)
+        self.insert([(1030, "hello again")])
+        with mock.patch.object(table_owners, "_name2id", side_effect=AssertionError("re-read")):
+            self.assertEqual(table_owners.vault_owner_map(self.vault)[TABLE[4:]], CHAT)
+
+
+class StatsRollupTests(VaultFixture):
+    def counts(self) -> dict[tuple[int, int], int]:
+        update_stats_rollup(self.vault)
+        with closing(sqlite3.connect(self.vault / STATS_ROLLUP)) as con:
+            return {(hour, local_type): count for hour, local_type, count in con.execute("SELECT hour, local_type, sum(count) FROM hourly_counts GROUP BY 1, 2")}
+
+    def test_late_and_changed_rows_are_counted(self):
+        self.assertEqual(sum(self.counts().values()), 3)
+        self.insert([(500, "late hello")])
+        self.assertEqual(sum(self.counts().values()), 4)
+        with closing(sqlite3.connect(self.db)) as con, con:
+            con.execute(f"UPDATE [{TABLE}] SET local_type=10000 WHERE create_time=1000")
+        self.touch()
+        counts = self.counts()
+        self.assertEqual(sum(count for (_, local_type), count in counts.items() if local_type == 10000), 1)
+        self.assertEqual(sum(counts.values()), 4)
+
+    def test_buckets_follow_half_hour_offsets(self):
+        previous = os.environ.get("TZ")
+        os.environ["TZ"] = "Asia/Kolkata"
+        time.tzset()
+        try:
+            self.assertEqual(local_hour_start(1000), -1800)
+            self.assertEqual(self.counts(), {(-1800, 1): 3})
+        finally:
+            if previous is None:
+                os.environ.pop("TZ")
+            else:
+                os.environ["TZ"] = previous
+            time.tzset()
+
+
+class ExportBatchTests(unittest.TestCase):
+    CHATS = {"wxid_alice": "Alice", "wxid_bob": "Bob"}
+    SHARDS = {
+        "message_0.db": {
+            "wxid_alice": [(100, 1, "a1"), (300, 1, "a3"), (300, 2, "a3 reply")],
+            "wxid_bob": [(150, 1, "b1"), (250, 2, "b2")],
+        },
+        "message_1.db": {
+            "wxid_alice": [(200, 2, "a2"), (300, 1, "a3"), (400, 1, "a4")],
+            "wxid_bob": [(150, 2, "b1 echo"), (350, 1, "b3")],
+        },
+    }
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        root = Path(self.tmp.name)
+        self.vault, self.exports = root / "vault", root / "exports"
+        (self.vault / "contact").mkdir(parents=True)
+        (self.vault / "message").mkdir()
+        with closing(sqlite3.connect(self.vault / "contact/contact.db")) as con, con:
+            con.execute("CREATE TABLE contact(username TEXT, remark TEXT, nick_name TEXT)")
+            con.executemany("INSERT INTO contact VALUES (?, ?, '')", self.CHATS.items())
+        for name, chats in self.SHARDS.items():
+            with closing(sqlite3.connect(self.vault / "message" / name)) as con, con:
+                con.execute("CREATE TABLE Name2Id(user_name TEXT PRIMARY KEY)")
+                for chat_id, rows in chats.items():
+                    con.execute("INSERT INTO Name2Id(user_name) VALUES (?)", (chat_id,))
+                    con.execute(
+                        f"CREATE TABLE [{table_owners.message_table(chat_id)}](local_id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                        "server_id INTEGER, local_type INTEGER, real_sender_id INTEGER, create_time INTEGER, "
+                        "message_content TEXT, compress_content BLOB)"
+                    )
+                    con.executemany(
+                        f"INSERT INTO [{table_owners.message_table(chat_id)}](server_id, local_type, real_sender_id, create_time, message_content) "
+                        "VALUES (0, 1, ?, ?, ?)",
+                        [(sender, ts, text) for ts, sender, text in rows],
+                    )
+
+    def test_batch_exports_each_chat_in_merged_order(self):
+        chat_list = Path(self.tmp.name) / "chats.txt"
+        chat_list.write_text("wxid_alice\nBob\n")
+        manifest = Path(self.tmp.name) / "manifest.json"
+        args = argparse.Namespace(
+            batch=str(chat_list), active_since=None, since=None, mode="full", write_empty=False, jobs=2, manifest=str(manifest)
+        )
+        with mock.patch.object(export_chat, "EXPORT_STATE_FILE", Path(self.tmp.name) / "state.json"), mock.patch("sys.stdout"):
+            export_chat.run_batch(args, self.vault, self.exports, export_chat.load_contacts(self.vault))
+
+        summary = json.loads(manifest.read_text())
+        self.assertEqual((summary["chats"], summary["exported"], summary["messages"], summary["unresolved"]), (2, 2, 9, []))
+        self.assertEqual([(item["chat_id"], item["display"], item["messages"]) for item in summary["results"]], [
+            ("wxid_alice", "Alice", 5),
+            ("wxid_bob", "Bob", 4),
+        ])
+        timelines = {}
+        for item in summary["results"]:
+            lines = Path(item["path"]).read_text(encoding="utf-8").split("## 时间线\n\n", 1)[1].splitlines()
+            timelines[item["chat_id"]] = [line.split("] ", 1)[1] for line in lines]
+        # a3 sits in both shards and is exported once; equal timestamps keep shard order.
+        self.assertEqual(timelines["wxid_alice"], ["a1", "a2", "a3", "a3 reply", "a4"])
+        self.assertEqual(timelines["wxid_bob"], ["b1", "b1 echo", "b2", "b3"])
+        state = json.loads((Path(self.tmp.name) / "state.json").read_text())
+        self.assertEqual(state["chat:wxid_alice"]["last_ts"], 400)
+
+
+class MediaIndexTests(unittest.TestCase):
+    def test_file_lookup_stays_near_month_and_size(self):
+        index = MediaIndex(Path("/account"), [
+            ("msg/file/2026-09", "report.pdf", "file", "", "2026-09", "report", 100),
+            ("msg/file/2026-05", "notes.txt", "file", "", "2026-05", "notes", 7),
+        ])
+        self.assertEqual(index.file("report.pdf", 100, "2026-10"), Path("/account/msg/file/2026-09/report.pdf"))
+        self.assertIsNone(index.file("report.pdf", 99, "2026-09"))
+        self.assertIsNone(index.file("notes.txt", None, "2026-09"))
+        self.assertEqual(index.file("notes.txt", None, "2026-05"), Path("/account/msg/file/2026-05/notes.txt"))
+
+
+class SnsIndexTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.vault = Path(self.tmp.name)
+        (self.vault / "sns").mkdir()
+        self.db = self.vault / "sns/sns.db"
+        with closing(sqlite3.connect(self.db)) as con, con:
+            con.execute("CREATE TABLE SnsTimeLine(tid INTEGER PRIMARY KEY, user_name TEXT, content TEXT)")
+            con.execute("INSERT INTO SnsTimeLine VALUES (1, ?, ?)", (CHAT, self.post("周末去爬山 hello")))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def post(self, text: str) -> str:
+        return (
+            f"<SnsDataItem><TimelineObject><id>1</id><username>{CHAT}</username><createTime>1000</createTime>"
+            f"<contentDesc>{text}</contentDesc></TimelineObject></SnsDataItem>"
+        )
+
+    def found(self, keyword: str) -> list[str]:
+        return [post["content"] for post in query_sns_index(self.vault, [CHAT], keyword=keyword)]
+
+    def test_same_length_edit_is_reparsed_and_substrings_match(self):
+        self.assertEqual(self.found("ell"), ["周末去爬山 hello"])
+        self.assertEqual(self.found("爬山"), ["周末去爬山 hello"])
+        with closing(sqlite3.connect(self.db)) as con, con:
+            con.execute("UPDATE SnsTimeLine SET content=? WHERE tid=1", (self.post("周末去爬山 jello"),))
+        stat = self.db.stat()
+        os.utime(self.db, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+        self.assertEqual(update_sns_index(self.vault)["posts_updated"], 1)
+        self.assertEqual(self.found("jell"), ["周末去爬山 jello"])
+        self.assertEqual(self.found("hell"), [])
+
+
+class DaemonTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.socket_path = Path(self.tmp.name) / "state/vault_cli.sock"
+        for target, name in ((vault_cli, "DAEMON_SOCKET"), (vault_daemon, "SOCKET_PATH")):
+            patcher = mock.patch.object(target, name, self.socket_path)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = mock.patch.dict(os.environ, {"WECHAT_VAULT_NO_DAEMON": ""})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.tmp.cleanup)
+
+    def start_daemon(self) -> vault_daemon.Daemon:
+        patcher = mock.patch.object(vault_cli.CACHE, "enabled", vault_cli.CACHE.enabled)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        daemon = vault_daemon.Daemon(idle_timeout=0)
+        thread = threading.Thread(target=daemon.serve)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(vault_daemon.rpc, "shutdown")
+        while not vault_daemon.is_running():
+            time.sleep(0.01)
+        return daemon
+
+    def test_runs_through_daemon(self):
+        daemon = self.start_daemon()
+        result = vault_cli.delegate_to_daemon(["--help"])
+        self.assertEqual(result["exit_code"], 0)
+        self.assertIn("usage", result["stdout"])
+        self.assertEqual(daemon.requests, 1)
+
+    def test_busy_daemon_falls_back_to_local(self):
+        daemon = self.start_daemon()
+        with daemon.run_lock:
+            self.assertIsNone(vault_cli.delegate_to_daemon(["--help"]))
+        self.assertEqual(daemon.requests, 0)
+
+    def test_unreachable_socket_falls_back_to_local(self):
+        self.socket_path.parent.mkdir(parents=True)
+        self.socket_path.touch()
+        self.assertIsNone(vault_cli.delegate_to_daemon(["--help"]))
+
+    def test_missing_reply_is_an_error_not_a_rerun(self):
+        self.socket_path.parent.mkdir(parents=True)
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as server:
+            server.bind(str(self.socket_path))
+            server.listen(1)
+            with mock.patch.object(vault_cli, "DAEMON_REPLY_TIMEOUT", 0.1), mock.patch.object(vault_cli, "command_search") as local:
+                with self.assertRaises(SystemExit):
+                    vault_cli.main(["search", "watch"])
+                local.assert_not_called()
+
+
+if __name__ == "__main__":
+    unittest.main()
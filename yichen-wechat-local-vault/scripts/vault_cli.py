@@ -10,16 +10,27 @@ and does not modify WeChat databases.
 from __future__ import annotations
 
 import argparse
+from collections.abc import Mapping, MutableMapping
 from datetime import datetime
+from functools import cached_property, lru_cache
 import hashlib
+import heapq
+from itertools import islice
 import json
 import os
 from pathlib import Path
 import re
+import socket
 import sqlite3
 import sys
+import time
 from xml.etree import ElementTree as ET
 
+from contact_resolver import ContactIndex
+from media_index import INDEX_NAME as MEDIA_INDEX, MediaIndex, load_media_index, update_media_index
+from table_catalog import chat_shards, load_table_catalog
+from table_owners import message_table, table_hash, vault_owner_map
+
 try:
     import zstandard as zstd
 except Exception:  # pragma: no cover - optional runtime dependency
@@ -31,6 +42,26 @@ DEFAULT_VAULT_DIR = Path("~/Library/Application Support/wechat-local-vault").exp
 DEFAULT_DECRYPTED_DIR = DEFAULT_VAULT_DIR / "decrypted/current"
 DEFAULT_EXPORTS_DIR = Path("~/Documents/wechat-local-vault/exports").expanduser()
 STATE_FILE = DEFAULT_VAULT_DIR / "state/vault_cli_last_check.json"
+DAEMON_SOCKET = DEFAULT_VAULT_DIR / "state/vault_cli.sock"
+DAEMON_CONNECT_TIMEOUT = 1.0
+DAEMON_REPLY_TIMEOUT = 120.0
+DAEMON_BUSY = -32001
+MESSAGE_INDEX = "derived/message_fts.db"
+MESSAGE_INDEX_VERSION = "2"
+STATS_ROLLUP = "derived/stats_rollup.db"
+STATS_ROLLUP_VERSION = "2"
+SNS_INDEX = "derived/sns_posts.db"
+SNS_INDEX_VERSION = "2"
+FAVORITE_INDEX = "derived/favorites.db"
+FAVORITE_INDEX_VERSION = "1"
+HOUR_SECONDS = 3600
+SESSION_DB = "session/session.db"
+MESSAGE_DB_RE = re.compile(r"message/message_\d+\.db")
+SYSTEM_TYPES = (10000, 10002)
+
+# unicode61 keeps a run of Han/Kana/Hangul as one token; spacing each character
+# turns CJK text into single-character tokens so phrase queries match substrings.
+CJK_RE = re.compile(r"[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff]")
 
 ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
 ZSTD_DECODER = zstd.ZstdDecompressor() if zstd else None
@@ -123,12 +154,67 @@ def resolve_db_dir() -> Path | None:
     return None
 
 
-def connect(path: Path) -> sqlite3.Connection:
+def file_signature(path: Path) -> tuple | None:
+    try:
+        stat = path.stat()
+    except OSError:
+        return None
+    return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+
+class WarmCache:
+    """Memo of per-file derived values, kept inside vault_daemon.py and `watch`.
+
+    Entries are keyed by file and dropped as soon as the file's inode, size or
+    mtime changes, so a re-decrypt is picked up on the next request.
+    """
+
+    def __init__(self) -> None:
+        self.enabled = False
+        self.entries: dict[tuple[str, str], tuple[tuple | None, object]] = {}
+
+    def get(self, kind: str, path: Path, build):
+        if not self.enabled:
+            return build()
+        key = (kind, str(path))
+        signature = file_signature(path)
+        hit = self.entries.get(key)
+        if hit and hit[0] == signature:
+            return hit[1]
+        if hit and isinstance(hit[1], sqlite3.Connection):
+            hit[1].close()
+        value = build()
+        self.entries[key] = (signature, value)
+        return value
+
+    def clear(self) -> None:
+        for _, value in self.entries.values():
+            if isinstance(value, sqlite3.Connection):
+                value.close()
+        self.entries.clear()
+
+
+CACHE = WarmCache()
+
+
+def open_db(path: Path) -> sqlite3.Connection:
     con = sqlite3.connect(path)
     con.row_factory = sqlite3.Row
     return con
 
 
+def connect(path: Path) -> sqlite3.Connection:
+    if not CACHE.enabled:
+        return open_db(path)
+
+    def open_read_only() -> sqlite3.Connection:
+        con = sqlite3.connect(f"{path.resolve().as_uri()}?mode=ro", uri=True)
+        con.row_factory = sqlite3.Row
+        return con
+
+    return CACHE.get("connection", path, open_read_only)
+
+
 def table_columns(con: sqlite3.Connection, table: str) -> set[str]:
     try:
         return {row["name"] for row in con.execute(f"PRAGMA table_info([{table}])")}
@@ -208,22 +294,53 @@ def decode_value(value, compression_flag=None) -> str:
         return "[二进制内容]"
 
 
+def decompress_many(blobs: list[bytes]) -> list[str]:
+    """Decode a batch of zstd blobs with one decompression context call."""
+    if not blobs:
+        return []
+    try:
+        return [bytes(item).decode("utf-8", errors="replace") for item in ZSTD_DECODER.multi_decompress_to_buffer(blobs)]
+    except Exception:
+        # Frames without a content size (or a corrupt one) go one at a time.
+        return [decode_value(blob, 4) for blob in blobs]
+
+
+def json_default(value):
+    if isinstance(value, MessageRecord):
+        return value.as_dict()
+    if isinstance(value, Mapping):
+        return dict(value)
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
 def output(data, fmt: str) -> None:
     if fmt == "json":
-        print(json.dumps(data, ensure_ascii=False, indent=2))
+        print(json.dumps(data, ensure_ascii=False, indent=2, default=json_default))
     else:
         print(data)
 
 
-def load_contacts(decrypted_dir: Path) -> tuple[dict[str, dict], dict[int, str]]:
+def load_contacts(decrypted_dir: Path) -> tuple[ContactBook, dict[int, str]]:
     contact_db = decrypted_dir / "contact/contact.db"
+    return CACHE.get("contacts", contact_db, lambda: read_contacts(contact_db))
+
+
+class ContactBook(dict):
+    """username -> contact, with the shared fuzzy-lookup index built on first use."""
+
+    @cached_property
+    def index(self) -> ContactIndex:
+        return ContactIndex(item["raw"] for item in self.values())
+
+
+def read_contacts(contact_db: Path) -> tuple[ContactBook, dict[int, str]]:
     if not contact_db.exists():
-        return {}, {}
-    contacts: dict[str, dict] = {}
+        return ContactBook(), {}
+    contacts = ContactBook()
     id_to_username: dict[int, str] = {}
     with connect(contact_db) as con:
         if not table_exists(con, "contact"):
-            return {}, {}
+            return ContactBook(), {}
         for row in con.execute("SELECT * FROM contact"):
             item = dict(row)
             username = item.get("username") or item.get("userName") or ""
@@ -259,7 +376,7 @@ def display_name(username: str, contacts: dict[str, dict]) -> str:
     return contacts.get(username, {}).get("display_name") or username
 
 
-def resolve_chat(query: str, contacts: dict[str, dict]) -> dict | None:
+def resolve_chat(query: str, contacts: ContactBook) -> dict | None:
     if query in contacts:
         return contacts[query]
     if query.startswith("wxid_") or "@chatroom" in query or query.startswith("gh_"):
@@ -268,24 +385,23 @@ def resolve_chat(query: str, contacts: dict[str, dict]) -> dict | None:
             "display_name": contacts.get(query, {}).get("display_name", query),
             "is_group": "@chatroom" in query,
         }
-    q = query.lower()
-    exact = [c for c in contacts.values() if q == c["display_name"].lower()]
-    if exact:
-        return exact[0]
-    fuzzy = [
-        c
-        for c in contacts.values()
-        if any(q in str(c.get(field) or "").lower() for field in ("display_name", "remark", "nick_name", "alias", "username"))
-    ]
-    return fuzzy[0] if fuzzy else None
+    username = contacts.index.resolve(query)
+    return contacts[username] if username else None
 
 
 def message_dbs(decrypted_dir: Path) -> list[Path]:
     return sorted((decrypted_dir / "message").glob("message_*.db"))
 
 
-def message_table(username: str) -> str:
-    return "Msg_" + hashlib.md5(username.encode()).hexdigest()
+def message_tables(db_path: Path, con: sqlite3.Connection) -> set[str]:
+    def read() -> set[str]:
+        return {row["name"] for row in con.execute("SELECT name FROM sqlite_master WHERE type='table' AND name LIKE 'Msg_%'")}
+
+    return CACHE.get("tables", db_path, read)
+
+
+def name2id_for(db_path: Path, con: sqlite3.Connection) -> dict[int, str]:
+    return CACHE.get("name2id", db_path, lambda: load_name2id(con))
 
 
 def load_name2id(con: sqlite3.Connection) -> dict[int, str]:
@@ -301,32 +417,6 @@ def load_name2id(con: sqlite3.Connection) -> dict[int, str]:
     return mapping
 
 
-def username_for_table(table: str, con: sqlite3.Connection) -> str:
-    if not table.startswith("Msg_"):
-        return ""
-    target = table[4:]
-    if not table_exists(con, "Name2Id"):
-        return ""
-    try:
-        for row in con.execute("SELECT user_name FROM Name2Id"):
-            username = str(row["user_name"] or "")
-            if hashlib.md5(username.encode()).hexdigest() == target:
-                return username
-    except sqlite3.Error:
-        return ""
-    return ""
-
-
-def username_for_table_from_contacts(table: str, contacts: dict[str, dict]) -> str:
-    if not table.startswith("Msg_"):
-        return ""
-    target = table[4:]
-    for username in contacts:
-        if hashlib.md5(username.encode()).hexdigest() == target:
-            return username
-    return ""
-
-
 def message_columns(con: sqlite3.Connection, table: str) -> dict[str, str]:
     columns = table_columns(con, table)
     result = {}
@@ -347,24 +437,34 @@ def message_columns(con: sqlite3.Connection, table: str) -> dict[str, str]:
     return result
 
 
-def build_select_sql(table: str, cols: dict[str, str], start_ts: int | None, end_ts: int | None, keyword: str | None, type_name: str | None, limit: int | None, offset: int = 0) -> tuple[str, list]:
+def type_clauses(column: str, type_name: str) -> tuple[list[str], list]:
+    expected = MESSAGE_TYPE_FILTERS[type_name]
+    clauses = [f"({column} & 4294967295) = ?"]
+    params = [expected[0]]
+    if len(expected) > 1:
+        clauses.append(f"(({column} >> 32) & 4294967295) = ?")
+        params.append(expected[1])
+    return clauses, params
+
+
+def message_select_list(cols: dict[str, str]) -> str:
     select_parts = []
-    aliases = {
-        "local_id": "local_id",
-        "server_id": "server_id",
-        "local_type": "local_type",
-        "create_time": "create_time",
-        "real_sender_id": "real_sender_id",
-        "message_content": "message_content",
-        "compress_content": "compress_content",
-        "compression_flag": "compression_flag",
-    }
-    for key, alias in aliases.items():
-        col = cols.get(key)
-        if col:
-            select_parts.append(f"{col} AS {alias}")
-        else:
-            select_parts.append(f"NULL AS {alias}")
+    for alias in (
+        "local_id",
+        "server_id",
+        "local_type",
+        "create_time",
+        "real_sender_id",
+        "message_content",
+        "compress_content",
+        "compression_flag",
+    ):
+        col = cols.get(alias)
+        select_parts.append(f"{col} AS {alias}" if col else f"NULL AS {alias}")
+    return ", ".join(select_parts)
+
+
+def filter_clauses(cols: dict[str, str], start_ts: int | None, end_ts: int | None, keyword: str | None, type_name: str | None) -> tuple[list[str], list]:
     clauses = []
     params: list = []
     if start_ts is not None and cols.get("create_time"):
@@ -377,16 +477,16 @@ def build_select_sql(table: str, cols: dict[str, str], start_ts: int | None, end
         clauses.append(f"{cols['message_content']} LIKE ?")
         params.append(f"%{keyword}%")
     if type_name and cols.get("local_type"):
-        expected = MESSAGE_TYPE_FILTERS[type_name]
-        base = expected[0]
-        clauses.append(f"({cols['local_type']} & 4294967295) = ?")
-        params.append(base)
-        if len(expected) > 1:
-            sub = expected[1]
-            clauses.append(f"(({cols['local_type']} >> 32) & 4294967295) = ?")
-            params.append(sub)
+        type_sql, type_params = type_clauses(cols["local_type"], type_name)
+        clauses.extend(type_sql)
+        params.extend(type_params)
+    return clauses, params
+
+
+def build_select_sql(table: str, cols: dict[str, str], start_ts: int | None, end_ts: int | None, keyword: str | None, type_name: str | None, limit: int | None, offset: int = 0) -> tuple[str, list]:
+    clauses, params = filter_clauses(cols, start_ts, end_ts, keyword, type_name)
     where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
-    sql = f"SELECT {', '.join(select_parts)} FROM [{table}] {where} ORDER BY create_time DESC"
+    sql = f"SELECT {message_select_list(cols)} FROM [{table}] {where} ORDER BY create_time DESC"
     if limit is not None:
         sql += " LIMIT ? OFFSET ?"
         params.extend([limit, offset])
@@ -402,17 +502,30 @@ def parse_sender_prefix(content: str) -> tuple[str, str]:
     return "", content
 
 
-def media_hint(local_type: int | None, content: str, resolve_media: bool, db_dir: Path | None, chat_username: str, ts: int) -> str | None:
+@lru_cache(maxsize=4096)
+def parse_appmsg(content: str) -> dict | None:
+    """Fields of an appmsg XML body, memoised on the content so repeated cards parse once."""
+    try:
+        root = ET.fromstring(content)
+    except Exception:
+        return None
+    return {field: (root.findtext(f".//{field}") or "").strip() for field in ("type", "title", "des", "filename", "totallen")}
+
+
+def media_hint(local_type: int | None, content: str, media: MediaIndex | None, chat_username: str, ts: int) -> str | None:
     base_type, _ = split_msg_type(local_type)
+    month = datetime.fromtimestamp(ts).strftime("%Y-%m") if media else ""
     if base_type == 3:
-        return "[图片]"
+        path = media.image(xml_attr(content, "md5"), table_hash(message_table(chat_username)), month) if media else None
+        return f"[图片]\n{path}" if path else "[图片]"
     if base_type == 34:
         match = re.search(r'voicelength="(\d+)"', content or "")
         if match:
             return f"[语音，约 {int(match.group(1)) / 1000:.1f} 秒]"
         return "[语音]"
     if base_type == 43:
-        return "[视频]"
+        path = media.video(xml_attr(content, "md5"), int(xml_attr(content, "length") or 0), month) if media else None
+        return f"[视频]\n{path}" if path else "[视频]"
     if base_type == 47:
         return "[表情]"
     if base_type == 48:
@@ -421,39 +534,31 @@ def media_hint(local_type: int | None, content: str, resolve_media: bool, db_dir
         return "[名片]"
     if base_type == 50:
         return "[通话]"
-    if base_type != 49 or not resolve_media or not db_dir:
+    if base_type != 49 or not media:
         return None
-    title = ""
-    try:
-        root = ET.fromstring(content)
-        title = (root.findtext(".//title") or root.findtext(".//filename") or "").strip()
-    except Exception:
-        pass
+    appmsg = parse_appmsg(content)
+    title = (appmsg["title"] or appmsg["filename"]) if appmsg else ""
     if not title:
         return None
-    file_dir = db_dir.parent / "msg/file"
-    if not file_dir.exists():
-        return f"[文件] {title}"
-    month = datetime.fromtimestamp(ts).strftime("%Y-%m")
-    month_dir = file_dir / month
-    if month_dir.exists():
-        candidate = month_dir / title
-        if candidate.exists():
-            return f"[文件] {title}\n{candidate}"
-    return f"[文件] {title}"
-
-
-def format_content(local_type: int | None, content: str, resolve_media: bool, db_dir: Path | None, chat_username: str, ts: int) -> str:
-    hint = media_hint(local_type, content, resolve_media, db_dir, chat_username, ts)
+    path = media.file(title, int(appmsg["totallen"]) if appmsg["totallen"].isdigit() else None, month)
+    return f"[文件] {title}\n{path}" if path else f"[文件] {title}"
+
+
+def xml_attr(content: str, name: str) -> str:
+    match = re.search(rf'\b{name}\s*=\s*"([^"]*)"', content or "")
+    return match.group(1) if match else ""
+
+
+def format_content(local_type: int | None, content: str, media: MediaIndex | None, chat_username: str, ts: int) -> str:
+    hint = media_hint(local_type, content, media, chat_username, ts)
     if hint:
         return hint
     base_type, sub_type = split_msg_type(local_type)
     if base_type == 49:
         try:
-            root = ET.fromstring(content)
-            app_type = int(root.findtext(".//type") or 0)
-            title = (root.findtext(".//title") or "").strip()
-            desc = (root.findtext(".//des") or "").strip()
+            appmsg = parse_appmsg(content)
+            app_type = int(appmsg["type"] or 0)
+            title, desc = appmsg["title"], appmsg["des"]
             if app_type == 5:
                 return f"[链接] {title or desc}".strip()
             if app_type in (33, 36, 44):
@@ -468,73 +573,245 @@ def format_content(local_type: int | None, content: str, resolve_media: bool, db
     return content.strip()
 
 
-def row_to_message(row: sqlite3.Row, db_name: str, table: str, chat: dict, contacts: dict[str, dict], name2id: dict[int, str], resolve_media: bool = False, db_dir: Path | None = None) -> dict:
-    local_type = row["local_type"]
-    ts = int(row["create_time"] or 0)
-    content = decode_value(row["message_content"], row["compression_flag"]) or decode_value(row["compress_content"], row["compression_flag"])
-    prefix_sender, content = parse_sender_prefix(content)
-    sender_username = ""
-    sender_id = row["real_sender_id"]
-    try:
-        sender_username = name2id.get(int(sender_id), "")
-    except (TypeError, ValueError):
-        sender_username = ""
-    if not sender_username:
-        sender_username = prefix_sender
+def sender_label(chat: dict, sender_username: str, sender_id, contacts: dict[str, dict]) -> str:
     if chat.get("is_group"):
-        sender = display_name(sender_username, contacts) if sender_username else ""
-    elif sender_username and sender_username != chat["username"]:
-        sender = display_name(sender_username, contacts)
-    elif str(sender_id) == "2":
-        sender = "我"
-    else:
-        sender = chat["display_name"]
-    text = format_content(local_type, content, resolve_media, db_dir, chat["username"], ts)
-    return {
-        "db": db_name,
-        "table": table,
-        "local_id": row["local_id"],
-        "server_id": row["server_id"],
-        "type": type_label(local_type),
-        "local_type": local_type,
-        "sender": sender,
-        "sender_username": sender_username,
-        "timestamp": ts,
-        "time": datetime.fromtimestamp(ts).strftime("%Y-%m-%d %H:%M:%S") if ts else "",
-        "content": text,
-    }
+        return display_name(sender_username, contacts) if sender_username else ""
+    if sender_username and sender_username != chat["username"]:
+        return display_name(sender_username, contacts)
+    if str(sender_id) == "2":
+        return "我"
+    return chat["display_name"]
+
+
+class MessageRecord(MutableMapping):
+    """One message row that reads like a dict but decodes on demand.
+
+    Decompression, sender-prefix parsing, appmsg XML and the formatted time are
+    only computed when their key is read, so rows dropped by a filter cost a
+    tuple copy. Keys set by callers (cursor, chat, ...) are kept alongside.
+    """
+
+    FIELDS = ("db", "table", "local_id", "server_id", "type", "local_type", "sender", "sender_username", "timestamp", "time", "content")
+    __slots__ = (
+        "db", "table", "local_id", "server_id", "local_type", "timestamp", "sender_id",
+        "_values", "_chat", "_contacts", "_name2id", "_media",
+        "_raw", "_sender_username", "_sender", "_content", "_time", "_extra",
+    )
 
+    def __init__(self, row: sqlite3.Row, db_name: str, table: str, chat: dict, contacts: dict[str, dict], name2id: dict[int, str], media: MediaIndex | None = None) -> None:
+        self.db = db_name
+        self.table = table
+        self.local_id = row["local_id"]
+        self.server_id = row["server_id"]
+        self.local_type = row["local_type"]
+        self.timestamp = int(row["create_time"] or 0)
+        self.sender_id = row["real_sender_id"]
+        self._values = (row["message_content"], row["compress_content"], row["compression_flag"])
+        self._chat = chat
+        self._contacts = contacts
+        self._name2id = name2id
+        self._media = media
+        self._raw = None
+        self._sender_username = None
+        self._sender = None
+        self._content = None
+        self._time = None
+        self._extra = {}
+
+    def zstd_blob(self) -> bytes | None:
+        """The message_content blob if it still needs zstd decompression."""
+        value, _, flag = self._values
+        if self._raw is not None or value is None or isinstance(value, str) or not ZSTD_DECODER:
+            return None
+        data = bytes(value)
+        return data if data.startswith(ZSTD_MAGIC) or flag == 4 else None
+
+    def set_decompressed(self, text: str) -> None:
+        self._raw = text or decode_value(self._values[1], self._values[2])
+
+    @property
+    def raw_content(self) -> str:
+        if self._raw is None:
+            value, compressed, flag = self._values
+            self._raw = decode_value(value, flag) or decode_value(compressed, flag)
+        return self._raw
+
+    @property
+    def sender_username(self) -> str:
+        if self._sender_username is None:
+            try:
+                username = self._name2id.get(int(self.sender_id), "")
+            except (TypeError, ValueError):
+                username = ""
+            self._sender_username = username or parse_sender_prefix(self.raw_content)[0]
+        return self._sender_username
 
-def find_chat_tables(decrypted_dir: Path, chat: dict) -> list[tuple[Path, str]]:
+    @property
+    def sender(self) -> str:
+        if self._sender is None:
+            self._sender = sender_label(self._chat, self.sender_username, self.sender_id, self._contacts)
+        return self._sender
+
+    @property
+    def content(self) -> str:
+        if self._content is None:
+            _, text = parse_sender_prefix(self.raw_content)
+            self._content = format_content(self.local_type, text, self._media, self._chat["username"], self.timestamp)
+        return self._content
+
+    @property
+    def type(self) -> str:
+        return type_label(self.local_type)
+
+    @property
+    def time(self) -> str:
+        if self._time is None:
+            self._time = datetime.fromtimestamp(self.timestamp).strftime("%Y-%m-%d %H:%M:%S") if self.timestamp else ""
+        return self._time
+
+    def __getitem__(self, key: str):
+        if self._extra and key in self._extra:
+            return self._extra[key]
+        if key in MESSAGE_FIELDS:
+            return getattr(self, key)
+        raise KeyError(key)
+
+    def as_dict(self) -> dict:
+        data = {key: getattr(self, key) for key in self.FIELDS}
+        data.update(self._extra)
+        return data
+
+    def __setitem__(self, key: str, value) -> None:
+        self._extra[key] = value
+
+    def __delitem__(self, key: str) -> None:
+        del self._extra[key]
+
+    def __iter__(self):
+        yield from self.FIELDS
+        yield from (key for key in self._extra if key not in self.FIELDS)
+
+    def __len__(self) -> int:
+        return len(self.FIELDS) + sum(1 for key in self._extra if key not in self.FIELDS)
+
+    def __repr__(self) -> str:
+        return f"MessageRecord({self.db}:{self.table}:{self.local_id})"
+
+
+MESSAGE_FIELDS = frozenset(MessageRecord.FIELDS)
+
+
+def row_to_message(row: sqlite3.Row, db_name: str, table: str, chat: dict, contacts: dict[str, dict], name2id: dict[int, str], media: MediaIndex | None = None) -> MessageRecord:
+    return MessageRecord(row, db_name, table, chat, contacts, name2id, media)
+
+
+def prime_messages(messages: list[MessageRecord]) -> list[MessageRecord]:
+    """Decompress the zstd bodies of a page of messages in one batch."""
+    pending = [(msg, blob) for msg in messages if (blob := msg.zstd_blob()) is not None]
+    for (msg, _), text in zip(pending, decompress_many([blob for _, blob in pending])):
+        msg.set_decompressed(text)
+    return messages
+
+
+def primed(messages, size: int = 500):
+    """Re-yield `messages`, batch-decompressing each chunk of `size` first."""
+    messages = iter(messages)
+    while chunk := list(islice(messages, size)):
+        yield from prime_messages(chunk)
+
+
+def find_chat_tables(decrypted_dir: Path, chat: dict, start_ts: int | None = None, end_ts: int | None = None) -> list[tuple[Path, str]]:
+    """Shards whose catalog entry for the chat's table overlaps [start_ts, end_ts]."""
     target = message_table(chat["username"])
-    matches = []
-    for db_path in message_dbs(decrypted_dir):
-        with connect(db_path) as con:
-            if table_exists(con, target):
-                matches.append((db_path, target))
-    return matches
+    catalog = load_table_catalog(decrypted_dir)
+    found = []
+    for name in chat_shards(catalog, target, start_ts, end_ts):
+        db_path = decrypted_dir / "message" / name
+        # Unknown shards are opened directly; a failure here surfaces instead of dropping the shard.
+        if catalog[name].get("unknown") and not table_exists(connect(db_path), target):
+            continue
+        found.append((db_path, target))
+    return found
+
+
+def format_cursor(key: tuple[int, int, str]) -> str:
+    return f"{key[0]}:{key[1]}:{key[2]}"
+
+
+def parse_cursor(value: str) -> tuple[int, int, str]:
+    try:
+        ts, local_id, db_name = value.split(":", 2)
+        return int(ts), int(local_id), db_name
+    except ValueError:
+        raise SystemExit(f"游标格式不正确: {value}") from None
+
+
+def keyset_clause(cols: dict[str, str], db_name: str, bound: tuple[int, int, str], descending: bool, inclusive: bool) -> tuple[str, list]:
+    """Rows strictly past `bound` in (create_time, local_id, db) order, or at it when inclusive."""
+    ts, local_id, bound_db = bound
+    op = "<" if descending else ">"
+    ties = db_name < bound_db if descending else db_name > bound_db
+    tie_op = op + "=" if ties or (inclusive and db_name == bound_db) else op
+    time_col, id_col = cols["create_time"], cols["local_id"]
+    return f"({time_col} {op} ? OR ({time_col} = ? AND {id_col} {tie_op} ?))", [ts, ts, local_id]
+
+
+def shard_stream(con: sqlite3.Connection, db_name: str, table: str, cols: dict[str, str], start_ts: int | None, end_ts: int | None, type_name: str | None, bound: tuple[int, int, str] | None, descending: bool, inclusive: bool):
+    clauses, params = filter_clauses(cols, start_ts, end_ts, None, type_name)
+    if bound is not None:
+        clause, bound_params = keyset_clause(cols, db_name, bound, descending, inclusive)
+        clauses.append(clause)
+        params.extend(bound_params)
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+    direction = "DESC" if descending else "ASC"
+    sql = (
+        f"SELECT {message_select_list(cols)} FROM [{table}] {where} "
+        f"ORDER BY {cols['create_time']} {direction}, {cols['local_id']} {direction}"
+    )
+    for row in con.execute(sql, params):
+        yield (int(row["create_time"] or 0), int(row["local_id"] or 0), db_name), row
 
 
-def collect_history(decrypted_dir: Path, chat: dict, start_ts: int | None, end_ts: int | None, limit: int, offset: int, type_name: str | None, resolve_media: bool = False) -> list[dict]:
+def iter_history(decrypted_dir: Path, chat: dict, start_ts: int | None, end_ts: int | None, type_name: str | None, resolve_media: bool = False, *, descending: bool = True, bound: tuple[int, int, str] | None = None, inclusive: bool = False):
+    """Yield messages in (create_time, local_id, db) order, k-way merged across message DBs."""
     contacts, _ = load_contacts(decrypted_dir)
-    db_dir = resolve_db_dir()
-    rows = []
-    candidate_limit = limit + offset
-    for db_path, table in find_chat_tables(decrypted_dir, chat):
-        with connect(db_path) as con:
-            cols = message_columns(con, table)
-            sql, params = build_select_sql(table, cols, start_ts, end_ts, None, type_name, candidate_limit, 0)
-            name2id = load_name2id(con)
-            for row in con.execute(sql, params):
-                msg = row_to_message(row, db_path.name, table, chat, contacts, name2id, resolve_media, db_dir)
-                if matches_type(msg["local_type"], type_name):
-                    rows.append(msg)
-    rows.sort(key=lambda item: (item["timestamp"], str(item["local_id"])), reverse=True)
-    page = rows[offset : offset + limit]
-    page.sort(key=lambda item: (item["timestamp"], str(item["local_id"])))
+    db_dir = resolve_db_dir() if resolve_media else None
+    media = load_media_index(decrypted_dir, db_dir.parent) if db_dir else None
+    streams = []
+    shards = {}
+    for db_path, table in find_chat_tables(decrypted_dir, chat, start_ts, end_ts):
+        con = connect(db_path)
+        cols = message_columns(con, table)
+        if not cols.get("create_time"):
+            continue
+        shards[db_path.name] = (table, name2id_for(db_path, con))
+        streams.append(shard_stream(con, db_path.name, table, cols, start_ts, end_ts, type_name, bound, descending, inclusive))
+    for key, row in heapq.merge(*streams, key=lambda item: item[0], reverse=descending):
+        table, name2id = shards[key[2]]
+        msg = row_to_message(row, key[2], table, chat, contacts, name2id, media)
+        msg["cursor"] = format_cursor(key)
+        yield msg
+
+
+def collect_history(decrypted_dir: Path, chat: dict, start_ts: int | None, end_ts: int | None, limit: int, offset: int, type_name: str | None, resolve_media: bool = False, cursor: str | None = None) -> list[dict]:
+    """Newest page of messages older than `cursor`, returned oldest first."""
+    bound = parse_cursor(cursor) if cursor else None
+    rows = iter_history(decrypted_dir, chat, start_ts, end_ts, type_name, resolve_media, bound=bound)
+    page = prime_messages(list(islice(rows, offset, offset + limit)))
+    page.reverse()
     return page
 
 
+def count_history(decrypted_dir: Path, chat: dict, start_ts: int | None, end_ts: int | None, type_name: str | None) -> int:
+    total = 0
+    for db_path, table in find_chat_tables(decrypted_dir, chat, start_ts, end_ts):
+        with connect(db_path) as con:
+            clauses, params = filter_clauses(message_columns(con, table), start_ts, end_ts, None, type_name)
+            where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+            total += con.execute(f"SELECT count(*) FROM [{table}] {where}", params).fetchone()[0]
+    return total
+
+
 def command_status(args: argparse.Namespace) -> None:
     decrypted_dir = resolve_decrypted_dir(args.decrypted_dir)
     names = [
@@ -649,6 +926,122 @@ def command_new_messages(args: argparse.Namespace) -> None:
     output(data if args.format == "json" else text, args.format)
 
 
+def max_local_id(con: sqlite3.Connection, table: str, cols: dict[str, str]) -> int:
+    return int(con.execute(f"SELECT max({cols['local_id']}) FROM [{table}]").fetchone()[0] or 0)
+
+
+class MessageWatcher:
+    """Turn updates of decrypted message shards into the messages that arrived since start.
+
+    Every Msg_ table keeps its highest local_id (the rowid, so the check is a
+    single b-tree lookup); a changed shard only reads rows above that mark, which
+    also catches late-synced messages whose create_time is older than the newest.
+    """
+
+    def __init__(self, decrypted_dir: Path, chats: list[dict]) -> None:
+        self.decrypted_dir = decrypted_dir
+        self.only = {message_table(chat["username"]) for chat in chats}
+        self.marks: dict[tuple[str, str], int] = {}
+        for db_path in message_dbs(decrypted_dir):
+            con = connect(db_path)
+            for table in message_tables(db_path, con):
+                cols = message_columns(con, table)
+                if cols.get("create_time"):
+                    self.marks[(db_path.name, table)] = max_local_id(con, table, cols)
+
+    def poll(self, changed: set[str]) -> list[dict]:
+        """New messages after the decrypted files in `changed` (relative paths) were updated."""
+        shards = [db_path for db_path in message_dbs(self.decrypted_dir) if f"message/{db_path.name}" in changed]
+        if not shards:
+            return []
+        contacts, _ = load_contacts(self.decrypted_dir)
+        owners: dict[str, str] = {}
+        messages = []
+        for db_path in shards:
+            con = connect(db_path)
+            for table in sorted(message_tables(db_path, con)):
+                if self.only and table not in self.only:
+                    continue
+                cols = message_columns(con, table)
+                if not cols.get("create_time"):
+                    continue
+                mark = self.marks.get((db_path.name, table), 0)
+                if max_local_id(con, table, cols) <= mark:
+                    continue
+                if not owners:
+                    owners = vault_owner_map(self.decrypted_dir)
+                messages.extend(self.drain(db_path, con, table, cols, mark, contacts, owners))
+        messages.sort(key=lambda msg: (msg["timestamp"], msg["local_id"] or 0, msg["db"]))
+        return messages
+
+    def drain(self, db_path: Path, con: sqlite3.Connection, table: str, cols: dict[str, str], mark: int, contacts: dict[str, dict], owners: dict[str, str]) -> list[dict]:
+        username = owners.get(table_hash(table), "")
+        chat = contacts.get(username) or {"username": username, "display_name": username or table, "is_group": "@chatroom" in username}
+        name2id = name2id_for(db_path, con)
+        messages = []
+        sql = f"SELECT {message_select_list(cols)} FROM [{table}] WHERE {cols['local_id']} > ? ORDER BY {cols['local_id']}"
+        for row in con.execute(sql, (mark,)):
+            msg = row_to_message(row, db_path.name, table, chat, contacts, name2id)
+            msg["chat"] = chat["display_name"]
+            msg["chat_username"] = username
+            messages.append(msg)
+            self.marks[(db_path.name, table)] = int(row["local_id"] or 0)
+        return prime_messages(messages)
+
+
+def watch_paths(decrypted_dir: Path, sources: dict[str, tuple[Path, str]]) -> dict[str, Path]:
+    if sources:
+        return {rel: src for rel, (src, _) in sources.items()}
+    return {f"message/{db_path.name}": db_path for db_path in message_dbs(decrypted_dir)}
+
+
+def command_watch(args: argparse.Namespace) -> None:
+    decrypted_dir = resolve_decrypted_dir(args.decrypted_dir)
+    CACHE.enabled = True
+    contacts, _ = load_contacts(decrypted_dir)
+    chats = []
+    for chat_query in args.chat or []:
+        chat = resolve_chat(chat_query, contacts)
+        if not chat:
+            raise SystemExit(f"找不到聊天对象: {chat_query}")
+        chats.append(chat)
+    sources: dict[str, tuple[Path, str]] = {}
+    if not args.no_refresh:
+        import decrypt_all_dbs
+
+        sources = {
+            rel: item for rel, item in decrypt_all_dbs.load_sources().items()
+            if rel == SESSION_DB or MESSAGE_DB_RE.fullmatch(rel)
+        }
+        if not sources:
+            raise SystemExit("密钥文件里没有 session.db 或 message_N.db，无法监听源库；可加 --no-refresh 只监听明文 vault")
+    watcher = MessageWatcher(decrypted_dir, chats)
+    signatures = {rel: file_signature(path) for rel, path in watch_paths(decrypted_dir, sources).items()}
+    deadline = time.monotonic() + args.duration if args.duration else None
+    interval = args.interval
+    emitted = 0
+    while deadline is None or time.monotonic() < deadline:
+        time.sleep(interval)
+        current = {rel: file_signature(path) for rel, path in watch_paths(decrypted_dir, sources).items()}
+        changed = {rel for rel, signature in current.items() if signature != signatures.get(rel)}
+        if not changed:
+            interval = min(interval * 2, args.max_interval)
+            continue
+        interval = args.interval
+        if sources:
+            try:
+                decrypt_all_dbs.refresh_sources({rel: sources[rel] for rel in changed}, decrypted_dir, jobs=1)
+            except Exception as exc:
+                print(f"[WARN] 增量解密失败，稍后重试: {exc}", file=sys.stderr)
+                continue
+        signatures = current
+        for msg in watcher.poll(changed):
+            print(json.dumps(msg, ensure_ascii=False, default=json_default), flush=True)
+            emitted += 1
+            if args.max_events and emitted >= args.max_events:
+                return
+
+
 def command_contacts(args: argparse.Namespace) -> None:
     contacts, _ = load_contacts(resolve_decrypted_dir(args.decrypted_dir))
     if args.detail:
@@ -658,14 +1051,10 @@ def command_contacts(args: argparse.Namespace) -> None:
         data = {k: v for k, v in item.items() if k != "raw"}
         output(data if args.format == "json" else render_contact_detail(data), args.format)
         return
-    items = list(contacts.values())
     if args.query:
-        q = args.query.lower()
-        items = [
-            item for item in items
-            if any(q in str(item.get(field) or "").lower() for field in ("username", "display_name", "remark", "nick_name", "alias"))
-        ]
-    items.sort(key=lambda item: (not item["is_group"], item["display_name"]))
+        items = [contacts[username] for username in contacts.index.search(args.query)]
+    else:
+        items = sorted(contacts.values(), key=lambda item: (not item["is_group"], item["display_name"]))
     items = [{k: v for k, v in item.items() if k != "raw"} for item in items[: args.limit]]
     output({"count": len(items), "contacts": items} if args.format == "json" else render_contacts_text(items), args.format)
 
@@ -757,18 +1146,409 @@ def command_history(args: argparse.Namespace) -> None:
         args.offset,
         args.type,
         args.media,
+        args.cursor,
     )
-    data = {"chat": chat["display_name"], "username": chat["username"], "count": len(rows), "messages": rows}
+    next_cursor = rows[0]["cursor"] if len(rows) == args.limit else None
+    data = {"chat": chat["display_name"], "username": chat["username"], "count": len(rows), "next_cursor": next_cursor, "messages": rows}
     output(data if args.format == "json" else render_messages_text(rows), args.format)
 
 
+def message_text_line(row: dict) -> str:
+    sender = f"{row['sender']}: " if row.get("sender") else ""
+    return f"[{row['time']}] {sender}{row['content']}"
+
+
 def render_messages_text(rows: list[dict]) -> str:
     if not rows:
         return "没有找到消息"
+    return "\n".join(message_text_line(row) for row in rows)
+
+
+def segment_text(text: str) -> str:
+    return CJK_RE.sub(r" \g<0> ", text)
+
+
+def trigram_query(keyword: str) -> str | None:
+    """A trigram MATCH phrase for a substring; None when it is too short to use the index."""
+    if len(keyword) < 3:
+        return None
+    return '"' + keyword.replace('"', '""') + '"'
+
+
+def fts_query(keyword: str) -> str:
+    """Each whitespace-separated term becomes a phrase; the last token is a prefix."""
+    phrases = []
+    for term in keyword.split():
+        tokens = re.findall(r"\w+", segment_text(term))
+        if tokens:
+            phrases.append('"' + " ".join(tokens) + '"*')
+    return " AND ".join(phrases)
+
+
+SIDECAR_SCHEMA = """
+CREATE TABLE IF NOT EXISTS index_meta(key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS index_sources(db TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER);
+CREATE TABLE IF NOT EXISTS index_tables(
+    db TEXT, tbl TEXT, last_local_id INTEGER, checksum INTEGER,
+    PRIMARY KEY(db, tbl)
+);
+"""
+
+MESSAGE_INDEX_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS message_fts USING fts5(
+    content, chat UNINDEXED, db UNINDEXED, tbl UNINDEXED,
+    local_id UNINDEXED, server_id UNINDEXED, create_time UNINDEXED,
+    local_type UNINDEXED, sender_username UNINDEXED, sender_id UNINDEXED,
+    tokenize='trigram'
+);
+"""
+
+STATS_ROLLUP_SCHEMA = """
+CREATE TABLE IF NOT EXISTS hourly_counts(
+    tbl TEXT, hour INTEGER, db TEXT, sender TEXT, sender_id INTEGER, local_type INTEGER, count INTEGER,
+    PRIMARY KEY(tbl, hour, db, sender, sender_id, local_type)
+) WITHOUT ROWID;
+"""
+
+
+def open_sidecar(decrypted_dir: Path, rel: str, data_table: str, schema: str, version: str) -> sqlite3.Connection:
+    """Open a derived store next to the decrypted DBs; a version change starts a fresh file."""
+    path = decrypted_dir / rel
+    path.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        os.chmod(path.parent, 0o700)
+    except OSError:
+        pass
+    con = open_db(path)
+    try:
+        os.chmod(path, 0o600)
+    except OSError:
+        pass
+    con.executescript(SIDECAR_SCHEMA)
+    row = con.execute("SELECT value FROM index_meta WHERE key='version'").fetchone()
+    if row is not None and row["value"] != version:
+        # Tokenizers and columns only change through CREATE, so drop the old file.
+        con.close()
+        for suffix in ("", "-wal", "-shm", "-journal"):
+            Path(f"{path}{suffix}").unlink(missing_ok=True)
+        con = open_db(path)
+        try:
+            os.chmod(path, 0o600)
+        except OSError:
+            pass
+        row = None
+    con.executescript(SIDECAR_SCHEMA + schema)
+    if row is None:
+        clear_sidecar(con, data_table, version)
+    return con
+
+
+def clear_sidecar(con: sqlite3.Connection, data_table: str, version: str) -> None:
+    with con:
+        con.execute(f"DELETE FROM {data_table}")
+        con.execute("DELETE FROM index_tables")
+        con.execute("DELETE FROM index_sources")
+        con.execute("INSERT OR REPLACE INTO index_meta(key, value) VALUES ('version', ?)", (version,))
+
+
+def table_checksum(con: sqlite3.Connection, table: str, cols: dict[str, str], after: int | None, upto: int | None) -> int:
+    """Order-independent sum over rows with after < local_id <= upto; revokes and deletes change it."""
+    id_col = cols["local_id"]
+    clauses, params = [], []
+    if after is not None:
+        clauses.append(f"{id_col} > ?")
+        params.append(after)
+    if upto is not None:
+        clauses.append(f"{id_col} <= ?")
+        params.append(upto)
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+    mix = (
+        f"(({id_col} % 32749) + 1) * ((COALESCE({cols.get('local_type') or '0'}, 0) % 8191) * 8209"
+        f" + (COALESCE({cols.get('real_sender_id') or '0'}, 0) % 4093) * 31"
+        f" + (COALESCE(length({cols.get('message_content') or 'NULL'}), 0) % 4093) * 7"
+        f" + COALESCE({cols['create_time']}, 0) % 1009 + 1)"
+    )
+    return con.execute(f"SELECT COALESCE(sum({mix}), 0) FROM [{table}] {where}", params).fetchone()[0]
+
+
+_TABLE_CHECKS: dict[str, tuple[tuple | None, dict]] = {}
+
+
+def shared_table_checksum(db_path: Path, con: sqlite3.Connection, table: str, cols: dict[str, str], after: int | None, upto: int | None) -> int:
+    """table_checksum memoized for the shard's current file state.
+
+    The FTS index and the stats rollup are refreshed together and keep the same
+    marks, so a changed shard has its rows summed once rather than once per sidecar.
+    """
+    signature = file_signature(db_path)
+    memo = _TABLE_CHECKS.get(str(db_path))
+    if memo is None or memo[0] != signature:
+        memo = _TABLE_CHECKS[str(db_path)] = (signature, {})
+    key = (table, after, upto)
+    if key not in memo[1]:
+        memo[1][key] = table_checksum(con, table, cols, after, upto)
+    return memo[1][key]
+
+
+def refresh_sidecar(store: sqlite3.Connection, decrypted_dir: Path, data_table: str, add_rows) -> dict:
+    """Feed rows past each Msg_ table's local_id high-water mark to `add_rows`.
+
+    local_id is the rowid, so late-synced messages with an older create_time
+    still land past the mark. Message DBs whose size and mtime are unchanged
+    since the last run are skipped; a table whose already-fed rows changed
+    (revokes, deletes) is dropped from the store and fed again from the start;
+    rows of DBs that disappeared are dropped.
+    """
+    stats = {"databases_scanned": 0, "tables_scanned": 0, "tables_rebuilt": 0, "messages_added": 0}
+    present = {db_path.name: db_path for db_path in message_dbs(decrypted_dir)}
+    for row in store.execute("SELECT db FROM index_sources").fetchall():
+        if row["db"] not in present:
+            with store:
+                store.execute(f"DELETE FROM {data_table} WHERE db=?", (row["db"],))
+                store.execute("DELETE FROM index_tables WHERE db=?", (row["db"],))
+                store.execute("DELETE FROM index_sources WHERE db=?", (row["db"],))
+    for db_name, db_path in present.items():
+        stat = db_path.stat()
+        seen = store.execute("SELECT size, mtime_ns FROM index_sources WHERE db=?", (db_name,)).fetchone()
+        if seen and (seen["size"], seen["mtime_ns"]) == (stat.st_size, stat.st_mtime_ns):
+            continue
+        stats["databases_scanned"] += 1
+        with connect(db_path) as con, store:
+            name2id = name2id_for(db_path, con)
+            for table in sorted(message_tables(db_path, con)):
+                cols = message_columns(con, table)
+                if not cols.get("create_time"):
+                    continue
+                state = store.execute("SELECT last_local_id, checksum FROM index_tables WHERE db=? AND tbl=?", (db_name, table)).fetchone()
+                after, checksum = None, 0
+                try:
+                    if state:
+                        if shared_table_checksum(db_path, con, table, cols, None, state["last_local_id"]) == state["checksum"]:
+                            after, checksum = state["last_local_id"], state["checksum"]
+                        else:
+                            store.execute(f"DELETE FROM {data_table} WHERE db=? AND tbl=?", (db_name, table))
+                            store.execute("DELETE FROM index_tables WHERE db=? AND tbl=?", (db_name, table))
+                            stats["tables_rebuilt"] += 1
+                    added, last = add_rows(store, con, db_name, table, cols, name2id, after)
+                    if last is not None:
+                        checksum += shared_table_checksum(db_path, con, table, cols, after, last)
+                except sqlite3.Error:
+                    continue
+                stats["tables_scanned"] += 1
+                stats["messages_added"] += added
+                if last is not None:
+                    store.execute(
+                        "INSERT OR REPLACE INTO index_tables(db, tbl, last_local_id, checksum) VALUES (?, ?, ?, ?)",
+                        (db_name, table, last, checksum),
+                    )
+            store.execute(
+                "INSERT OR REPLACE INTO index_sources(db, size, mtime_ns) VALUES (?, ?, ?)",
+                (db_name, stat.st_size, stat.st_mtime_ns),
+            )
+    return stats
+
+
+def past_mark(cols: dict[str, str], after: int | None) -> tuple[str, list]:
+    if after is None:
+        return "", []
+    return f"WHERE {cols['local_id']} > ?", [after]
+
+
+def local_hour_start(ts: int) -> int:
+    """Start of the local-time hour containing ts; also right for half-hour UTC offsets."""
+    return ts - (ts + time.localtime(ts).tm_gmtoff) % HOUR_SECONDS
+
+
+def update_message_index(decrypted_dir: Path, rebuild: bool = False) -> dict:
+    """Add decoded messages past each table's local_id high-water mark to the FTS index."""
+    index = open_sidecar(decrypted_dir, MESSAGE_INDEX, "message_fts", MESSAGE_INDEX_SCHEMA, MESSAGE_INDEX_VERSION)
+    if rebuild:
+        clear_sidecar(index, "message_fts", MESSAGE_INDEX_VERSION)
+    owners: dict[str, str] = {}
+
+    def add_rows(store, con, db_name, table, cols, name2id, after):
+        if not owners:
+            owners.update(vault_owner_map(decrypted_dir))
+        username = owners.get(table_hash(table), "")
+        chat = {"username": username, "display_name": username, "is_group": "@chatroom" in username}
+        where, params = past_mark(cols, after)
+        sql = f"SELECT {message_select_list(cols)} FROM [{table}] {where} ORDER BY {cols['local_id']}"
+        batch = []
+        last = None
+        for msg in primed(row_to_message(row, db_name, table, chat, {}, name2id) for row in con.execute(sql, params)):
+            batch.append((
+                msg["content"],
+                username,
+                db_name,
+                table,
+                msg["local_id"],
+                msg["server_id"],
+                msg["timestamp"],
+                msg["local_type"],
+                msg["sender_username"],
+                msg.sender_id,
+            ))
+            last = msg["local_id"]
+        if batch:
+            store.executemany("INSERT INTO message_fts VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", batch)
+        return len(batch), last
+
+    try:
+        stats = refresh_sidecar(index, decrypted_dir, "message_fts", add_rows)
+        stats["indexed_messages"] = index.execute("SELECT count(*) FROM message_fts").fetchone()[0]
+    finally:
+        index.close()
+    return stats
+
+
+def update_stats_rollup(decrypted_dir: Path, rebuild: bool = False) -> dict:
+    """Fold messages past each table's local_id high-water mark into local-hour per-sender/per-type counts."""
+    # Hour buckets follow the local zone, so a zone change rebuilds the rollup.
+    version = f"{STATS_ROLLUP_VERSION}:{time.timezone}:{time.altzone}:{'/'.join(time.tzname)}"
+    store = open_sidecar(decrypted_dir, STATS_ROLLUP, "hourly_counts", STATS_ROLLUP_SCHEMA, version)
+    if rebuild:
+        clear_sidecar(store, "hourly_counts", version)
+
+    def add_rows(store, con, db_name, table, cols, name2id, after):
+        where, params = past_mark(cols, after)
+        time_col, id_col = cols["create_time"], cols["local_id"]
+        last = con.execute(f"SELECT max({id_col}) FROM [{table}] {where}", params).fetchone()[0]
+        if last is None:
+            return 0, None
+        # Bound the aggregate by the same mark so rows landing meanwhile wait for the next run.
+        where = f"{where} AND {id_col} <= ?" if where else f"WHERE {id_col} <= ?"
+        sender_col = cols.get("real_sender_id") or "0"
+        type_col = cols.get("local_type") or "0"
+        # Buckets start on local-time hours, matching the strftime(..., 'localtime') readers.
+        local_col = f"CAST(strftime('%s', {time_col}, 'unixepoch', 'localtime') AS INTEGER)"
+        hour_expr = f"{time_col} - ({local_col} % {HOUR_SECONDS} + {HOUR_SECONDS}) % {HOUR_SECONDS}"
+        added = 0
+        batch = []
+        for row in con.execute(
+            f"SELECT {hour_expr} AS hour, {sender_col} AS sender_id, "
+            f"{type_col} AS local_type, COUNT(*) AS count FROM [{table}] {where} GROUP BY hour, sender_id, local_type",
+            params + [last],
+        ):
+            sender_id = int(row["sender_id"] or 0)
+            batch.append((table, row["hour"], db_name, name2id.get(sender_id, ""), sender_id, row["local_type"], row["count"]))
+            added += row["count"]
+        store.executemany(
+            "INSERT INTO hourly_counts(tbl, hour, db, sender, sender_id, local_type, count) VALUES (?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT(tbl, hour, db, sender, sender_id, local_type) DO UPDATE SET count = count + excluded.count",
+            batch,
+        )
+        return added, last
+
+    try:
+        stats = refresh_sidecar(store, decrypted_dir, "hourly_counts", add_rows)
+        stats["rolled_up_messages"] = store.execute("SELECT COALESCE(sum(count), 0) FROM hourly_counts").fetchone()[0]
+    finally:
+        store.close()
+    return stats
+
+
+def refresh_message_sidecars(decrypted_dir: Path) -> None:
+    """Bring the FTS index and the stats rollup up to date in one go.
+
+    Refreshing both whenever either is needed keeps their local_id marks equal,
+    so shared_table_checksum sums a changed shard's rows once for the pair.
+    """
+    update_message_index(decrypted_dir)
+    update_stats_rollup(decrypted_dir)
+
+
+def search_message_index(decrypted_dir: Path, contacts: dict[str, dict], args: argparse.Namespace, chats: list[dict], start_ts: int | None, end_ts: int | None) -> list[dict] | None:
+    """Substring search over the trigram index, with the same semantics as the --scan path.
+
+    Keywords of three or more characters go through MATCH; shorter ones fall
+    back to LIKE over the index, which still skips decoding every message.
+    """
+    if not args.keyword:
+        return None
+    try:
+        refresh_message_sidecars(decrypted_dir)
+    except sqlite3.OperationalError:
+        return None
+    query = trigram_query(args.keyword)
+    if query:
+        clauses = ["message_fts MATCH ?"]
+        params: list = [query]
+        score = "bm25(message_fts)"
+    else:
+        clauses = ["content LIKE ? ESCAPE '\\'"]
+        params = ["%" + re.sub(r"([\\%_])", r"\\\1", args.keyword) + "%"]
+        score = "NULL"
+    if chats:
+        clauses.append(f"chat IN ({','.join('?' for _ in chats)})")
+        params.extend(chat["username"] for chat in chats)
+    if start_ts is not None:
+        clauses.append("create_time >= ?")
+        params.append(start_ts)
+    if end_ts is not None:
+        clauses.append("create_time <= ?")
+        params.append(end_ts)
+    if args.type:
+        type_sql, type_params = type_clauses("local_type", args.type)
+        clauses.extend(type_sql)
+        params.extend(type_params)
+    order = "rank" if args.sort == "rank" and score != "NULL" else "create_time DESC"
+    sql = (
+        "SELECT content, chat, db, tbl, local_id, server_id, create_time, local_type, sender_username, sender_id, "
+        f"{score} AS score FROM message_fts WHERE {' AND '.join(clauses)} ORDER BY {order} LIMIT ? OFFSET ?"
+    )
+    params.extend([args.limit, args.offset])
+    results = []
+    with connect(decrypted_dir / MESSAGE_INDEX) as index:
+        for row in index.execute(sql, params):
+            username = str(row["chat"] or "")
+            chat = {
+                "username": username,
+                "display_name": display_name(username, contacts) if username else row["tbl"],
+                "is_group": "@chatroom" in username,
+            }
+            ts = int(row["create_time"] or 0)
+            results.append({
+                "db": row["db"],
+                "table": row["tbl"],
+                "local_id": row["local_id"],
+                "server_id": row["server_id"],
+                "type": type_label(row["local_type"]),
+                "local_type": row["local_type"],
+                "sender": sender_label(chat, row["sender_username"] or "", row["sender_id"], contacts),
+                "sender_username": row["sender_username"] or "",
+                "timestamp": ts,
+                "time": datetime.fromtimestamp(ts).strftime("%Y-%m-%d %H:%M:%S") if ts else "",
+                "content": row["content"],
+                "chat": chat["display_name"],
+                "chat_username": username,
+                "score": None if row["score"] is None else round(-row["score"], 4),
+            })
+    if args.sort == "time":
+        results.sort(key=lambda item: item["timestamp"])
+    return results
+
+
+def command_index(args: argparse.Namespace) -> None:
+    decrypted_dir = resolve_decrypted_dir(args.decrypted_dir)
+    data = {
+        "message_index": {"path": str(decrypted_dir / MESSAGE_INDEX), **update_message_index(decrypted_dir, args.rebuild)},
+        "stats_rollup": {"path": str(decrypted_dir / STATS_ROLLUP), **update_stats_rollup(decrypted_dir, args.rebuild)},
+    }
+    if (decrypted_dir / "sns/sns.db").exists():
+        data["sns_posts"] = {"path": str(decrypted_dir / SNS_INDEX), **update_sns_index(decrypted_dir, args.rebuild)}
+    if (decrypted_dir / "favorite/favorite.db").exists():
+        data["favorites"] = {"path": str(decrypted_dir / FAVORITE_INDEX), **update_favorite_index(decrypted_dir, args.rebuild)}
+    db_dir = resolve_db_dir()
+    if db_dir and db_dir.parent.exists():
+        data["media_index"] = {"path": str(decrypted_dir / MEDIA_INDEX), **update_media_index(decrypted_dir, db_dir.parent, args.rebuild)}
+    output(data if args.format == "json" else render_index_text(data), args.format)
+
+
+def render_index_text(data: dict) -> str:
     lines = []
-    for row in rows:
-        sender = f"{row['sender']}: " if row.get("sender") else ""
-        lines.append(f"[{row['time']}] {sender}{row['content']}")
+    for name, item in data.items():
+        lines.append(f"{name}: {item['path']}")
+        lines.extend(f"  {key}: {value}" for key, value in item.items() if key != "path")
     return "\n".join(lines)
 
 
@@ -780,11 +1560,18 @@ def command_search(args: argparse.Namespace) -> None:
     candidate_limit = args.limit + args.offset
     results = []
     chats = []
+    for chat_query in args.chat or []:
+        chat = resolve_chat(chat_query, contacts)
+        if chat:
+            chats.append(chat)
+    if args.chat and not chats:
+        raise SystemExit(f"找不到聊天对象: {', '.join(args.chat)}")
+    page = None if args.scan else search_message_index(decrypted_dir, contacts, args, chats, start_ts, end_ts)
+    if page is not None:
+        data = {"keyword": args.keyword, "count": len(page), "source": "index", "messages": page}
+        output(data if args.format == "json" else render_search_text(page), args.format)
+        return
     if args.chat:
-        for chat_query in args.chat:
-            chat = resolve_chat(chat_query, contacts)
-            if chat:
-                chats.append(chat)
         for chat in chats:
             for row in collect_history(decrypted_dir, chat, start_ts, end_ts, candidate_limit, 0, args.type, False):
                 if args.keyword.lower() in row["content"].lower():
@@ -792,12 +1579,12 @@ def command_search(args: argparse.Namespace) -> None:
                     row["chat_username"] = chat["username"]
                     results.append(row)
     else:
+        owners = vault_owner_map(decrypted_dir)
         for db_path in message_dbs(decrypted_dir):
             with connect(db_path) as con:
-                tables = [row["name"] for row in con.execute("SELECT name FROM sqlite_master WHERE type='table' AND name LIKE 'Msg_%'")]
-                name2id = load_name2id(con)
-                for table in tables:
-                    username = username_for_table(table, con) or username_for_table_from_contacts(table, contacts)
+                name2id = name2id_for(db_path, con)
+                for table in sorted(message_tables(db_path, con)):
+                    username = owners.get(table_hash(table), "")
                     chat = {
                         "username": username,
                         "display_name": display_name(username, contacts) if username else table,
@@ -806,8 +1593,7 @@ def command_search(args: argparse.Namespace) -> None:
                     cols = message_columns(con, table)
                     sql, params = build_select_sql(table, cols, start_ts, end_ts, args.keyword, args.type, candidate_limit, 0)
                     try:
-                        for row in con.execute(sql, params):
-                            msg = row_to_message(row, db_path.name, table, chat, contacts, name2id)
+                        for msg in primed(row_to_message(row, db_path.name, table, chat, contacts, name2id) for row in con.execute(sql, params)):
                             if args.keyword.lower() in msg["content"].lower() and matches_type(msg["local_type"], args.type):
                                 msg["chat"] = chat["display_name"]
                                 msg["chat_username"] = chat["username"]
@@ -817,7 +1603,7 @@ def command_search(args: argparse.Namespace) -> None:
     results.sort(key=lambda item: item["timestamp"], reverse=True)
     page = results[args.offset : args.offset + args.limit]
     page.sort(key=lambda item: item["timestamp"])
-    data = {"keyword": args.keyword, "count": len(page), "messages": page}
+    data = {"keyword": args.keyword, "count": len(page), "source": "scan", "messages": page}
     output(data if args.format == "json" else render_search_text(page), args.format)
 
 
@@ -827,37 +1613,81 @@ def render_search_text(rows: list[dict]) -> str:
     return "\n".join(f"[{row['time']}] [{row.get('chat', '')}] {row.get('sender', '')}: {row['content']}".strip() for row in rows)
 
 
+def rollup_tallies(decrypted_dir: Path, chat: dict, start_ts: int | None, end_ts: int | None, exclude_types: tuple[int, ...] = ()) -> list[tuple[str, int, int, int, int]]:
+    """(sender username, sender id, local_type, local hour of day, count) for a chat and time range.
+
+    Whole local hours come from the rollup; partial hours at the range edges are
+    counted from the message tables.
+    """
+    tables = find_chat_tables(decrypted_dir, chat, start_ts, end_ts)
+    if not tables:
+        return []
+    refresh_message_sidecars(decrypted_dir)
+    lo = None if start_ts is None else local_hour_start(start_ts)
+    if lo is not None and lo < start_ts:
+        lo = local_hour_start(lo + 2 * HOUR_SECONDS - 1)
+    hi = None if end_ts is None else local_hour_start(end_ts + 1)
+    tallies = []
+    if lo is not None and hi is not None and lo >= hi:
+        raw_ranges = [(start_ts, end_ts)]
+    else:
+        raw_ranges = []
+        if lo is not None and start_ts < lo:
+            raw_ranges.append((start_ts, lo - 1))
+        if hi is not None and hi <= end_ts:
+            raw_ranges.append((hi, end_ts))
+        clauses = [f"tbl IN ({','.join('?' for _ in tables)})"]
+        params: list = [table for _, table in tables]
+        if lo is not None:
+            clauses.append("hour >= ?")
+            params.append(lo)
+        if hi is not None:
+            clauses.append("hour < ?")
+            params.append(hi)
+        if exclude_types:
+            clauses.append(f"(local_type & 4294967295) NOT IN ({','.join('?' for _ in exclude_types)})")
+            params.extend(exclude_types)
+        with connect(decrypted_dir / STATS_ROLLUP) as store:
+            for row in store.execute(
+                "SELECT sender, sender_id, local_type, CAST(strftime('%H', hour, 'unixepoch', 'localtime') AS INTEGER) AS hour, "
+                f"SUM(count) AS count FROM hourly_counts WHERE {' AND '.join(clauses)} GROUP BY sender, sender_id, local_type, 4",
+                params,
+            ):
+                tallies.append((row["sender"], row["sender_id"], row["local_type"], row["hour"], row["count"]))
+    for range_start, range_end in raw_ranges:
+        for db_path, table in tables:
+            with connect(db_path) as con:
+                name2id = name2id_for(db_path, con)
+                cols = message_columns(con, table)
+                clauses, params = filter_clauses(cols, range_start, range_end, None, None)
+                if exclude_types:
+                    clauses.append(f"({cols['local_type']} & 4294967295) NOT IN ({','.join('?' for _ in exclude_types)})")
+                    params.extend(exclude_types)
+                for row in con.execute(
+                    f"SELECT {cols.get('real_sender_id') or '0'} AS sender_id, {cols.get('local_type') or '0'} AS local_type, "
+                    f"CAST(strftime('%H', {cols['create_time']}, 'unixepoch', 'localtime') AS INTEGER) AS hour, COUNT(*) AS count "
+                    f"FROM [{table}] WHERE {' AND '.join(clauses)} GROUP BY sender_id, local_type, hour",
+                    params,
+                ):
+                    sender_id = int(row["sender_id"] or 0)
+                    tallies.append((name2id.get(sender_id, ""), sender_id, row["local_type"], row["hour"], row["count"]))
+    return tallies
+
+
 def collect_stats(decrypted_dir: Path, chat: dict, start_ts: int | None, end_ts: int | None) -> dict:
     contacts, _ = load_contacts(decrypted_dir)
     total = 0
     type_counts: dict[str, int] = {}
     sender_counts: dict[str, int] = {}
     hourly = {hour: 0 for hour in range(24)}
-    for db_path, table in find_chat_tables(decrypted_dir, chat):
-        with connect(db_path) as con:
-            name2id = load_name2id(con)
-            cols = message_columns(con, table)
-            clauses = []
-            params = []
-            if start_ts is not None:
-                clauses.append(f"{cols['create_time']} >= ?")
-                params.append(start_ts)
-            if end_ts is not None:
-                clauses.append(f"{cols['create_time']} <= ?")
-                params.append(end_ts)
-            where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
-            for row in con.execute(f"SELECT {cols['local_type']} AS local_type, COUNT(*) AS count FROM [{table}] {where} GROUP BY {cols['local_type']}", params):
-                label = type_label(row["local_type"])
-                count = int(row["count"] or 0)
-                type_counts[label] = type_counts.get(label, 0) + count
-                total += count
-            for row in con.execute(f"SELECT {cols['real_sender_id']} AS sender_id, COUNT(*) AS count FROM [{table}] {where} GROUP BY {cols['real_sender_id']}", params):
-                sender_username = name2id.get(int(row["sender_id"] or 0), "")
-                sender = display_name(sender_username, contacts) if sender_username else str(row["sender_id"])
-                sender_counts[sender] = sender_counts.get(sender, 0) + int(row["count"] or 0)
-            for row in con.execute(f"SELECT cast(strftime('%H', {cols['create_time']}, 'unixepoch', 'localtime') as integer) AS hour, COUNT(*) AS count FROM [{table}] {where} GROUP BY hour", params):
-                if row["hour"] is not None:
-                    hourly[int(row["hour"])] += int(row["count"] or 0)
+    for sender_username, sender_id, local_type, hour, count in rollup_tallies(decrypted_dir, chat, start_ts, end_ts):
+        total += count
+        label = type_label(local_type)
+        type_counts[label] = type_counts.get(label, 0) + count
+        sender = display_name(sender_username, contacts) if sender_username else str(sender_id)
+        sender_counts[sender] = sender_counts.get(sender, 0) + count
+        if hour is not None:
+            hourly[int(hour)] += count
     return {
         "total": total,
         "type_breakdown": dict(sorted(type_counts.items(), key=lambda item: item[1], reverse=True)),
@@ -866,6 +1696,15 @@ def collect_stats(decrypted_dir: Path, chat: dict, start_ts: int | None, end_ts:
     }
 
 
+def sender_counts_for_digest(decrypted_dir: Path, chat: dict, start_ts: int | None, end_ts: int | None) -> dict[str, int]:
+    contacts, _ = load_contacts(decrypted_dir)
+    counts: dict[str, int] = {}
+    for sender_username, _, _, _, count in rollup_tallies(decrypted_dir, chat, start_ts, end_ts, SYSTEM_TYPES):
+        sender = display_name(sender_username, contacts) if sender_username else "未知"
+        counts[sender] = counts.get(sender, 0) + count
+    return counts
+
+
 def command_stats(args: argparse.Namespace) -> None:
     decrypted_dir = resolve_decrypted_dir(args.decrypted_dir)
     contacts, _ = load_contacts(decrypted_dir)
@@ -903,27 +1742,33 @@ def command_export(args: argparse.Namespace) -> None:
     chat = resolve_chat(args.chat, contacts)
     if not chat:
         raise SystemExit(f"找不到聊天对象: {args.chat}")
-    rows = collect_history(
-        decrypted_dir,
-        chat,
-        parse_time(args.start_time),
-        parse_time(args.end_time, end_of_day=True),
-        args.limit,
-        0,
-        args.type,
-        args.media,
-    )
-    if args.format == "markdown":
-        body = render_export_markdown(chat, rows, args.start_time, args.end_time)
-        suffix = "md"
-    else:
-        body = render_messages_text(rows)
-        suffix = "txt"
+    start_ts = parse_time(args.start_time)
+    end_ts = parse_time(args.end_time, end_of_day=True)
+    total = count_history(decrypted_dir, chat, start_ts, end_ts, args.type)
+    floor = None
+    if args.limit and total > args.limit:
+        # Only the newest `limit` messages: find the oldest one, then stream forward from it.
+        oldest = next(islice(iter_history(decrypted_dir, chat, start_ts, end_ts, args.type), args.limit - 1, None))
+        floor = parse_cursor(oldest["cursor"])
+        total = args.limit
+    suffix = "md" if args.format == "markdown" else "txt"
     out_path = Path(args.output).expanduser() if args.output else exports_dir / "cli_exports" / f"{datetime.now().strftime('%Y%m%d-%H%M%S')}-{safe_name(chat['display_name'])}.{suffix}"
     out_path.parent.mkdir(parents=True, exist_ok=True)
-    out_path.write_text(body.rstrip() + "\n", encoding="utf-8")
+    rows = iter_history(decrypted_dir, chat, start_ts, end_ts, args.type, args.media, descending=False, bound=floor, inclusive=True)
+    written = 0
+    with out_path.open("w", encoding="utf-8") as handle:
+        if args.format == "markdown":
+            handle.write(render_export_markdown(chat, total, args.start_time, args.end_time).rstrip() + "\n")
+        for row in primed(islice(rows, total)):
+            if args.format == "markdown":
+                handle.write(("\n" if not written else "") + export_markdown_line(row) + "\n")
+            else:
+                handle.write(message_text_line(row) + "\n")
+            written += 1
+        if not written and args.format != "markdown":
+            handle.write(render_messages_text([]) + "\n")
     print(out_path)
-    print(f"Exported {len(rows)} messages.")
+    print(f"Exported {written} messages.")
 
 
 def digest_range_label(start_time: str | None, end_time: str | None) -> str:
@@ -949,20 +1794,26 @@ def last_digest_timestamp(folder: Path) -> int | None:
     return None
 
 
-def digest_stats_from_rows(rows: list[dict]) -> dict:
-    counts: dict[str, int] = {}
+def digest_stats_from_rows(rows: list[dict], counts: dict[str, int] | None = None) -> dict:
+    """Leaderboards come from `counts` (the stats rollup) when given, else from the rows."""
     usable = []
+    row_counts: dict[str, int] = {}
     for row in rows:
         content = row.get("content") or ""
         if row.get("type") == "系统" or "revokemsg" in content:
             continue
         usable.append(row)
         sender = row.get("sender") or "未知"
-        counts[sender] = counts.get(sender, 0) + 1
+        row_counts[sender] = row_counts.get(sender, 0) + 1
+    if counts is None:
+        counts = row_counts
+        message_count = len(usable)
+    else:
+        message_count = sum(counts.values())
     leaderboard = [{"name": name, "count": count} for name, count in sorted(counts.items(), key=lambda item: item[1], reverse=True)[:10]]
     active_senders = [{"name": name, "count": count} for name, count in sorted(counts.items(), key=lambda item: item[1], reverse=True) if count >= 3]
     return {
-        "message_count": len(usable),
+        "message_count": message_count,
         "leaderboard": leaderboard,
         "active_senders": active_senders,
         "last_message_timestamp": max((row["timestamp"] for row in rows), default=0),
@@ -1015,7 +1866,7 @@ def command_digest_source(args: argparse.Namespace) -> None:
         start_ts = last_digest_timestamp(folder) or start_ts
     end_ts = parse_time(args.end, end_of_day=True)
     rows = collect_history(decrypted_dir, group, start_ts, end_ts, args.limit, 0, None, args.media)
-    stats = digest_stats_from_rows(rows)
+    stats = digest_stats_from_rows(rows, sender_counts_for_digest(decrypted_dir, group, start_ts, end_ts))
     range_text = digest_range_label(args.start, args.end)
     stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
     source_json = folder / "sources" / f"{stamp}-{range_text}.json"
@@ -1032,7 +1883,7 @@ def command_digest_source(args: argparse.Namespace) -> None:
             "history_file": str(folder / "history.json"),
         },
     }
-    source_json.write_text(json.dumps(payload, ensure_ascii=False, indent=2) + "\n", encoding="utf-8")
+    source_json.write_text(json.dumps(payload, ensure_ascii=False, indent=2, default=json_default) + "\n", encoding="utf-8")
     source_md.write_text(render_digest_source_markdown(group, rows, stats, range_text) + "\n", encoding="utf-8")
     result = {
         "folder": str(folder),
@@ -1046,7 +1897,7 @@ def command_digest_source(args: argparse.Namespace) -> None:
     output(result if args.format == "json" else "\n".join(f"{k}: {v}" for k, v in result.items()), args.format)
 
 
-def render_export_markdown(chat: dict, rows: list[dict], start_time: str | None, end_time: str | None) -> str:
+def render_export_markdown(chat: dict, count: int, start_time: str | None, end_time: str | None) -> str:
     lines = [
         f"# 聊天记录: {chat['display_name']}",
         "",
@@ -1054,42 +1905,116 @@ def render_export_markdown(chat: dict, rows: list[dict], start_time: str | None,
         f"- 类型: {'群聊' if chat.get('is_group') else '私聊'}",
         f"- 时间范围: {start_time or '最早'} ~ {end_time or '最新'}",
         f"- 导出时间: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}",
-        f"- 消息数量: {len(rows)}",
+        f"- 消息数量: {count}",
         "",
         "## 时间线",
         "",
     ]
-    for row in rows:
-        sender = f"{row['sender']}: " if row.get("sender") else ""
-        lines.append(f"- {row['time']} [{row['type']}] {sender}{row['content']}")
     return "\n".join(lines)
 
 
-def parse_favorite(content: str, fav_type: int) -> str:
+def export_markdown_line(row: dict) -> str:
+    sender = f"{row['sender']}: " if row.get("sender") else ""
+    return f"- {row['time']} [{row['type']}] {sender}{row['content']}"
+
+
+def parse_favorite(content: str, fav_type: int) -> dict:
+    """Title, description, one-line summary and all text of a favorite's XML."""
+    fields = {"title": "", "description": "", "summary": "", "text": ""}
     if not content:
-        return ""
+        return fields
     try:
         root = ET.fromstring(content)
     except ET.ParseError:
-        return ""
+        return fields
     item = root if root.tag == "favitem" else root.find(".//favitem")
     if item is None:
-        return ""
-    if fav_type == 1:
-        return (item.findtext("desc") or "").strip()
-    if fav_type == 2:
-        return "[图片收藏]"
+        return fields
+    fields["text"] = " ".join(part.strip() for part in item.itertext() if part.strip())
+    desc = (item.findtext("desc") or "").strip()
     if fav_type == 5:
-        title = (item.findtext(".//pagetitle") or "").strip()
-        desc = (item.findtext(".//pagedesc") or "").strip()
-        return f"{title} - {desc}" if desc else title
-    if fav_type == 19:
-        return (item.findtext("desc") or "").strip()
-    if fav_type == 20:
-        nickname = (item.findtext(".//nickname") or "").strip()
-        desc = (item.findtext(".//desc") or "").strip()
-        return " ".join(part for part in (nickname, desc) if part) or "[视频号]"
-    return (item.findtext("desc") or "").strip() or "[收藏]"
+        fields["title"] = (item.findtext(".//pagetitle") or "").strip()
+        fields["description"] = (item.findtext(".//pagedesc") or "").strip()
+        fields["summary"] = f"{fields['title']} - {fields['description']}" if fields["description"] else fields["title"]
+    elif fav_type == 20:
+        fields["title"] = (item.findtext(".//nickname") or "").strip()
+        fields["description"] = (item.findtext(".//desc") or "").strip()
+        fields["summary"] = " ".join(part for part in (fields["title"], fields["description"]) if part) or "[视频号]"
+    else:
+        fields["description"] = desc
+        fields["summary"] = "[图片收藏]" if fav_type == 2 else desc if fav_type in (1, 19) else desc or "[收藏]"
+    return fields
+
+
+FAVORITE_INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS fav_items(
+    local_id INTEGER PRIMARY KEY, type INTEGER, update_time INTEGER, title TEXT, description TEXT,
+    summary TEXT, fromusr TEXT, realchatname TEXT
+);
+CREATE INDEX IF NOT EXISTS fav_items_time ON fav_items(update_time);
+CREATE VIRTUAL TABLE IF NOT EXISTS fav_fts USING fts5(body, tokenize='unicode61');
+CREATE TRIGGER IF NOT EXISTS fav_items_delete AFTER DELETE ON fav_items BEGIN
+    DELETE FROM fav_fts WHERE rowid = old.local_id;
+END;
+"""
+
+
+def update_favorite_index(decrypted_dir: Path, rebuild: bool = False) -> dict:
+    """Parse favorites whose update_time reached the last high-water mark into fav_items.
+
+    favorite.db is only read when its size or mtime changed; ids that disappeared
+    from fav_db_item are dropped.
+    """
+    fav_db = decrypted_dir / "favorite/favorite.db"
+    store = open_sidecar(decrypted_dir, FAVORITE_INDEX, "fav_items", FAVORITE_INDEX_SCHEMA, FAVORITE_INDEX_VERSION)
+    if rebuild:
+        clear_sidecar(store, "fav_items", FAVORITE_INDEX_VERSION)
+    stats = {"favorites_updated": 0, "favorites_removed": 0}
+    try:
+        stat = fav_db.stat()
+        seen = store.execute("SELECT size, mtime_ns FROM index_sources WHERE db='favorite.db'").fetchone()
+        if not seen or (seen["size"], seen["mtime_ns"]) != (stat.st_size, stat.st_mtime_ns):
+            with connect(fav_db) as con, store:
+                if not table_exists(con, "fav_db_item"):
+                    raise SystemExit("favorite.db 中没有 fav_db_item")
+                present = {row[0] for row in con.execute("SELECT local_id FROM fav_db_item")}
+                gone = [(local_id,) for (local_id,) in store.execute("SELECT local_id FROM fav_items") if local_id not in present]
+                store.executemany("DELETE FROM fav_items WHERE local_id=?", gone)
+                stats["favorites_removed"] = len(gone)
+                mark = store.execute("SELECT max(update_time) FROM fav_items").fetchone()[0]
+                # >= rather than > so items sharing the mark's second are re-read, not missed.
+                rows = con.execute(
+                    "SELECT local_id, type, update_time, content, fromusr, realchatname FROM fav_db_item WHERE update_time >= ?",
+                    (mark if mark is not None else -1,),
+                )
+                for row in rows:
+                    fav_type = int(row["type"] or 0)
+                    fields = parse_favorite(row["content"] or "", fav_type)
+                    store.execute("DELETE FROM fav_items WHERE local_id=?", (row["local_id"],))
+                    store.execute(
+                        "INSERT INTO fav_items(local_id, type, update_time, title, description, summary, fromusr, realchatname) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                        (
+                            row["local_id"],
+                            fav_type,
+                            int(row["update_time"] or 0),
+                            fields["title"],
+                            fields["description"],
+                            fields["summary"],
+                            str(row["fromusr"] or ""),
+                            str(row["realchatname"] or ""),
+                        ),
+                    )
+                    store.execute("INSERT INTO fav_fts(rowid, body) VALUES (?, ?)", (row["local_id"], segment_text(fields["text"])))
+                    stats["favorites_updated"] += 1
+                store.execute(
+                    "INSERT OR REPLACE INTO index_sources(db, size, mtime_ns) VALUES ('favorite.db', ?, ?)",
+                    (stat.st_size, stat.st_mtime_ns),
+                )
+        stats["indexed_favorites"] = store.execute("SELECT count(*) FROM fav_items").fetchone()[0]
+    finally:
+        store.close()
+    return stats
 
 
 def command_favorites(args: argparse.Namespace) -> None:
@@ -1098,21 +2023,28 @@ def command_favorites(args: argparse.Namespace) -> None:
     if not fav_db.exists():
         raise SystemExit(f"找不到 favorite.db: {fav_db}")
     contacts, _ = load_contacts(decrypted_dir)
+    update_favorite_index(decrypted_dir)
     where = []
     params = []
     if args.type:
-        where.append("type = ?")
+        where.append("fav_items.type = ?")
         params.append(FAVORITE_TYPE_FILTERS[args.type])
-    if args.query:
-        where.append("content LIKE ?")
-        params.append(f"%{args.query}%")
+    query = fts_query(args.query) if args.query else ""
+    if query:
+        source = "fav_items JOIN fav_fts ON fav_fts.rowid = fav_items.local_id"
+        where.append("fav_fts MATCH ?")
+        params.append(query)
+    else:
+        source = "fav_items"
+        if args.query:
+            where.append("(title LIKE ? OR description LIKE ? OR summary LIKE ?)")
+            params.extend([f"%{args.query}%"] * 3)
     where_sql = f"WHERE {' AND '.join(where)}" if where else ""
+    order = "fav_fts.rank" if query and args.sort == "rank" else "update_time DESC, local_id DESC"
     rows = []
-    with connect(fav_db) as con:
-        if not table_exists(con, "fav_db_item"):
-            raise SystemExit("favorite.db 中没有 fav_db_item")
-        for row in con.execute(
-            f"SELECT local_id, type, update_time, content, fromusr, realchatname FROM fav_db_item {where_sql} ORDER BY update_time DESC LIMIT ?",
+    with connect(decrypted_dir / FAVORITE_INDEX) as store:
+        for row in store.execute(
+            f"SELECT fav_items.* FROM {source} {where_sql} ORDER BY {order} LIMIT ?",
             (*params, args.limit),
         ):
             ts = int(row["update_time"] or 0)
@@ -1121,9 +2053,11 @@ def command_favorites(args: argparse.Namespace) -> None:
                 "id": row["local_id"],
                 "type": FAVORITE_TYPE_MAP.get(fav_type, f"type={fav_type}"),
                 "time": datetime.fromtimestamp(ts).strftime("%Y-%m-%d %H:%M") if ts else "",
-                "summary": parse_favorite(row["content"] or "", fav_type),
-                "from": display_name(str(row["fromusr"] or ""), contacts) if row["fromusr"] else "",
-                "source_chat": display_name(str(row["realchatname"] or ""), contacts) if row["realchatname"] else "",
+                "title": row["title"],
+                "description": row["description"],
+                "summary": row["summary"],
+                "from": display_name(row["fromusr"], contacts) if row["fromusr"] else "",
+                "source_chat": display_name(row["realchatname"], contacts) if row["realchatname"] else "",
             })
     data = {"count": len(rows), "favorites": rows}
     output(data if args.format == "json" else render_favorites_text(rows), args.format)
@@ -1172,6 +2106,7 @@ def parse_moment(content: str, tid: str, db_user: str) -> dict:
     ts = int(create_time) if create_time.isdigit() else 0
     return {
         "tid": tid,
+        "id": xml_text(timeline, "id"),
         "username": xml_text(timeline, "username") or db_user,
         "nickname": xml_text(timeline, "nickname"),
         "timestamp": ts,
@@ -1183,6 +2118,144 @@ def parse_moment(content: str, tid: str, db_user: str) -> dict:
     }
 
 
+SNS_INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sns_posts(
+    id INTEGER PRIMARY KEY, tid UNIQUE, db_user TEXT, post_id TEXT, username TEXT, nickname TEXT,
+    create_time INTEGER, content TEXT, type TEXT, media_count INTEGER, media TEXT, links TEXT,
+    content_hash TEXT
+);
+CREATE INDEX IF NOT EXISTS sns_posts_user_time ON sns_posts(db_user, create_time);
+CREATE VIRTUAL TABLE IF NOT EXISTS sns_fts USING fts5(body, links, tokenize='trigram');
+CREATE TRIGGER IF NOT EXISTS sns_posts_delete AFTER DELETE ON sns_posts BEGIN
+    DELETE FROM sns_fts WHERE rowid = old.id;
+END;
+"""
+
+
+def parse_moment_row(content: str, tid, db_user: str) -> dict:
+    try:
+        return parse_moment(content, str(tid), db_user)
+    except Exception as exc:
+        return {"tid": str(tid), "id": "", "username": db_user, "nickname": "", "timestamp": 0, "time": "", "content": f"[无法解析 XML: {exc}]", "type": "", "media": [], "links": []}
+
+
+def content_hash(content) -> str:
+    data = content.encode("utf-8", "surrogatepass") if isinstance(content, str) else bytes(content)
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def update_sns_index(decrypted_dir: Path, rebuild: bool = False) -> dict:
+    """Parse SnsTimeLine rows that are new or changed since the last run into sns_posts.
+
+    The cache is keyed by tid; a post is re-parsed only when a hash of its XML
+    changes, and tids that disappeared from sns.db are dropped.
+    """
+    sns_db = decrypted_dir / "sns/sns.db"
+    store = open_sidecar(decrypted_dir, SNS_INDEX, "sns_posts", SNS_INDEX_SCHEMA, SNS_INDEX_VERSION)
+    if rebuild:
+        clear_sidecar(store, "sns_posts", SNS_INDEX_VERSION)
+    stats = {"posts_added": 0, "posts_updated": 0, "posts_removed": 0}
+    try:
+        stat = sns_db.stat()
+        seen = store.execute("SELECT size, mtime_ns FROM index_sources WHERE db='sns.db'").fetchone()
+        if not seen or (seen["size"], seen["mtime_ns"]) != (stat.st_size, stat.st_mtime_ns):
+            with connect(sns_db) as con, store:
+                known = {row["tid"]: (row["id"], row["content_hash"]) for row in store.execute("SELECT id, tid, content_hash FROM sns_posts")}
+                source = {
+                    row["tid"]: content_hash(row["content"])
+                    for row in con.execute("SELECT tid, content FROM SnsTimeLine")
+                    if row["content"]
+                }
+                stale = [tid for tid in known if tid not in source or known[tid][1] != source[tid]]
+                store.executemany("DELETE FROM sns_posts WHERE id=?", [(known[tid][0],) for tid in stale])
+                stats["posts_removed"] = sum(1 for tid in stale if tid not in source)
+                pending = [tid for tid in source if tid not in known or known[tid][1] != source[tid]]
+                stats["posts_updated"] = len(pending) - sum(1 for tid in pending if tid not in known)
+                stats["posts_added"] = len(pending) - stats["posts_updated"]
+                for start in range(0, len(pending), 500):
+                    chunk = pending[start:start + 500]
+                    rows = con.execute(
+                        f"SELECT tid, user_name, content FROM SnsTimeLine WHERE tid IN ({','.join('?' for _ in chunk)})",
+                        chunk,
+                    ).fetchall()
+                    for row in rows:
+                        if not row["content"]:
+                            continue
+                        post = parse_moment_row(row["content"], row["tid"], str(row["user_name"]))
+                        cursor = store.execute(
+                            "INSERT INTO sns_posts(tid, db_user, post_id, username, nickname, create_time, content, type, "
+                            "media_count, media, links, content_hash) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                            (
+                                row["tid"],
+                                str(row["user_name"]),
+                                post["id"],
+                                post["username"],
+                                post["nickname"],
+                                post["timestamp"],
+                                post["content"],
+                                post["type"],
+                                len(post["media"]),
+                                json.dumps(post["media"], ensure_ascii=False),
+                                json.dumps(post["links"], ensure_ascii=False),
+                                content_hash(row["content"]),
+                            ),
+                        )
+                        store.execute(
+                            "INSERT INTO sns_fts(rowid, body, links) VALUES (?, ?, ?)",
+                            (cursor.lastrowid, post["content"], " ".join(post["links"])),
+                        )
+                store.execute(
+                    "INSERT OR REPLACE INTO index_sources(db, size, mtime_ns) VALUES ('sns.db', ?, ?)",
+                    (stat.st_size, stat.st_mtime_ns),
+                )
+        stats["indexed_posts"] = store.execute("SELECT count(*) FROM sns_posts").fetchone()[0]
+    finally:
+        store.close()
+    return stats
+
+
+def query_sns_index(decrypted_dir: Path, usernames, start_ts: int | None = None, end_ts: int | None = None, keyword: str | None = None, limit: int = 50) -> list[dict]:
+    """Date, keyword and limit filters run in SQL against the parsed-post cache; newest first."""
+    update_sns_index(decrypted_dir)
+    usernames = sorted(usernames)
+    clauses = [f"db_user IN ({','.join('?' for _ in usernames)})"]
+    params: list = list(usernames)
+    if start_ts:
+        clauses.append("create_time >= ?")
+        params.append(start_ts)
+    if end_ts:
+        clauses.append("create_time BETWEEN 1 AND ?")
+        params.append(end_ts)
+    if keyword:
+        query = trigram_query(keyword)
+        if query:
+            clauses.append("id IN (SELECT rowid FROM sns_fts WHERE sns_fts MATCH ?)")
+            params.append(query)
+        else:
+            clauses.append("(content LIKE ? OR links LIKE ?)")
+            params.extend([f"%{keyword}%"] * 2)
+    sql = f"SELECT * FROM sns_posts WHERE {' AND '.join(clauses)} ORDER BY create_time DESC, id DESC LIMIT ?"
+    params.append(limit)
+    posts = []
+    with connect(decrypted_dir / SNS_INDEX) as store:
+        for row in store.execute(sql, params):
+            ts = int(row["create_time"] or 0)
+            posts.append({
+                "tid": str(row["tid"]),
+                "id": row["post_id"],
+                "username": row["username"],
+                "nickname": row["nickname"],
+                "timestamp": ts,
+                "time": datetime.fromtimestamp(ts).strftime("%Y-%m-%d %H:%M") if ts else "",
+                "content": row["content"],
+                "type": row["type"],
+                "media": json.loads(row["media"] or "[]"),
+                "links": json.loads(row["links"] or "[]"),
+                "db_user": row["db_user"],
+            })
+    return posts
+
+
 def command_moments(args: argparse.Namespace) -> None:
     decrypted_dir = resolve_decrypted_dir(args.decrypted_dir)
     sns_db = decrypted_dir / "sns/sns.db"
@@ -1191,36 +2264,19 @@ def command_moments(args: argparse.Namespace) -> None:
     contacts, _ = load_contacts(decrypted_dir)
     usernames = set(args.username or [])
     if args.name:
-        q = args.name.lower()
-        for item in contacts.values():
-            if any(q in str(item.get(field) or "").lower() for field in ("username", "display_name", "remark", "nick_name", "alias")):
-                usernames.add(item["username"])
+        usernames.update(contacts.index.search(args.name))
     if not usernames:
         raise SystemExit("请传 --name 或 --username")
-    start_ts = parse_time(args.start)
-    end_ts = parse_time(args.end, end_of_day=True)
-    posts = []
-    with connect(sns_db) as con:
-        placeholders = ",".join("?" for _ in usernames)
-        for row in con.execute(f"SELECT tid, user_name, content FROM SnsTimeLine WHERE user_name IN ({placeholders})", tuple(usernames)):
-            if not row["content"]:
-                continue
-            try:
-                post = parse_moment(row["content"], str(row["tid"]), str(row["user_name"]))
-            except Exception as exc:
-                post = {"tid": str(row["tid"]), "username": str(row["user_name"]), "time": "", "timestamp": 0, "content": f"[无法解析 XML: {exc}]", "media": [], "links": []}
-            if start_ts and (not post["timestamp"] or post["timestamp"] < start_ts):
-                continue
-            if end_ts and (not post["timestamp"] or post["timestamp"] > end_ts):
-                continue
-            if args.keyword:
-                haystack = json.dumps(post, ensure_ascii=False)
-                if args.keyword.lower() not in haystack.lower():
-                    continue
-            post["display_name"] = display_name(post["username"], contacts)
-            posts.append(post)
-    posts.sort(key=lambda item: item["timestamp"], reverse=True)
-    posts = posts[: args.limit]
+    posts = query_sns_index(
+        decrypted_dir,
+        usernames,
+        start_ts=parse_time(args.start),
+        end_ts=parse_time(args.end, end_of_day=True),
+        keyword=args.keyword,
+        limit=args.limit,
+    )
+    for post in posts:
+        post["display_name"] = display_name(post["username"], contacts)
     data = {"count": len(posts), "moments": posts}
     output(data if args.format == "json" else render_moments_text(posts), args.format)
 
@@ -1247,7 +2303,7 @@ def render_moments_text(posts: list[dict]) -> str:
 
 
 def build_parser() -> argparse.ArgumentParser:
-    parser = argparse.ArgumentParser(description="Query the decrypted wechat-local-vault.")
+    parser = argparse.ArgumentParser(prog="vault_cli.py", description="Query the decrypted wechat-local-vault.")
     parser.add_argument("--decrypted-dir", help="覆盖明文 vault 目录")
     sub = parser.add_subparsers(dest="command", required=True)
 
@@ -1269,6 +2325,15 @@ def build_parser() -> argparse.ArgumentParser:
     p.add_argument("--format", choices=["json", "text"], default="json")
     p.set_defaults(func=command_new_messages)
 
+    p = sub.add_parser("watch", help="持续监听新消息，逐条输出 JSON 行")
+    p.add_argument("--chat", action="append", help="只输出这些聊天对象，可重复")
+    p.add_argument("--interval", type=float, default=1.0, help="最短轮询间隔（秒）")
+    p.add_argument("--max-interval", type=float, default=30.0, help="无变化时退避到的最长轮询间隔（秒）")
+    p.add_argument("--duration", type=float, default=0, help="运行多少秒后退出；0 表示一直运行")
+    p.add_argument("--max-events", type=int, default=0, help="输出多少条消息后退出；0 表示不限")
+    p.add_argument("--no-refresh", action="store_true", help="不读源库，只监听已由其他进程刷新的明文消息库")
+    p.set_defaults(func=command_watch)
+
     p = sub.add_parser("contacts", help="联系人/群聊搜索")
     p.add_argument("--query")
     p.add_argument("--detail")
@@ -1285,6 +2350,7 @@ def build_parser() -> argparse.ArgumentParser:
     p.add_argument("chat")
     p.add_argument("--limit", type=int, default=50)
     p.add_argument("--offset", type=int, default=0)
+    p.add_argument("--cursor", help="上一页返回的 next_cursor，只取比它更早的消息")
     p.add_argument("--start-time", default="")
     p.add_argument("--end-time", default="")
     p.add_argument("--type", choices=sorted(MESSAGE_TYPE_FILTERS))
@@ -1300,9 +2366,16 @@ def build_parser() -> argparse.ArgumentParser:
     p.add_argument("--start-time", default="")
     p.add_argument("--end-time", default="")
     p.add_argument("--type", choices=sorted(MESSAGE_TYPE_FILTERS))
+    p.add_argument("--sort", choices=["rank", "time"], default="rank", help="索引命中按相关度或时间排序")
+    p.add_argument("--scan", action="store_true", help="不用全文索引，逐表 LIKE 扫描")
     p.add_argument("--format", choices=["json", "text"], default="json")
     p.set_defaults(func=command_search)
 
+    p = sub.add_parser("index", help="增量更新消息全文索引和统计汇总")
+    p.add_argument("--rebuild", action="store_true", help="清空后重建")
+    p.add_argument("--format", choices=["json", "text"], default="json")
+    p.set_defaults(func=command_index)
+
     p = sub.add_parser("stats", help="聊天统计")
     p.add_argument("chat")
     p.add_argument("--start-time", default="")
@@ -1317,7 +2390,7 @@ def build_parser() -> argparse.ArgumentParser:
     p.add_argument("--exports-dir")
     p.add_argument("--start-time", default="")
     p.add_argument("--end-time", default="")
-    p.add_argument("--limit", type=int, default=500)
+    p.add_argument("--limit", type=int, default=500, help="只导出最新 N 条；0 表示全部，边读边写")
     p.add_argument("--type", choices=sorted(MESSAGE_TYPE_FILTERS))
     p.add_argument("--media", action="store_true")
     p.set_defaults(func=command_export)
@@ -1337,6 +2410,7 @@ def build_parser() -> argparse.ArgumentParser:
     p.add_argument("--limit", type=int, default=20)
     p.add_argument("--type", choices=sorted(FAVORITE_TYPE_FILTERS))
     p.add_argument("--query")
+    p.add_argument("--sort", choices=["time", "rank"], default="time", help="--query 命中按时间或相关度排序")
     p.add_argument("--format", choices=["json", "text"], default="json")
     p.set_defaults(func=command_favorites)
 
@@ -1352,11 +2426,59 @@ def build_parser() -> argparse.ArgumentParser:
     return parser
 
 
-def main(argv: list[str] | None = None) -> None:
+def run(argv: list[str]) -> None:
     parser = build_parser()
     args = parser.parse_args(argv)
     args.func(args)
 
 
+def delegate_to_daemon(argv: list[str]) -> dict | None:
+    """Run argv inside vault_daemon.py when its socket answers; None means run locally.
+
+    Only a daemon that cannot be reached within DAEMON_CONNECT_TIMEOUT or answers busy falls
+    back to a local run. Once the request is sent the daemon may already be executing it, so a
+    missing reply is an error rather than a second run (exports and new-messages are not idempotent).
+    """
+    if os.environ.get("WECHAT_VAULT_NO_DAEMON") == "1" or not DAEMON_SOCKET.exists():
+        return None
+    request = {"jsonrpc": "2.0", "id": 1, "method": "run", "params": {"argv": argv, "cwd": os.getcwd()}}
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        try:
+            client.settimeout(DAEMON_CONNECT_TIMEOUT)
+            client.connect(str(DAEMON_SOCKET))
+            client.sendall(json.dumps(request, ensure_ascii=False).encode() + b"\n")
+        except OSError:
+            return None
+        try:
+            client.settimeout(DAEMON_REPLY_TIMEOUT)
+            with client.makefile("rb") as reader:
+                line = reader.readline()
+        except OSError as exc:
+            raise SystemExit(f"daemon 未在 {DAEMON_REPLY_TIMEOUT:g} 秒内返回结果，命令可能仍在 daemon 中执行，未在本地重跑: {exc}")
+    if not line:
+        raise SystemExit("daemon 在返回结果前断开连接，命令可能已部分执行，未在本地重跑")
+    reply = json.loads(line)
+    if "result" in reply:
+        return reply["result"]
+    error = reply.get("error") or {}
+    if error.get("code") == DAEMON_BUSY:
+        return None
+    raise SystemExit(f"daemon 执行失败: {error.get('message')}")
+
+
+def main(argv: list[str] | None = None) -> None:
+    argv = sys.argv[1:] if argv is None else argv
+    args = build_parser().parse_args(argv)
+    # watch streams until stopped, so it never goes through the daemon's buffered replies.
+    result = None if args.command == "watch" else delegate_to_daemon(argv)
+    if result is None:
+        args.func(args)
+        return
+    sys.stdout.write(result["stdout"])
+    sys.stderr.write(result["stderr"])
+    if result["exit_code"]:
+        raise SystemExit(result["exit_code"])
+
+
 if __name__ == "__main__":
     main(sys.argv[1:])
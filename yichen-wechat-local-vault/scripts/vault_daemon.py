@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+"""
+Opt-in local query daemon for vault_cli.py.
+
+Serves vault_cli subcommands over a private Unix socket (newline-delimited
+JSON-RPC 2.0) so read-only SQLite connections, the contact map, Name2Id maps
+and the per-DB Msg_ table catalog stay warm between calls. Cached values are
+dropped when the underlying decrypted file changes. vault_cli.py delegates to
+the daemon automatically while the socket is up; set WECHAT_VAULT_NO_DAEMON=1
+to bypass it.
+"""
+
+from __future__ import annotations
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
+import io
+import json
+import os
+from pathlib import Path
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import vault_cli
+
+SOCKET_PATH = vault_cli.DAEMON_SOCKET
+REQUEST_READ_TIMEOUT = 5.0
+
+
+def rpc(method: str, params: dict | None = None, timeout: float = 5.0) -> dict:
+    request = {"jsonrpc": "2.0", "id": 1, "method": method, "params": params or {}}
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.settimeout(timeout)
+        client.connect(str(SOCKET_PATH))
+        client.sendall(json.dumps(request).encode() + b"\n")
+        with client.makefile("rb") as reader:
+            return json.loads(reader.readline())
+
+
+def is_running() -> bool:
+    try:
+        return "result" in rpc("ping", timeout=1.0)
+    except (OSError, ValueError):
+        return False
+
+
+def run_argv(argv: list[str], cwd: str | None) -> dict:
+    stdout, stderr = io.StringIO(), io.StringIO()
+    exit_code = 0
+    previous = os.getcwd()
+    try:
+        if cwd:
+            os.chdir(cwd)
+        with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+            try:
+                vault_cli.run(argv)
+            except SystemExit as exc:
+                if isinstance(exc.code, str):
+                    print(exc.code, file=sys.stderr)
+                    exit_code = 1
+                else:
+                    exit_code = exc.code or 0
+            except Exception as exc:
+                print(f"{type(exc).__name__}: {exc}", file=sys.stderr)
+                exit_code = 1
+    finally:
+        os.chdir(previous)
+    return {"stdout": stdout.getvalue(), "stderr": stderr.getvalue(), "exit_code": exit_code}
+
+
+class DaemonBusy(Exception):
+    pass
+
+
+class Daemon:
+    """Each client gets its own thread; `run` commands execute one at a time on a single worker.
+
+    run_argv swaps the process-wide cwd and stdout, and the cached SQLite connections belong to the
+    thread that opened them, so every command and cache flush goes through the same worker thread.
+    A second `run` arriving while one is in flight is refused with a busy error instead of queueing,
+    and vault_cli runs it locally.
+    """
+
+    def __init__(self, idle_timeout: float) -> None:
+        self.idle_timeout = idle_timeout
+        self.started = time.time()
+        self.last_active = self.started
+        self.requests = 0
+        self.clients = 0
+        self.running = True
+        self.run_lock = threading.Lock()
+        self.state_lock = threading.Lock()
+        self.worker = ThreadPoolExecutor(max_workers=1)
+
+    def handle(self, request: dict) -> dict:
+        method = request.get("method")
+        params = request.get("params") or {}
+        if method == "run":
+            if not self.run_lock.acquire(blocking=False):
+                raise DaemonBusy("daemon busy")
+            try:
+                self.requests += 1
+                return self.worker.submit(run_argv, [str(item) for item in params.get("argv", [])], params.get("cwd")).result()
+            finally:
+                self.run_lock.release()
+        if method == "ping":
+            return {"pid": os.getpid()}
+        if method == "status":
+            return {
+                "pid": os.getpid(),
+                "socket": str(SOCKET_PATH),
+                "uptime_seconds": int(time.time() - self.started),
+                "requests": self.requests,
+                "cached_entries": len(vault_cli.CACHE.entries),
+            }
+        if method == "flush":
+            self.worker.submit(vault_cli.CACHE.clear).result()
+            return {"flushed": True}
+        if method == "shutdown":
+            self.running = False
+            return {"stopping": True}
+        raise ValueError(f"unknown method: {method}")
+
+    def serve_client(self, client: socket.socket) -> None:
+        with self.state_lock:
+            self.clients += 1
+        try:
+            with client, client.makefile("rb") as reader:
+                client.settimeout(REQUEST_READ_TIMEOUT)
+                try:
+                    line = reader.readline()
+                except OSError:
+                    return
+                if not line:
+                    return
+                client.settimeout(None)
+                try:
+                    request = json.loads(line)
+                    reply = {"jsonrpc": "2.0", "id": request.get("id"), "result": self.handle(request)}
+                except DaemonBusy as exc:
+                    reply = {"jsonrpc": "2.0", "id": request.get("id"), "error": {"code": vault_cli.DAEMON_BUSY, "message": str(exc)}}
+                except Exception as exc:
+                    reply = {"jsonrpc": "2.0", "id": None, "error": {"code": -32000, "message": str(exc)}}
+                with contextlib.suppress(OSError):
+                    client.sendall(json.dumps(reply, ensure_ascii=False).encode() + b"\n")
+        finally:
+            with self.state_lock:
+                self.clients -= 1
+                self.last_active = time.time()
+
+    def idle(self) -> bool:
+        with self.state_lock:
+            return bool(self.idle_timeout) and not self.clients and time.time() - self.last_active > self.idle_timeout
+
+    def serve(self) -> None:
+        SOCKET_PATH.parent.mkdir(parents=True, exist_ok=True)
+        os.chmod(SOCKET_PATH.parent, 0o700)
+        if SOCKET_PATH.exists():
+            if is_running():
+                raise SystemExit(f"daemon 已在运行: {SOCKET_PATH}")
+            SOCKET_PATH.unlink()
+        vault_cli.CACHE.enabled = True
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        old_umask = os.umask(0o077)
+        try:
+            server.bind(str(SOCKET_PATH))
+        finally:
+            os.umask(old_umask)
+        os.chmod(SOCKET_PATH, 0o600)
+        server.listen(8)
+        # Short accept timeout so shutdown and the idle timer are noticed while clients run on threads.
+        server.settimeout(1.0)
+        try:
+            while self.running and not self.idle():
+                try:
+                    client, _ = server.accept()
+                except socket.timeout:
+                    continue
+                threading.Thread(target=self.serve_client, args=(client,), daemon=True).start()
+        finally:
+            server.close()
+            with contextlib.suppress(OSError):
+                SOCKET_PATH.unlink()
+            self.worker.submit(vault_cli.CACHE.clear).result()
+            self.worker.shutdown()
+
+
+def command_start(args: argparse.Namespace) -> None:
+    if is_running():
+        print(json.dumps(rpc("status")["result"], ensure_ascii=False, indent=2))
+        return
+    if args.foreground:
+        Daemon(args.idle_timeout).serve()
+        return
+    command = [sys.executable, str(Path(__file__).resolve()), "start", "--foreground", "--idle-timeout", str(args.idle_timeout)]
+    subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+    for _ in range(50):
+        if is_running():
+            print(json.dumps(rpc("status")["result"], ensure_ascii=False, indent=2))
+            return
+        time.sleep(0.1)
+    raise SystemExit("daemon 启动失败")
+
+
+def command_stop(args: argparse.Namespace) -> None:
+    if not is_running():
+        print("daemon 未运行")
+        return
+    rpc("shutdown")
+    print("daemon 已停止")
+
+
+def command_status(args: argparse.Namespace) -> None:
+    if not is_running():
+        print("daemon 未运行")
+        return
+    print(json.dumps(rpc("status")["result"], ensure_ascii=False, indent=2))
+
+
+def command_flush(args: argparse.Namespace) -> None:
+    if not is_running():
+        print("daemon 未运行")
+        return
+    print(json.dumps(rpc("flush")["result"], ensure_ascii=False))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Warm local query daemon for vault_cli.py.")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("start", help="后台启动 daemon")
+    p.add_argument("--foreground", action="store_true", help="在前台运行")
+    p.add_argument("--idle-timeout", type=float, default=1800, help="空闲多少秒后自动退出；0 表示不退出")
+    p.set_defaults(func=command_start)
+
+    p = sub.add_parser("stop", help="停止 daemon")
+    p.set_defaults(func=command_stop)
+
+    p = sub.add_parser("status", help="查看 daemon 状态")
+    p.set_defaults(func=command_status)
+
+    p = sub.add_parser("flush", help="清空 daemon 缓存")
+    p.set_defaults(func=command_flush)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+"""
+SQLCipher 4 page decryption engine for WeChat Mac 4.x databases.
+
+Every page is AES-256-CBC with its own IV stored in the 80-byte reserve area.
+Instead of building one cipher object per page, a range of pages is decrypted
+with a single ECB call and the CBC chaining is undone with one bulk XOR. Large
+databases are split into page ranges that worker processes decrypt and write
+straight to their final offset in a preallocated output file.
+"""
+
+from __future__ import annotations
+
+from concurrent.futures import ProcessPoolExecutor
+import os
+from pathlib import Path
+import struct
+import time
+
+from Crypto.Cipher import AES
+from Crypto.Util.strxor import strxor
+
+PAGE_SIZE = 4096
+RESERVE = 80
+IV_SIZE = 16
+SQLITE_HEADER = b"SQLite format 3\x00"
+
+CHUNK_PAGES = 1024
+PARALLEL_MIN_PAGES = 8192
+ZERO_RESERVE = bytes(RESERVE)
+
+# The reserve area holds the IV followed by an HMAC over ciphertext, IV and
+# page number, so the HMAC prefix already is a per-page ciphertext checksum.
+TOKEN_OFFSET = PAGE_SIZE - RESERVE + IV_SIZE
+TOKEN_SIZE = 16
+
+
+def check_key(key_hex: str) -> bytes:
+    key = bytes.fromhex(key_hex)
+    if len(key) != 32:
+        raise ValueError("key must be 32 bytes")
+    return key
+
+
+def decrypt_pages(key: bytes, data: bytes, first_page: int) -> bytearray:
+    """Decrypt whole pages that start at zero-based page index `first_page`."""
+    size = len(data) - len(data) % PAGE_SIZE
+    if not size:
+        return bytearray()
+    data = data[:size]
+    decrypted = AES.new(key, AES.MODE_ECB).decrypt(data)
+    # CBC: plaintext block = ECB(block) XOR previous ciphertext block, or the
+    # page IV for the first encrypted block of every page.
+    plain = bytearray(size)
+    plain[AES.block_size :] = data[: size - AES.block_size]
+    for offset in range(0, size, PAGE_SIZE):
+        enc_start = 16 if first_page == 0 and offset == 0 else 0
+        iv_start = offset + PAGE_SIZE - RESERVE
+        plain[offset + enc_start : offset + enc_start + IV_SIZE] = data[iv_start : iv_start + IV_SIZE]
+    strxor(decrypted, plain, output=plain)
+    for offset in range(PAGE_SIZE - RESERVE, size, PAGE_SIZE):
+        plain[offset : offset + RESERVE] = ZERO_RESERVE
+    if first_page == 0:
+        plain[:16] = SQLITE_HEADER
+        plain[16:18] = struct.pack(">H", PAGE_SIZE)
+    return plain
+
+
+def chunk_tokens(data: bytes) -> bytes:
+    """Per-page checksums of the whole pages in `data`."""
+    end = len(data) - len(data) % PAGE_SIZE
+    return b"".join(data[offset : offset + TOKEN_SIZE] for offset in range(TOKEN_OFFSET, end, PAGE_SIZE))
+
+
+def decrypt_span(src: str, dst: str, key: bytes, start: int, stop: int) -> bytes:
+    """Decrypt pages [start, stop) of `src` into the same offsets of `dst`; return their checksums."""
+    tokens = []
+    with open(src, "rb") as source, open(dst, "r+b") as target:
+        for first in range(start, stop, CHUNK_PAGES):
+            count = min(CHUNK_PAGES, stop - first)
+            source.seek(first * PAGE_SIZE)
+            data = source.read(count * PAGE_SIZE)
+            target.seek(first * PAGE_SIZE)
+            target.write(decrypt_pages(key, data, first))
+            tokens.append(chunk_tokens(data))
+    return b"".join(tokens)
+
+
+def page_ranges(start: int, stop: int, parts: int) -> list[tuple[int, int]]:
+    parts = max(1, min(parts, stop - start))
+    step = -(-(stop - start) // parts)
+    step = -(-step // CHUNK_PAGES) * CHUNK_PAGES
+    return [(first, min(first + step, stop)) for first in range(start, stop, step)]
+
+
+def default_jobs() -> int:
+    return os.cpu_count() or 1
+
+
+def run_spans(src: Path, dst: Path, key: bytes, spans: list[tuple[int, int]], jobs: int | None) -> bytes:
+    """Decrypt `spans` of `src` into `dst`; return the page checksums read, in span order."""
+    jobs = default_jobs() if jobs is None else max(1, jobs)
+    total = sum(stop - start for start, stop in spans)
+    if jobs == 1 or len(spans) == 1 or total < PARALLEL_MIN_PAGES:
+        return b"".join(decrypt_span(str(src), str(dst), key, start, stop) for start, stop in spans)
+    with ProcessPoolExecutor(max_workers=min(jobs, len(spans))) as pool:
+        futures = [pool.submit(decrypt_span, str(src), str(dst), key, start, stop) for start, stop in spans]
+        return b"".join(future.result() for future in futures)
+
+
+def page_tokens(src: Path) -> bytes:
+    """Return the concatenated per-page checksums of an encrypted database."""
+    tokens = []
+    with src.open("rb") as source:
+        while True:
+            data = source.read(CHUNK_PAGES * PAGE_SIZE)
+            if len(data) < PAGE_SIZE:
+                break
+            tokens.append(chunk_tokens(data))
+    return b"".join(tokens)
+
+
+def changed_pages(old_tokens: bytes, new_tokens: bytes) -> list[int]:
+    block = TOKEN_SIZE * CHUNK_PAGES
+    changed = []
+    for start in range(0, len(new_tokens), block):
+        stop = min(start + block, len(new_tokens))
+        if old_tokens[start:stop] == new_tokens[start:stop]:
+            continue
+        for offset in range(start, stop, TOKEN_SIZE):
+            if old_tokens[offset : offset + TOKEN_SIZE] != new_tokens[offset : offset + TOKEN_SIZE]:
+                changed.append(offset // TOKEN_SIZE)
+    return changed
+
+
+def page_runs(pages: list[int]) -> list[tuple[int, int]]:
+    runs: list[tuple[int, int]] = []
+    for page in pages:
+        if runs and runs[-1][1] == page and runs[-1][1] - runs[-1][0] < CHUNK_PAGES:
+            runs[-1] = (runs[-1][0], page + 1)
+        else:
+            runs.append((page, page + 1))
+    return runs
+
+
+def patch_database(src: Path, dst: Path, key_hex: str, pages: list[int], total_pages: int, *, jobs: int | None = None) -> dict:
+    """Re-decrypt only `pages` of `src` in place into an existing `dst`."""
+    key = check_key(key_hex)
+    started = time.perf_counter()
+    with dst.open("r+b") as handle:
+        if handle.seek(0, os.SEEK_END) != total_pages * PAGE_SIZE:
+            handle.truncate(total_pages * PAGE_SIZE)
+    patched = len(run_spans(src, dst, key, page_runs(sorted(pages)), jobs)) // TOKEN_SIZE
+    elapsed = time.perf_counter() - started
+    return {
+        "pages": total_pages,
+        "pages_patched": patched,
+        "seconds": round(elapsed, 3),
+        "pages_per_second": int(patched / elapsed) if elapsed > 0 else patched,
+    }
+
+
+def decrypt_database(src: Path, dst: Path, key_hex: str, *, jobs: int | None = None, with_tokens: bool = False) -> dict:
+    """Decrypt `src` into `dst` and return page throughput stats.
+
+    `with_tokens` adds the per-page checksums read on the way as "page_tokens",
+    so a full decrypt can seed the incremental page map without a second read.
+    """
+    key = check_key(key_hex)
+    total_pages = src.stat().st_size // PAGE_SIZE
+    if total_pages == 0:
+        raise ValueError("database is smaller than one page")
+    jobs = default_jobs() if jobs is None else max(1, jobs)
+
+    dst.parent.mkdir(parents=True, exist_ok=True)
+    partial = dst.with_name(dst.name + ".partial")
+    started = time.perf_counter()
+    try:
+        with partial.open("wb") as handle:
+            handle.truncate(total_pages * PAGE_SIZE)
+        parts = jobs if total_pages >= PARALLEL_MIN_PAGES else 1
+        tokens = run_spans(src, partial, key, page_ranges(0, total_pages, parts), jobs)
+        os.replace(partial, dst)
+    except BaseException:
+        try:
+            partial.unlink()
+        except OSError:
+            pass
+        raise
+    elapsed = time.perf_counter() - started
+    stats = {
+        "pages": total_pages,
+        "workers": parts,
+        "seconds": round(elapsed, 3),
+        "pages_per_second": int(total_pages / elapsed) if elapsed > 0 else total_pages,
+    }
+    if with_tokens:
+        stats["page_tokens"] = tokens
+    return stats
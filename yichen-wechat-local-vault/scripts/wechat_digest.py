@@ -1,20 +1,23 @@
 #!/usr/bin/env python3
 """
-微信本地解析摘要生成器 - 从加密数据库提取聊天记录生成摘要
+微信本地解析摘要生成器 - 从已解密 vault 提取聊天记录生成摘要
 支持配置文件驱动，适配不同用户
 """
-import sqlite3, struct, os, json, hashlib, argparse
+import sqlite3, os, re, json, argparse
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from Crypto.Cipher import AES
+from pathlib import Path
 import zstandard as zstd
 
+import decrypt_all_dbs
+from table_owners import vault_owner_map
+
 # === 常量 ===
-PAGE_SIZE = 4096
-RESERVE = 80
-IV_SIZE = 16
-KEYS_FILE = os.path.expanduser("~/.config/wechat-keys.json")
 CONFIG_FILE = os.path.expanduser("~/.config/wechat-local-vault.json")
-TMP_DIR = os.path.expanduser("~/Library/Application Support/wechat-local-vault/tmp")
+DEFAULT_DECRYPTED_DIR = os.path.expanduser("~/Library/Application Support/wechat-local-vault/decrypted/current")
+# 摘要只读这几类库；其余有密钥的库（收藏、朋友圈等）不在这里刷新
+DIGEST_SOURCES = ("contact/contact.db", "session/session.db")
+MESSAGE_DB_RE = re.compile(r"message/message_\d+\.db")
 
 MSG_TYPE_LABELS = {
     1: None,           # 文本
@@ -49,55 +52,33 @@ def load_config(config_path=None):
     }
 
 
-def get_db_base(config):
-    """获取数据库基础路径"""
-    if config.get("db_base_path"):
-        return os.path.expanduser(config["db_base_path"])
-    if config.get("wxid"):
-        return os.path.expanduser(
-            f"~/Library/Containers/com.tencent.xinWeChat/Data/Documents/"
-            f"xwechat_files/{config['wxid']}/db_storage"
-        )
-    print("[ERROR] 未配置 wxid 或 db_base_path，请先运行 extract_keys.py 或配置 ~/.config/wechat-local-vault.json")
-    return None
-
-
 def get_report_dir(config):
     """获取报告输出目录"""
     return os.path.expanduser(config.get("report_dir", "~/Documents/wechat-local-vault"))
 
 
+def get_decrypted_dir(config):
+    """获取已解密 vault 目录（decrypt_all_dbs.py 的输出）"""
+    return Path(os.path.expanduser(config.get("decrypted_dir") or DEFAULT_DECRYPTED_DIR))
+
+
 # === 基础工具 ===
 
-def load_keys():
-    with open(KEYS_FILE) as f:
-        return json.load(f)
-
-
-def decrypt_db(db_path, key_hex, out_path):
-    key = bytes.fromhex(key_hex)
-    with open(db_path, "rb") as f:
-        data = f.read()
-    total_pages = len(data) // PAGE_SIZE
-    result = bytearray()
-    for pn in range(total_pages):
-        page = data[pn * PAGE_SIZE:(pn + 1) * PAGE_SIZE]
-        enc_start = 16 if pn == 0 else 0
-        enc_size = PAGE_SIZE - RESERVE - enc_start
-        iv = page[PAGE_SIZE - RESERVE:PAGE_SIZE - RESERVE + IV_SIZE]
-        cipher = AES.new(key, AES.MODE_CBC, iv)
-        dec = cipher.decrypt(page[enc_start:enc_start + enc_size])
-        dp = bytearray(PAGE_SIZE)
-        if pn == 0:
-            dp[:16] = page[:16]
-            dp[16:16 + len(dec)] = dec
-        else:
-            dp[:len(dec)] = dec
-        result.extend(dp)
-    result[:16] = b"SQLite format 3\x00"
-    result[16:18] = struct.pack(">H", PAGE_SIZE)
-    with open(out_path, "wb") as f:
-        f.write(result)
+def refresh_vault(decrypted_dir):
+    """增量刷新摘要用到的联系人、会话和消息分片库：只补写密文有变化的页"""
+    try:
+        sources = {
+            rel: item
+            for rel, item in decrypt_all_dbs.load_sources().items()
+            if rel in DIGEST_SOURCES or MESSAGE_DB_RE.fullmatch(rel)
+        }
+        decrypt_all_dbs.refresh_sources(sources, Path(decrypted_dir))
+    except (SystemExit, OSError, ValueError) as exc:
+        print(f"[WARN] 增量解密失败，继续使用现有 vault: {exc}")
+
+
+def message_db_paths(decrypted_dir):
+    return sorted((decrypted_dir / "message").glob("message_[0-9]*.db"))
 
 
 def get_contact_map(db_path):
@@ -109,13 +90,8 @@ def get_contact_map(db_path):
     return contacts
 
 
-def get_hash_map(db_path):
-    db = sqlite3.connect(db_path)
-    mapping = {}
-    for row in db.execute("SELECT user_name FROM Name2Id"):
-        mapping[hashlib.md5(row[0].encode()).hexdigest()] = row[0]
-    db.close()
-    return mapping
+def get_hash_map(decrypted_dir):
+    return vault_owner_map(Path(decrypted_dir))
 
 
 def decode_content(content):
@@ -186,11 +162,13 @@ def collect_messages(db, contacts, hash_map, since_ts=None, start_ts=None, end_t
                 if is_group:
                     content = resolve_sender(content, contacts)
                 messages.append({
+                    "ts": ct,
                     "time": datetime.fromtimestamp(ct).strftime("%H:%M"),
                     "content": content[:200],
                 })
             else:
                 messages.append({
+                    "ts": ct,
                     "time": datetime.fromtimestamp(ct).strftime("%H:%M"),
                     "content": label,
                 })
@@ -207,61 +185,81 @@ def collect_messages(db, contacts, hash_map, since_ts=None, start_ts=None, end_t
     return chat_stats, max_ts
 
 
-# === 列表模式 ===
+def collect_shard(db_path, contacts, hash_map, since_ts=None, start_ts=None, end_ts=None):
+    db = sqlite3.connect(db_path)
+    try:
+        return collect_messages(db, contacts, hash_map, since_ts, start_ts, end_ts)
+    finally:
+        db.close()
 
-def list_all_chats(config):
-    """列出所有群聊和联系人，供用户选择监控对象"""
-    db_base = get_db_base(config)
-    if not db_base:
-        return
 
-    keys = load_keys()
-    tmp_dir = TMP_DIR
-    os.makedirs(tmp_dir, exist_ok=True)
+def collect_all_shards(decrypted_dir, contacts, hash_map, since_ts=None, start_ts=None, end_ts=None):
+    """并发查询所有 message_N.db 分片，按会话合并结果"""
+    paths = message_db_paths(decrypted_dir)
+    chat_stats = {}
+    max_ts = since_ts or 0
+    if not paths:
+        return chat_stats, max_ts
+    with ThreadPoolExecutor(max_workers=len(paths)) as pool:
+        futures = [pool.submit(collect_shard, path, contacts, hash_map, since_ts, start_ts, end_ts) for path in paths]
+        results = [future.result() for future in futures]
+    for shard_stats, shard_max in results:
+        max_ts = max(max_ts, shard_max)
+        for uname, data in shard_stats.items():
+            merged = chat_stats.get(uname)
+            if merged is None:
+                chat_stats[uname] = data
+                continue
+            merged["count"] += data["count"]
+            merged["text_count"] += data["text_count"]
+            merged["messages"] = sorted(merged["messages"] + data["messages"], key=lambda item: item["ts"])
+    return chat_stats, max_ts
 
-    paths = {
-        "message_0": os.path.join(db_base, "message", "message_0.db"),
-        "contact": os.path.join(db_base, "contact", "contact.db"),
-    }
 
-    for name, path in paths.items():
-        if name in keys and os.path.exists(path):
-            decrypt_db(path, keys[name], os.path.join(tmp_dir, f"{name}.db"))
+# === 列表模式 ===
+
+def list_all_chats(config, refresh=True):
+    """列出所有群聊和联系人，供用户选择监控对象"""
+    decrypted_dir = get_decrypted_dir(config)
+    if refresh:
+        refresh_vault(decrypted_dir)
 
-    contacts = get_contact_map(os.path.join(tmp_dir, "contact.db"))
-    hash_map = get_hash_map(os.path.join(tmp_dir, "message_0.db"))
-    db = sqlite3.connect(os.path.join(tmp_dir, "message_0.db"))
+    contacts = get_contact_map(decrypted_dir / "contact" / "contact.db")
+    hash_map = get_hash_map(decrypted_dir)
 
     # Count messages per chat (last 7 days for relevance)
     week_ago = int((datetime.now() - timedelta(days=7)).timestamp())
-    tables = [t[0] for t in db.execute(
-        "SELECT name FROM sqlite_master WHERE type='table' AND name LIKE 'Msg_%'"
-    ).fetchall()]
+    counts = {}
+    for path in message_db_paths(decrypted_dir):
+        db = sqlite3.connect(path)
+        tables = [t[0] for t in db.execute(
+            "SELECT name FROM sqlite_master WHERE type='table' AND name LIKE 'Msg_%'"
+        ).fetchall()]
+        for t in tables:
+            try:
+                count = db.execute(
+                    f"SELECT COUNT(*) FROM [{t}] WHERE create_time > ?", (week_ago,)
+                ).fetchone()[0]
+            except:
+                count = 0
+            counts[t] = counts.get(t, 0) + count
+        db.close()
 
     groups = []
     contacts_list = []
 
-    for t in tables:
+    for t, count in counts.items():
         hash_id = t.replace("Msg_", "")
         uname = hash_map.get(hash_id, hash_id)
         display = contacts.get(uname, uname)
         is_group = "@chatroom" in uname
 
-        try:
-            count = db.execute(
-                f"SELECT COUNT(*) FROM [{t}] WHERE create_time > ?", (week_ago,)
-            ).fetchone()[0]
-        except:
-            count = 0
-
         entry = {"name": display, "id": uname, "msg_count_7d": count}
         if is_group:
             groups.append(entry)
         else:
             contacts_list.append(entry)
 
-    db.close()
-
     # Sort by message count
     groups.sort(key=lambda x: x["msg_count_7d"], reverse=True)
     contacts_list.sort(key=lambda x: x["msg_count_7d"], reverse=True)
@@ -337,39 +335,17 @@ def generate_report(chat_stats, config, target_date=None):
     return report
 
 
-# === 解密入口 ===
-
-def decrypt_databases(db_base, tmp_dir):
-    """解密所有需要的数据库"""
-    keys = load_keys()
-    os.makedirs(tmp_dir, exist_ok=True)
-
-    paths = {
-        "message_0": os.path.join(db_base, "message", "message_0.db"),
-        "contact": os.path.join(db_base, "contact", "contact.db"),
-        "session": os.path.join(db_base, "session", "session.db"),
-    }
-
-    for name, key_hex in keys.items():
-        if name in paths and os.path.exists(paths[name]):
-            decrypt_db(paths[name], key_hex, os.path.join(tmp_dir, f"{name}.db"))
-
-
 # === 主入口 ===
 
-def run_digest(config_path=None):
+def run_digest(config_path=None, refresh=True):
     """默认模式：昨天 08:00 到今天 08:00"""
     config = load_config(config_path)
-    db_base = get_db_base(config)
-    if not db_base:
-        return None
+    decrypted_dir = get_decrypted_dir(config)
+    if refresh:
+        refresh_vault(decrypted_dir)
 
-    tmp_dir = TMP_DIR
-    decrypt_databases(db_base, tmp_dir)
-
-    contacts = get_contact_map(os.path.join(tmp_dir, "contact.db"))
-    hash_map = get_hash_map(os.path.join(tmp_dir, "message_0.db"))
-    db = sqlite3.connect(os.path.join(tmp_dir, "message_0.db"))
+    contacts = get_contact_map(decrypted_dir / "contact" / "contact.db")
+    hash_map = get_hash_map(decrypted_dir)
 
     today = datetime.now()
     start = today.replace(hour=8, minute=0, second=0, microsecond=0) - timedelta(days=1)
@@ -379,8 +355,7 @@ def run_digest(config_path=None):
 
     print(f"摘要模式：{start.strftime('%Y-%m-%d %H:%M')} → {end.strftime('%Y-%m-%d %H:%M')}")
 
-    chat_stats, _ = collect_messages(db, contacts, hash_map, start_ts=start_ts, end_ts=end_ts)
-    db.close()
+    chat_stats, _ = collect_all_shards(decrypted_dir, contacts, hash_map, start_ts=start_ts, end_ts=end_ts)
 
     if not chat_stats:
         print("没有新消息")
@@ -401,26 +376,21 @@ def run_digest(config_path=None):
     return report_path
 
 
-def run_date(date_str, config_path=None):
+def run_date(date_str, config_path=None, refresh=True):
     """日期模式：生成指定日期的完整报告"""
     config = load_config(config_path)
-    db_base = get_db_base(config)
-    if not db_base:
-        return None
+    decrypted_dir = get_decrypted_dir(config)
+    if refresh:
+        refresh_vault(decrypted_dir)
 
-    tmp_dir = TMP_DIR
-    decrypt_databases(db_base, tmp_dir)
-
-    contacts = get_contact_map(os.path.join(tmp_dir, "contact.db"))
-    hash_map = get_hash_map(os.path.join(tmp_dir, "message_0.db"))
-    db = sqlite3.connect(os.path.join(tmp_dir, "message_0.db"))
+    contacts = get_contact_map(decrypted_dir / "contact" / "contact.db")
+    hash_map = get_hash_map(decrypted_dir)
 
     target_date = datetime.strptime(date_str, "%Y-%m-%d")
     start_ts = int(target_date.replace(hour=0, minute=0, second=0).timestamp())
     end_ts = int(target_date.replace(hour=23, minute=59, second=59).timestamp())
 
-    chat_stats, _ = collect_messages(db, contacts, hash_map, start_ts=start_ts, end_ts=end_ts)
-    db.close()
+    chat_stats, _ = collect_all_shards(decrypted_dir, contacts, hash_map, start_ts=start_ts, end_ts=end_ts)
 
     report = generate_report(chat_stats, config, target_date=target_date)
 
@@ -442,13 +412,15 @@ if __name__ == "__main__":
     parser.add_argument("date", nargs="?", help="指定日期 (YYYY-MM-DD)，默认昨天8点到今天8点")
     parser.add_argument("--config", help="配置文件路径", default=None)
     parser.add_argument("--list", action="store_true", help="列出所有群聊和联系人")
+    parser.add_argument("--no-refresh", action="store_true", help="不先增量解密，直接读取现有 vault")
     args = parser.parse_args()
 
     config = load_config(args.config)
+    refresh = not args.no_refresh
 
     if args.list:
-        list_all_chats(config)
+        list_all_chats(config, refresh)
     elif args.date:
-        run_date(args.date, args.config)
+        run_date(args.date, args.config, refresh)
     else:
-        run_digest(args.config)
+        run_digest(args.config, refresh)
@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+"""Offline micro-benchmarks for vault hot paths; no WeCom process or user database is touched."""
+
+from __future__ import annotations
+
+import argparse
+import io
+import json
+import os
+import random
+import re
+import tempfile
+import time
+from pathlib import Path
+
+from Crypto.Cipher import AES
+
+import vault_cli
+import wecom_crypto
+from wecom_common import CandidateValidator, iter_databases
+from wecom_crypto import (
+    PAGE_SIZE,
+    SQLITE_HEADER,
+    database_format,
+    decrypt_database_bytes,
+    encrypt_page_for_test,
+    page_key,
+    verify_key,
+)
+
+
+def _timed(function) -> float:
+    started = time.perf_counter()
+    function()
+    return time.perf_counter() - started
+
+
+def bench_keys(args) -> dict:
+    """Decrypting a dataset of same-sized databases: IVs derived per page vs the shared IV table."""
+    raw_key = bytes.fromhex("00112233445566778899aabbccddeeff")
+    rng = random.Random(11)
+    plain = bytearray(rng.randbytes(PAGE_SIZE))
+    plain[:16] = SQLITE_HEADER
+    plain[16:18] = PAGE_SIZE.to_bytes(2, "big")
+    plain[21:24] = b"\x40\x20\x20"
+    pages = [bytes(plain)] + [rng.randbytes(PAGE_SIZE) for _ in range(args.pages - 1)]
+    encrypted = b"".join(encrypt_page_for_test(raw_key, page, number) for number, page in enumerate(pages, 1))
+    outputs = {}
+
+    def per_page():
+        # The previous path: the page key and the four-step LCG + MD5 IV derived for every page of every database.
+        for _ in range(args.databases):
+            output = io.BytesIO()
+            for number in range(1, args.pages + 1):
+                page = encrypted[(number - 1) * PAGE_SIZE : number * PAGE_SIZE]
+                if number == 1:
+                    page = page[8:16] + page[24:]
+                cipher = AES.new(page_key(raw_key, number), AES.MODE_CBC, wecom_crypto._derive_page_iv(number))
+                output.write(SQLITE_HEADER + cipher.decrypt(page) if number == 1 else cipher.decrypt(page))
+            outputs["baseline"] = output.getvalue()
+
+    def shared_table():
+        # Start from an empty table so the one-time build is part of the measurement.
+        wecom_crypto._IV_TABLE = b""
+        for _ in range(args.databases):
+            outputs["optimized"] = decrypt_database_bytes(encrypted, raw_key)[0]
+
+    baseline = _timed(per_page)
+    optimized = _timed(shared_table)
+    if not outputs["baseline"] == outputs["optimized"] == b"".join(pages):
+        raise SystemExit("benchmark results differ between the two decrypt paths")
+    total = args.databases * args.pages
+    return {
+        "benchmark": "keys",
+        "databases": args.databases,
+        "pages_per_database": args.pages,
+        "per_page_seconds": round(baseline, 4),
+        "shared_table_seconds": round(optimized, 4),
+        "per_page_pages_per_second": int(total / baseline) if baseline else None,
+        "shared_table_pages_per_second": int(total / optimized) if optimized else None,
+        "speedup": round(baseline / optimized, 2) if optimized else None,
+    }
+
+
+def _synthetic_dataset(root: Path, raw_key: bytes, databases: int) -> None:
+    plain = bytearray(PAGE_SIZE)
+    plain[:16] = SQLITE_HEADER
+    plain[16:18] = PAGE_SIZE.to_bytes(2, "big")
+    plain[21:24] = b"\x40\x20\x20"
+    plain[100] = 0x0D
+    page_one = encrypt_page_for_test(raw_key, bytes(plain), 1)
+    for number in range(databases):
+        path = root / f"db{number % 4}" / f"bench_{number}.db"
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(page_one + bytes(PAGE_SIZE))
+
+
+def bench_candidates(args) -> dict:
+    """Capture-time key candidate validation against synthetic encrypt_page_for_test page ones."""
+    raw_key = bytes.fromhex("00112233445566778899aabbccddeeff")
+    distinct = [os.urandom(16) for _ in range(max(1, args.candidates // args.repeat))]
+    candidates = [distinct[index % len(distinct)] for index in range(args.candidates - 1)] + [raw_key]
+    with tempfile.TemporaryDirectory() as directory:
+        dataset = Path(directory)
+        _synthetic_dataset(dataset, raw_key, args.databases)
+        found = {}
+
+        def per_candidate():
+            # The previous validate_candidate(): walk, reopen and fully decrypt
+            # every page one for every candidate message.
+            for candidate in candidates:
+                validated = []
+                for relative, path in iter_databases(dataset):
+                    with path.open("rb") as handle:
+                        page = handle.read(PAGE_SIZE)
+                    if database_format(page) == "wecom-wxsqlite3-aes128" and verify_key(candidate, page):
+                        validated.append(str(relative))
+                found["baseline"] = validated
+
+        def cached():
+            validator = CandidateValidator(dataset)
+            for candidate in candidates:
+                found["optimized"] = validator.validate(candidate)
+
+        baseline = _timed(per_candidate)
+        optimized = _timed(cached)
+    if found["baseline"] != found["optimized"]:
+        raise SystemExit("benchmark results differ between the two validators")
+    return {
+        "benchmark": "candidates",
+        "databases": args.databases,
+        "candidates": len(candidates),
+        "distinct_candidates": len(set(candidates)),
+        "validated_databases": len(found["optimized"]),
+        "per_candidate_seconds": round(baseline, 4),
+        "cached_seconds": round(optimized, 4),
+        "speedup": round(baseline / optimized, 1) if optimized else None,
+    }
+
+
+def _varint(value: int) -> bytes:
+    out = bytearray()
+    while value >= 0x80:
+        out.append(value & 0x7F | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def _field(number: int, value) -> bytes:
+    if isinstance(value, int):
+        return _varint(number << 3) + _varint(value)
+    return _varint(number << 3 | 2) + _varint(len(value)) + value
+
+
+def _protobuf_corpus(count: int, distinct: int) -> list[bytes]:
+    """Blobs shaped like WeCom message content: text, mentions, link cards, images, files, revokes."""
+    rng = random.Random(7)
+    words = ["项目进展", "明天上午十点开会", "请查收附件", "收到，谢谢", "客户反馈", "合同已经盖章", "https://work.weixin.qq.com/", "OK"]
+
+    def sentence() -> bytes:
+        return "，".join(rng.choice(words) for _ in range(rng.randint(1, 12))).encode()
+
+    def header() -> bytes:
+        return _field(1, rng.getrandbits(40)) + _field(2, rng.getrandbits(20)) + b"\x19" + os.urandom(8)
+
+    shapes = [
+        lambda: header() + _field(3, _field(1, sentence())),
+        lambda: header() + _field(3, _field(1, sentence()) + b"".join(_field(2, _field(1, rng.getrandbits(40)) + _field(2, "同事".encode())) for _ in range(rng.randint(1, 5)))),
+        lambda: header() + _field(4, _field(1, "季度复盘".encode()) + _field(2, sentence()) + _field(3, b"https://example.com/" + os.urandom(6).hex().encode()) + _field(4, os.urandom(16).hex().encode())),
+        lambda: header() + _field(5, _field(1, os.urandom(16).hex().encode()) + _field(2, os.urandom(16)) + _field(3, rng.getrandbits(24)) + _field(4, os.urandom(rng.randint(40, 400)))),
+        lambda: header() + _field(6, _field(1, "报价单.xlsx".encode()) + _field(2, rng.getrandbits(24)) + _field(3, os.urandom(32))),
+        lambda: header() + _field(7, _field(1, _field(1, _field(1, "撤回了一条消息".encode())))),
+    ]
+    pool = [rng.choice(shapes)() for _ in range(max(1, distinct))]
+    return [pool[rng.randrange(len(pool))] for _ in range(count)]
+
+
+def _baseline_clean(value: str) -> str:
+    value = "".join(character if character in "\n\t" or character.isprintable() else " " for character in value)
+    value = re.sub(r"[ \t]+", " ", value)
+    return re.sub(r"\n{3,}", "\n\n", value).strip()
+
+
+def _baseline_fields(data: bytes, depth: int = 0) -> list[str]:
+    # The previous decoder: byte slices at every level and _clean_text on every segment.
+    if depth > 4 or not data:
+        return []
+    position = 0
+    values: list[str] = []
+    try:
+        while position < len(data):
+            tag, position = vault_cli._read_varint(data, position)
+            wire_type = tag & 7
+            if tag == 0:
+                return []
+            if wire_type == 0:
+                _, position = vault_cli._read_varint(data, position)
+            elif wire_type == 1:
+                position += 8
+            elif wire_type == 5:
+                position += 4
+            elif wire_type == 2:
+                length, position = vault_cli._read_varint(data, position)
+                if position + length > len(data):
+                    return []
+                segment = data[position : position + length]
+                position += length
+                try:
+                    text = _baseline_clean(segment.decode("utf-8")) if b"\x00" not in segment else ""
+                except UnicodeDecodeError:
+                    text = ""
+                if len(text) >= 2 and not re.fullmatch(r"[0-9a-fA-F]{32,}", text):
+                    values.append(text)
+                else:
+                    values.extend(_baseline_fields(segment, depth + 1))
+            else:
+                return []
+            if position > len(data):
+                return []
+    except (ValueError, IndexError):
+        return []
+    return list(dict.fromkeys(value for value in values if value))
+
+
+def _baseline_decode(data: bytes) -> str:
+    try:
+        plain = data.decode("utf-8")
+        controls = sum(1 for byte in data if byte < 32 and byte not in (9, 10, 13))
+        if controls / len(data) <= 0.08:
+            return _baseline_clean(plain)
+    except UnicodeDecodeError:
+        pass
+    values = _baseline_fields(data)
+    return "\n".join(values[:12]) if values else f"[二进制内容 {len(data)} 字节]"
+
+
+def bench_protobuf(args) -> dict:
+    """decode_content over a corpus of WeCom-shaped protobuf message blobs."""
+    corpus = _protobuf_corpus(args.messages, args.distinct)
+    decoded = {}
+
+    def baseline():
+        decoded["baseline"] = [_baseline_decode(blob) for blob in corpus]
+
+    def uncached():
+        decoded["uncached"] = [vault_cli._decode_bytes(blob) for blob in corpus]
+
+    def cached():
+        vault_cli._DECODE_CACHE.clear()
+        decoded["optimized"] = [vault_cli.decode_content(blob) for blob in corpus]
+
+    baseline_seconds = _timed(baseline)
+    uncached_seconds = _timed(uncached)
+    optimized = _timed(cached)
+    if not decoded["baseline"] == decoded["uncached"] == decoded["optimized"]:
+        raise SystemExit("benchmark results differ between the decoders")
+    return {
+        "benchmark": "protobuf",
+        "messages": len(corpus),
+        "distinct_blobs": len(set(corpus)),
+        "mean_blob_bytes": round(sum(map(len, corpus)) / len(corpus)),
+        "baseline_seconds": round(baseline_seconds, 4),
+        "uncached_seconds": round(uncached_seconds, 4),
+        "cached_seconds": round(optimized, 4),
+        "speedup_uncached": round(baseline_seconds / uncached_seconds, 1) if uncached_seconds else None,
+        "speedup": round(baseline_seconds / optimized, 1) if optimized else None,
+    }
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Offline WeCom vault micro-benchmarks")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    command = sub.add_parser("keys", help="整库解密一组数据库：逐页派生 IV vs 进程内共享的 IV 表")
+    command.add_argument("--databases", type=int, default=10)
+    command.add_argument("--pages", type=int, default=5000)
+    command.set_defaults(func=bench_keys)
+
+    command = sub.add_parser("candidates", help="候选 key 校验：每个候选重读全部第一页 vs 缓存第一页 + 去重 + 单块预检")
+    command.add_argument("--databases", type=int, default=30)
+    command.add_argument("--candidates", type=int, default=2048)
+    command.add_argument("--repeat", type=int, default=4, help="每个不同候选平均重复出现的次数")
+    command.set_defaults(func=bench_candidates)
+
+    command = sub.add_parser("protobuf", help="消息正文解码：旧的逐字节 protobuf 解析 vs memoryview 快路径 + 内容缓存")
+    command.add_argument("--messages", type=int, default=50000)
+    command.add_argument("--distinct", type=int, default=20000, help="语料中不同 blob 的数量；其余为重复内容")
+    command.set_defaults(func=bench_protobuf)
+
+    args = parser.parse_args()
+    print(json.dumps(args.func(args), ensure_ascii=False, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
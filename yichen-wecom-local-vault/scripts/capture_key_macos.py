@@ -17,12 +17,12 @@ from datetime import datetime
 from pathlib import Path
 
 from wecom_common import (
+    CandidateValidator,
     choose_dataset,
     dataset_id,
     discover_datasets,
     inspect_dataset,
     save_validated_key,
-    validate_candidate,
     vault_root,
 )
 
@@ -408,6 +408,60 @@ def list_only(data_dir: str | None) -> int:
     return 0
 
 
+def validate_dump(args: argparse.Namespace) -> int:
+    """Re-validate a saved --save-candidates dump offline; raw keys are never printed."""
+    path = Path(args.dump).expanduser()
+    with path.open(encoding="utf-8") as handle:
+        payload = json.load(handle)
+    dataset = choose_capture_dataset(args.data_dir)
+    if payload.get("dataset_id") and payload["dataset_id"] != dataset_id(dataset):
+        print(f"注意：候选文件来自 dataset {payload['dataset_id']}，当前校验 {dataset_id(dataset)}", file=sys.stderr)
+    candidates = []
+    sources: dict[bytes, str] = {}
+    for item in payload.get("candidates", []):
+        try:
+            candidate = bytes.fromhex(str(item.get("key_hex") or item.get("candidate_hex") or ""))
+        except ValueError:
+            continue
+        if len(candidate) == 16:
+            candidates.append(candidate)
+            sources.setdefault(candidate, str(item.get("source", "")))
+    started = time.perf_counter()
+    validator = CandidateValidator(dataset)
+    results = validator.validate_many(candidates)
+    elapsed = time.perf_counter() - started
+    valid = [(candidate, validated) for candidate, validated in results.items() if validated]
+    print(
+        json.dumps(
+            {
+                "dataset_id": dataset_id(dataset),
+                "encrypted_databases": len(validator.pages),
+                "candidate_count": len(candidates),
+                "distinct_candidates": len(results),
+                "validated": [
+                    {
+                        "sha256_12": hashlib.sha256(candidate).hexdigest()[:12],
+                        "source": sources[candidate],
+                        "validated_db_count": len(validated),
+                    }
+                    for candidate, validated in valid
+                ],
+                "seconds": round(elapsed, 3),
+            },
+            ensure_ascii=False,
+            indent=2,
+        )
+    )
+    if not valid:
+        print("候选文件中没有能通过数据库第一页校验的密钥。未保存任何 key。", file=sys.stderr)
+        return 3
+    if args.save:
+        candidate, validated = valid[0]
+        saved = save_validated_key(candidate, dataset, validated, Path(args.output).expanduser() if args.output else None)
+        print(f"已保存经 {len(validated)} 个数据库验证的 key：{saved}")
+    return 0
+
+
 def _probe(command: list[str]) -> str:
     try:
         result = subprocess.run(command, capture_output=True, text=True, check=False, timeout=5)
@@ -452,6 +506,7 @@ def capture(args: argparse.Namespace) -> int:
         raise SystemExit("缺少 frida；请在隔离环境中安装 frida 后重试") from exc
 
     dataset = choose_capture_dataset(args.data_dir)
+    validator = CandidateValidator(dataset)
     messages: queue.Queue[dict] = queue.Queue()
     hooks: set[str] = set()
     validated_key: bytes | None = None
@@ -546,7 +601,7 @@ def capture(args: argparse.Namespace) -> int:
                     candidate = bytes.fromhex(str(payload.get("key", "")))
                 except ValueError:
                     continue
-                validated = validate_candidate(candidate, dataset)
+                validated = validator.validate(candidate)
                 if args.debug_candidates:
                     digest = hashlib.sha256(candidate).hexdigest()[:12]
                     print(
@@ -647,11 +702,18 @@ def main() -> int:
     capture_parser.add_argument("--debug-candidates", action="store_true", help="打印候选来源和短 hash，不打印 raw key")
     capture_parser.add_argument("--save-candidates", action="store_true", help="把 raw 候选写入私密 vault 诊断文件，不在终端显示")
     capture_parser.add_argument("--candidate-output", help="候选诊断文件路径；已存在时拒绝覆盖")
+    dump_parser = sub.add_parser("validate-dump", help="离线校验 --save-candidates 保存的候选文件，不附加进程")
+    dump_parser.add_argument("dump")
+    dump_parser.add_argument("--data-dir")
+    dump_parser.add_argument("--save", action="store_true", help="把第一个通过校验的候选保存为新的私密密钥文件")
+    dump_parser.add_argument("--output", help="新密钥文件路径；已存在时拒绝覆盖")
     args = parser.parse_args()
     if args.command == "list":
         return list_only(args.data_dir)
     if args.command == "doctor":
         return doctor(args.data_dir)
+    if args.command == "validate-dump":
+        return validate_dump(args)
     return capture(args)
 
 
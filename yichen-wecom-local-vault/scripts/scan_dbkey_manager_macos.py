@@ -21,13 +21,13 @@ from datetime import datetime
 from pathlib import Path
 
 from wecom_common import (
+    CandidateValidator,
     choose_dataset,
     discover_datasets,
     dataset_id,
     inspect_dataset,
     iter_databases,
     save_validated_key,
-    validate_candidate,
     vault_root,
 )
 
@@ -281,14 +281,15 @@ def scan_root(args: argparse.Namespace) -> int:
 def validate_candidate_file(path: Path, dataset: Path) -> Path | None:
     with path.open(encoding="utf-8") as handle:
         payload = json.load(handle)
+    candidates = []
     for item in payload.get("candidates", []):
         try:
-            candidate = bytes.fromhex(str(item.get("candidate_hex", "")))
+            candidates.append(bytes.fromhex(str(item.get("candidate_hex", ""))))
         except ValueError:
             continue
-        validated = validate_candidate(candidate, dataset)
-        if validated:
-            return save_validated_key(candidate, dataset, validated)
+    found = CandidateValidator(dataset).first_valid(candidates)
+    if found:
+        return save_validated_key(found[0], dataset, found[1])
     return None
 
 
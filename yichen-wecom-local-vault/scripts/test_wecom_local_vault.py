@@ -3,20 +3,44 @@
 
 from __future__ import annotations
 
+import hashlib
+import io
+import json
+import os
+import sqlite3
 import struct
+import tempfile
 import unittest
+from contextlib import closing
+from pathlib import Path
+from unittest import mock
 
-from vault_cli import decode_content
+import vault_cli
+import wecom_common
+from vault_cli import (
+    build_search_index,
+    decode_content,
+    iter_messages,
+    metadata_names,
+    metadata_users,
+    open_metadata,
+    stream_messages,
+)
+from wecom_common import CandidateValidator, previous_snapshot, source_fingerprint
 from wecom_crypto import (
     PAGE_SIZE,
     SQLITE_HEADER,
+    IV_TABLE_PAGES,
+    _derive_page_iv,
     _wal_frames,
     database_format,
+    decrypt_database,
     decrypt_database_bytes,
     decrypt_page,
     encrypt_page_for_test,
     page_iv,
     page_key,
+    page_one_header_matches,
     verify_key,
 )
 
@@ -47,6 +71,26 @@ class CryptoTests(unittest.TestCase):
         self.assertNotEqual(page_key(self.key, 1), page_key(self.key, 2))
         self.assertNotEqual(page_iv(1), page_iv(2))
 
+    def test_shared_iv_table_matches_direct_derivation(self):
+        for page_number in (7, 1, 2, 4096, 4097, 9000, IV_TABLE_PAGES, IV_TABLE_PAGES + 1):
+            self.assertEqual(page_iv(page_number), _derive_page_iv(page_number))
+
+    def test_candidate_validator_reads_page_ones_once(self):
+        encrypted = encrypt_page_for_test(self.key, bytes(self.page_one), 1)
+        self.assertTrue(page_one_header_matches(self.key, encrypted))
+        self.assertFalse(page_one_header_matches(bytes(16), encrypted))
+        with tempfile.TemporaryDirectory() as directory:
+            dataset = Path(directory)
+            (dataset / "sub").mkdir()
+            for name in ("message.db", "sub/user.db"):
+                (dataset / name).write_bytes(encrypted + bytes(PAGE_SIZE))
+            (dataset / "plain.db").write_bytes(bytes(self.page_one))
+            validator = CandidateValidator(dataset)
+            (dataset / "message.db").unlink()
+            results = validator.validate_many([bytes(16), self.key, self.key])
+        self.assertEqual(results, {bytes(16): [], self.key: ["message.db", "sub/user.db"]})
+        self.assertEqual(validator.first_valid([bytes(16), self.key]), (self.key, ["message.db", "sub/user.db"]))
+
     def test_wal_parser_stops_at_last_commit(self):
         wal_header = struct.pack(">IIIIIIII", 0x377F0682, 3007000, PAGE_SIZE, 0, 1, 2, 0, 0)
         frame_one = struct.pack(">IIIIII", 2, 0, 1, 2, 0, 0) + bytes(PAGE_SIZE)
@@ -80,6 +124,231 @@ class CryptoTests(unittest.TestCase):
         self.assertEqual(plaintext, bytes(self.page_one) + updated_second_page)
         self.assertEqual(details["wal_frames_applied"], 1)
 
+    def test_streaming_file_decrypt_applies_last_committed_frame(self):
+        encrypted_database = (
+            encrypt_page_for_test(self.key, bytes(self.page_one), 1)
+            + encrypt_page_for_test(self.key, bytes([3]) * PAGE_SIZE, 2)
+        )
+        wal_header = struct.pack(">IIIIIIII", 0x377F0682, 3007000, PAGE_SIZE, 0, 1, 2, 0, 0)
+        frames = [
+            struct.pack(">IIIIII", 2, 0, 1, 2, 0, 0) + encrypt_page_for_test(self.key, bytes([4]) * PAGE_SIZE, 2),
+            struct.pack(">IIIIII", 3, 3, 1, 2, 0, 0) + encrypt_page_for_test(self.key, bytes([5]) * PAGE_SIZE, 3),
+            struct.pack(">IIIIII", 2, 3, 1, 2, 0, 0) + encrypt_page_for_test(self.key, bytes([6]) * PAGE_SIZE, 2),
+        ]
+        wal_bytes = wal_header + b"".join(frames)
+        expected, expected_details = decrypt_database_bytes(encrypted_database, self.key, wal_bytes=wal_bytes)
+        self.assertEqual(expected, bytes(self.page_one) + bytes([6]) * PAGE_SIZE + bytes([5]) * PAGE_SIZE)
+        with tempfile.TemporaryDirectory() as tmp:
+            source = Path(tmp) / "message.db"
+            source.write_bytes(encrypted_database)
+            Path(str(source) + "-wal").write_bytes(wal_bytes)
+            destination = Path(tmp) / "out" / "message.db"
+            details = decrypt_database(source, destination, self.key)
+            self.assertEqual(destination.read_bytes(), expected)
+            self.assertEqual(details, expected_details)
+            self.assertEqual(details["wal_frames_applied"], 3)
+            with self.assertRaises(FileExistsError):
+                decrypt_database(source, destination, self.key)
+
+
+class SnapshotTests(unittest.TestCase):
+    def test_fingerprint_tracks_wal_and_key(self):
+        with tempfile.TemporaryDirectory() as directory:
+            source = Path(directory) / "message.db"
+            source.write_bytes(bytes(PAGE_SIZE))
+            key = bytes(16)
+            before = source_fingerprint(source, key, True)
+            self.assertEqual(before, source_fingerprint(source, key, True))
+            self.assertNotEqual(before, source_fingerprint(source, b"\x01" * 16, True))
+            Path(str(source) + "-wal").write_bytes(bytes(32))
+            self.assertNotEqual(before, source_fingerprint(source, key, True))
+            self.assertEqual(before, source_fingerprint(source, key, False))
+
+    def test_previous_snapshot_requires_finished_manifest(self):
+        with tempfile.TemporaryDirectory() as directory:
+            root = Path(directory)
+            for name, manifest in (("20260101-000000-abc", "manifest.json"), ("20260102-000000-abc", "manifest.json.partial")):
+                (root / "snapshots" / name).mkdir(parents=True)
+                (root / "snapshots" / name / manifest).write_text("{}")
+            (root / "snapshots" / "20260103-000000-other").mkdir()
+            (root / "snapshots" / "20260103-000000-other" / "manifest.json").write_text("{}")
+            self.assertEqual(previous_snapshot("abc", root).name, "20260101-000000-abc")
+            self.assertIsNone(previous_snapshot("missing", root))
+
+    def test_search_index_is_exhaustive(self):
+        with tempfile.TemporaryDirectory() as directory:
+            snapshot = Path(directory)
+            connection = sqlite3.connect(snapshot / "message.db")
+            connection.execute("CREATE TABLE message_table(message_id, sequence, sender_id, conversation_id, content_type, send_time, content)")
+            connection.executemany(
+                "INSERT INTO message_table VALUES (?,?,?,?,?,?,?)",
+                [(index, index, 1, "R:1", 2, 1_700_000_000_000 + index * 1000, f"row {index}".encode()) for index in range(2000)],
+            )
+            connection.execute("INSERT INTO message_table VALUES (9999, 0, 1, 'R:1', 2, 1600000000000, ?)", ("旧的关键词消息".encode(),))
+            connection.commit()
+            connection.close()
+            self.assertEqual(iter_messages(snapshot, None, None, None, "关键词", 1), [])
+            self.assertEqual(build_search_index(snapshot)["messages"], 2001)
+            found = iter_messages(snapshot, None, None, None, "关键词", 1)
+            self.assertEqual([item["message_id"] for item in found], [9999])
+            recent = iter_messages(snapshot, "R:1", 1_700_000_000 + 1990, None, "ROW", 3)
+            self.assertEqual([item["content"] for item in recent], ["row 1997", "row 1998", "row 1999"])
+
+    def test_metadata_cache_follows_core_databases(self):
+        with tempfile.TemporaryDirectory() as directory:
+            snapshot = Path(directory)
+            connection = sqlite3.connect(snapshot / "user.db")
+            connection.execute("CREATE TABLE user_table(id, name, real_name)")
+            connection.execute("INSERT INTO user_table VALUES (7, 'zhang', '张三')")
+            connection.commit()
+            connection.close()
+            connection = sqlite3.connect(snapshot / "session.db")
+            connection.execute("CREATE TABLE conversation_user_table(conversation_id, user_id, nick_name)")
+            connection.execute("INSERT INTO conversation_user_table VALUES ('R:1', 7, '老张')")
+            connection.commit()
+            connection.close()
+            cache = open_metadata(snapshot)
+            _, users, members = metadata_names(cache, {("R:1", 7), ("R:2", 8)})
+            cache.close()
+            self.assertTrue((snapshot / "metadata.db").is_file())
+            self.assertEqual((users, members), ({7: {"display_name": "张三"}}, {"R:1": {7: "老张"}}))
+            connection = sqlite3.connect(snapshot / "user.db")
+            connection.execute("UPDATE user_table SET real_name='张三丰'")
+            connection.commit()
+            connection.close()
+            cache = open_metadata(snapshot)
+            self.assertEqual(metadata_users(cache)[7]["display_name"], "张三丰")
+            cache.close()
+
+    def test_incremental_decrypt_links_unchanged_databases(self):
+        key = bytes.fromhex("00112233445566778899aabbccddeeff")
+        with tempfile.TemporaryDirectory() as directory:
+            root = Path(directory)
+            dataset = root / "dataset"
+            dataset.mkdir()
+            schemas = {
+                "message.db": "CREATE TABLE message_table(message_id, sequence, sender_id, conversation_id, content_type, send_time, content)",
+                "session.db": "CREATE TABLE conversation_user_table(conversation_id, user_id, nick_name)",
+                "user.db": "CREATE TABLE user_table(id, name, real_name)",
+            }
+            for name, schema in schemas.items():
+                plain = root / name
+                with closing(sqlite3.connect(plain)) as connection, connection:
+                    connection.execute(schema)
+                if name == "message.db":
+                    with closing(sqlite3.connect(plain)) as connection, connection:
+                        connection.executemany(
+                            "INSERT INTO message_table VALUES (?,?,?,?,?,?,?)",
+                            [(index, index, 1, "R:1", 2, 1_700_000_000_000 + index * 1000, f"row {index}".encode()) for index in range(50)],
+                        )
+                data = plain.read_bytes()
+                pages = [data[offset : offset + PAGE_SIZE] for offset in range(0, len(data), PAGE_SIZE)]
+                (dataset / name).write_bytes(b"".join(encrypt_page_for_test(key, page, number) for number, page in enumerate(pages, 1)))
+            key_file = root / "keys.json"
+            key_file.write_text(json.dumps({"global_key": key.hex()}))
+            os.chmod(key_file, 0o600)
+            config = root / "config.json"
+            config.write_text(json.dumps({"vault_dir": str(root / "vault")}))
+
+            def decrypt(*extra: str) -> dict:
+                argv = ["vault_cli.py", "decrypt", "--data-dir", str(dataset), "--key-file", str(key_file), *extra]
+                with mock.patch.object(wecom_common, "CONFIG_PATH", config), mock.patch("sys.argv", argv), \
+                        mock.patch("sys.stdout", new_callable=io.StringIO) as stdout, mock.patch("sys.stderr"):
+                    vault_cli.main()
+                snapshot = Path(json.loads(stdout.getvalue())["snapshot"])
+                with (snapshot / "manifest.json").open(encoding="utf-8") as handle:
+                    return {"path": snapshot, **json.load(handle)}
+
+            first = decrypt("--jobs", "2")
+            self.assertEqual(first["jobs"], 2)
+            self.assertEqual(sorted(item["database"] for item in first["results"] if item["status"] == "ok"), sorted(schemas))
+            self.assertEqual(first["search_index"]["messages"], 50)
+            session = dataset / "session.db"
+            stat = session.stat()
+            os.utime(session, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+
+            second = decrypt("--jobs", "2", "--incremental")
+            self.assertEqual(second["base_snapshot"], first["path"].name)
+            self.assertEqual(second["reused_databases"], ["message.db", "user.db"])
+            self.assertEqual(second["search_index"], {"status": "ok", "reused_from": first["path"].name})
+            for relative, shared in (("message.db", True), ("user.db", True), ("session.db", False), (str(vault_cli.SEARCH_INDEX), True)):
+                same_inode = (first["path"] / relative).stat().st_ino == (second["path"] / relative).stat().st_ino
+                self.assertEqual(same_inode, shared, relative)
+            self.assertEqual((second["path"] / "session.db").read_bytes(), (root / "session.db").read_bytes())
+
+    def test_stream_merges_tables_by_cursor(self):
+        with tempfile.TemporaryDirectory() as directory:
+            snapshot = Path(directory)
+            connection = sqlite3.connect(snapshot / "message.db")
+            for table in ("message_table", "message_small_table"):
+                connection.execute(f"CREATE TABLE {table}(message_id, sequence, sender_id, conversation_id, content_type, send_time, content)")
+            rows = [(index, index, 1, "R:1", 2, 1_700_000_000_000 + (index // 2) * 1000, f"m{index}".encode()) for index in range(25)]
+            connection.executemany("INSERT INTO message_table VALUES (?,?,?,?,?,?,?)", rows[::2])
+            connection.executemany("INSERT INTO message_small_table VALUES (?,?,?,?,?,?,?)", rows[1::2])
+            connection.execute("INSERT INTO message_small_table VALUES (99, 0, 1, 'R:1', 2, NULL, 'no time')")
+            connection.commit()
+            connection.close()
+            expected = ["no time"] + [f"m{index}" for index in range(25)]
+            with closing(open_metadata(snapshot)) as cache:
+                self.assertEqual([content for _, _, content in stream_messages(snapshot, cache, "R:1", None, None, page_size=2)], expected)
+                build_search_index(snapshot)
+                self.assertEqual([content for _, _, content in stream_messages(snapshot, cache, "R:1", None, None, page_size=2)], expected)
+                window = stream_messages(snapshot, cache, "R:1", 1_700_000_003, 1_700_000_004, page_size=3)
+                self.assertEqual([content for _, _, content in window], ["m6", "m7", "m8", "m9"])
+
+
+class ExportTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.snapshot = Path(self.tmp.name)
+        with closing(sqlite3.connect(self.snapshot / "session.db")) as connection, connection:
+            connection.execute("CREATE TABLE conversation_table(id, name)")
+            connection.execute("INSERT INTO conversation_table VALUES ('R:1', '项目群')")
+        with closing(sqlite3.connect(self.snapshot / "user.db")) as connection, connection:
+            connection.execute("CREATE TABLE user_table(id, name, real_name)")
+            connection.execute("INSERT INTO user_table VALUES (7, 'zhang', '张三')")
+        with closing(sqlite3.connect(self.snapshot / "message.db")) as connection, connection:
+            connection.execute("CREATE TABLE message_table(message_id, sequence, sender_id, conversation_id, content_type, send_time, content)")
+            connection.executemany(
+                "INSERT INTO message_table VALUES (?,?,?,?,?,?,?)",
+                [(index, index, 7, "R:1", 2, 1_700_000_000_000 + index * 1000, f"第 {index} 条\n\"引号\"".encode()) for index in range(5)],
+            )
+
+    def export(self, fmt: str, *extra: str) -> str:
+        destination = self.snapshot / "exports" / f"{fmt}-{len(extra)}.out"
+        argv = ["vault_cli.py", "export", "R:1", "--snapshot", str(self.snapshot), "--all", "--format", fmt, "--output", str(destination), *extra]
+        with mock.patch("sys.argv", argv), mock.patch("sys.stdout"), mock.patch("sys.stderr"):
+            vault_cli.main()
+        return destination.read_text(encoding="utf-8")
+
+    def expected(self, start: int | None = None) -> tuple[dict, list[dict]]:
+        with closing(open_metadata(self.snapshot)) as cache:
+            session = vault_cli.metadata_sessions(cache)["R:1"]
+        return session, list(vault_cli.iter_message_records(self.snapshot, "R:1", start, None))
+
+    def test_all_formats_match_buffered_layout(self):
+        session, messages = self.expected()
+        self.assertEqual(len(messages), 5)
+        layout = json.dumps({"session": session, "count": 5, "messages": messages}, ensure_ascii=False, indent=2) + "\n"
+        text = self.export("json")
+        self.assertEqual(text, layout)
+        self.assertEqual(json.loads(text)["messages"], messages)
+        self.assertEqual([json.loads(line) for line in self.export("jsonl").splitlines()], messages)
+        markdown = "# 项目群\n\n- conversation_id: `R:1`\n- messages: 5\n\n" + "".join(
+            f"- {item['time']} · {item['sender']}\n  {item['content'].replace(chr(10), chr(10) + '  ')}\n" for item in messages
+        )
+        self.assertEqual(self.export("markdown"), markdown)
+
+    def test_empty_range_is_valid_output(self):
+        session, messages = self.expected(1_800_000_000)
+        self.assertEqual(messages, [])
+        text = self.export("json", "--start", "2030-01-01")
+        self.assertEqual(text, json.dumps({"session": session, "count": 0, "messages": []}, ensure_ascii=False, indent=2) + "\n")
+        self.assertEqual(json.loads(text)["count"], 0)
+        self.assertEqual(self.export("jsonl", "--start", "2030-01-01"), "")
+        self.assertEqual(self.export("markdown", "--start", "2030-01-01"), "# 项目群\n\n- conversation_id: `R:1`\n- messages: 0\n\n")
+
 
 class ContentTests(unittest.TestCase):
     def test_plain_utf8(self):
@@ -90,6 +359,26 @@ class ContentTests(unittest.TestCase):
         payload = bytes([0x0A, len(text)]) + text
         self.assertEqual(decode_content(payload), "项目进展正常")
 
+    def test_nested_protobuf_skips_digests_and_binary(self):
+        text = "明天\t\t上午\r开会".encode()
+        digest = b"0123456789abcdef" * 2
+        inner = b"\x08\x96\x01" + bytes([0x0A, len(text)]) + text + bytes([0x12, len(digest)]) + digest
+        payload = b"\x08\x96\x01\x11" + bytes(8) + b"\x22\x02\xff\x00" + bytes([0x1A, len(inner)]) + inner
+        self.assertEqual(decode_content(payload), "明天 上午 开会")
+        self.assertEqual(decode_content(payload + b"\x1a\x7f"), "[二进制内容 %d 字节]" % (len(payload) + 2))
+
+    def test_decode_cache_keys_on_digest_and_skips_large_blobs(self):
+        vault_cli._DECODE_CACHE.clear()
+        small = "收到，谢谢".encode()
+        large = "合同已经盖章".encode() * (vault_cli.DECODE_CACHE_MAX_BYTES // 10)
+        self.assertEqual(decode_content(small), "收到，谢谢")
+        self.assertEqual(decode_content(large), large.decode())
+        self.assertEqual(list(vault_cli._DECODE_CACHE), [hashlib.blake2b(small, digest_size=16).digest()])
+        with mock.patch.object(vault_cli, "DECODE_CACHE_ENTRIES", 2):
+            for text in ("甲方", "乙方", "丙方"):
+                decode_content(text.encode())
+        self.assertEqual(len(vault_cli._DECODE_CACHE), 2)
+
 
 if __name__ == "__main__":
     unittest.main(verbosity=2)
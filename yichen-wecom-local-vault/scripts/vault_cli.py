@@ -4,10 +4,17 @@
 from __future__ import annotations
 
 import argparse
+import hashlib
+import heapq
 import json
 import os
 import re
 import sqlite3
+import sys
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import closing
 from datetime import datetime
 from pathlib import Path
 
@@ -20,6 +27,8 @@ from wecom_common import (
     key_for_database,
     latest_snapshot,
     load_key_file,
+    previous_snapshot,
+    source_fingerprint,
     utc_now,
     vault_root,
 )
@@ -39,6 +48,10 @@ TYPE_NAMES = {
     503: "状态",
     1011: "会议通知",
 }
+# Decoded text of small message blobs, keyed by a blake2b digest; larger blobs are decoded every time.
+DECODE_CACHE_ENTRIES = 16384
+DECODE_CACHE_MAX_BYTES = 2048
+_DECODE_CACHE: OrderedDict[bytes, str] = OrderedDict()
 
 
 def connect(path: Path) -> sqlite3.Connection:
@@ -92,10 +105,18 @@ def format_time(value) -> str:
     return datetime.fromtimestamp(stamp).strftime("%Y-%m-%d %H:%M:%S") if stamp > 0 else ""
 
 
-def _read_varint(data: bytes, position: int) -> tuple[int, int]:
+_HEX_DIGEST = re.compile(r"[0-9a-fA-F]{32,}")
+_SPACE_RUN = re.compile(r"[ \t]+")
+_BLANK_LINES = re.compile(r"\n{3,}")
+_CONTROL_CHARS = re.compile(r"[\x00-\x08\x0b-\x1f\x7f-\x9f]")
+_CONTROL_BYTES = bytes(byte for byte in range(32) if byte not in (9, 10, 13))
+
+
+def _read_varint(data: bytes, position: int, end: int | None = None) -> tuple[int, int]:
+    end = len(data) if end is None else end
     value = 0
     shift = 0
-    while position < len(data) and shift < 64:
+    while position < end and shift < 64:
         byte = data[position]
         position += 1
         value |= (byte & 0x7F) << shift
@@ -106,68 +127,82 @@ def _read_varint(data: bytes, position: int) -> tuple[int, int]:
 
 
 def _clean_text(value: str) -> str:
-    value = "".join(character if character in "\n\t" or character.isprintable() else " " for character in value)
-    value = re.sub(r"[ \t]+", " ", value)
-    return re.sub(r"\n{3,}", "\n\n", value).strip()
-
-
-def _protobuf_text(data: bytes, depth: int = 0) -> list[str]:
-    if depth > 4 or not data:
+    if not value.replace("\n", "").replace("\t", "").isprintable():
+        # Nested protobuf bytes usually decode as text with tag/length control bytes.
+        value = _CONTROL_CHARS.sub(" ", value)
+    if not value.replace("\n", "").replace("\t", "").isprintable():
+        value = "".join(character if character in "\n\t" or character.isprintable() else " " for character in value)
+    if "\t" in value or "  " in value:
+        value = _SPACE_RUN.sub(" ", value)
+    if "\n\n\n" in value:
+        value = _BLANK_LINES.sub("\n\n", value)
+    return value.strip()
+
+
+def _protobuf_fields(data: bytes, view: memoryview, position: int, end: int, depth: int) -> list[str]:
+    """Text of length-delimited fields in data[position:end]; nested messages are walked up to depth 4."""
+    if depth > 4 or position >= end:
         return []
-    position = 0
     values: list[str] = []
     try:
-        while position < len(data):
-            tag, position = _read_varint(data, position)
-            wire_type = tag & 7
+        while position < end:
+            tag = data[position]
+            if tag < 0x80:
+                position += 1
+            else:
+                tag, position = _read_varint(data, position, end)
             if tag == 0:
                 return []
-            if wire_type == 0:
-                _, position = _read_varint(data, position)
+            wire_type = tag & 7
+            if wire_type == 2:
+                length = data[position] if position < end else 0x80
+                if length < 0x80:
+                    position += 1
+                elif position + 1 < end and data[position + 1] < 0x80:
+                    length = (length & 0x7F) | data[position + 1] << 7
+                    position += 2
+                else:
+                    length, position = _read_varint(data, position, end)
+                start = position
+                position += length
+                if position > end:
+                    return []
+                text = ""
+                if data.find(b"\x00", start, position) == -1:
+                    try:
+                        text = _clean_text(str(view[start:position], "utf-8"))
+                    except UnicodeDecodeError:
+                        pass
+                if len(text) >= 2 and not _HEX_DIGEST.fullmatch(text):
+                    values.append(text)
+                else:
+                    values.extend(_protobuf_fields(data, view, start, position, depth + 1))
+            elif wire_type == 0:
+                if position < end and data[position] < 0x80:
+                    position += 1
+                else:
+                    _, position = _read_varint(data, position, end)
             elif wire_type == 1:
                 position += 8
             elif wire_type == 5:
                 position += 4
-            elif wire_type == 2:
-                length, position = _read_varint(data, position)
-                if position + length > len(data):
-                    return []
-                segment = data[position : position + length]
-                position += length
-                try:
-                    text = _clean_text(segment.decode("utf-8")) if b"\x00" not in segment else ""
-                except UnicodeDecodeError:
-                    text = ""
-                if len(text) >= 2 and not re.fullmatch(r"[0-9a-fA-F]{32,}", text):
-                    values.append(text)
-                else:
-                    values.extend(_protobuf_text(segment, depth + 1))
             else:
                 return []
-            if position > len(data):
+            if position > end:
                 return []
     except (ValueError, IndexError):
         return []
-    deduped = []
-    seen = set()
-    for value in values:
-        if value and value not in seen:
-            seen.add(value)
-            deduped.append(value)
-    return deduped
+    return list(dict.fromkeys(value for value in values if value))
 
 
-def decode_content(raw) -> str:
-    if raw is None:
-        return ""
-    if isinstance(raw, str):
-        return _clean_text(raw)
-    data = bytes(raw)
-    if not data:
-        return ""
+def _protobuf_text(data: bytes, depth: int = 0) -> list[str]:
+    return _protobuf_fields(data, memoryview(data), 0, len(data), depth)
+
+
+def _decode_bytes(data: bytes) -> str:
     try:
         plain = data.decode("utf-8")
-        controls = sum(1 for byte in data if byte < 32 and byte not in (9, 10, 13))
+        controls = len(data) - len(data.translate(None, _CONTROL_BYTES))
         if controls / len(data) <= 0.08:
             return _clean_text(plain)
     except UnicodeDecodeError:
@@ -178,6 +213,29 @@ def decode_content(raw) -> str:
     return f"[二进制内容 {len(data)} 字节]"
 
 
+def decode_content(raw) -> str:
+    if raw is None:
+        return ""
+    if isinstance(raw, str):
+        return _clean_text(raw)
+    data = bytes(raw)
+    if not data:
+        return ""
+    if len(data) > DECODE_CACHE_MAX_BYTES:
+        return _decode_bytes(data)
+    # Identical blobs (stickers, system notices, forwarded cards) are decoded once per process.
+    digest = hashlib.blake2b(data, digest_size=16).digest()
+    text = _DECODE_CACHE.get(digest)
+    if text is not None:
+        _DECODE_CACHE.move_to_end(digest)
+        return text
+    text = _decode_bytes(data)
+    _DECODE_CACHE[digest] = text
+    if len(_DECODE_CACHE) > DECODE_CACHE_ENTRIES:
+        _DECODE_CACHE.popitem(last=False)
+    return text
+
+
 def load_users(snapshot: Path) -> dict[int, dict]:
     path = snapshot / "user.db"
     users: dict[int, dict] = {}
@@ -277,30 +335,347 @@ def resolve_session(query: str, sessions: dict[str, dict]) -> dict:
     return matches[0]
 
 
+EXPORT_PAGE_SIZE = 2000
+MESSAGE_FIELDS = ("message_id", "server_id", "sequence", "sender_id", "conversation_id", "content_type", "send_time", "flag", "content", "extra_content", "local_extra_content")
+METADATA_CACHE = "metadata.db"
+METADATA_CACHE_VERSION = "1"
+METADATA_CACHE_SCHEMA = """
+CREATE TABLE meta(key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE sessions(position INTEGER PRIMARY KEY, conversation_id TEXT UNIQUE, record TEXT);
+CREATE TABLE users(position INTEGER PRIMARY KEY, user_id INTEGER UNIQUE, display_name TEXT, record TEXT);
+CREATE TABLE members(conversation_id TEXT, user_id INTEGER, nick_name TEXT, PRIMARY KEY(conversation_id, user_id)) WITHOUT ROWID;
+"""
+SEARCH_INDEX = Path("derived") / "search.db"
+SEARCH_INDEX_VERSION = "1"
+SEARCH_INDEX_SCHEMA = """
+CREATE TABLE meta(key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE messages(
+    id INTEGER PRIMARY KEY,
+    source_table TEXT NOT NULL,
+    message_id INTEGER,
+    server_id INTEGER,
+    sequence INTEGER,
+    conversation_id TEXT,
+    sender_id INTEGER,
+    content_type INTEGER,
+    send_time INTEGER,
+    send_ms INTEGER,
+    content TEXT
+);
+"""
+SEARCH_INDEX_INDEXES = """
+CREATE INDEX messages_conversation_time ON messages(conversation_id, send_ms);
+CREATE INDEX messages_time ON messages(send_ms);
+"""
+# Trigram FTS matches arbitrary substrings (CJK included) of three or more characters.
+SEARCH_INDEX_FTS = """
+CREATE VIRTUAL TABLE message_fts USING fts5(content, content='messages', content_rowid='id', tokenize='trigram');
+INSERT INTO message_fts(message_fts) VALUES ('rebuild');
+"""
+
+
+def message_tables(connection: sqlite3.Connection, time_scales: dict[str, int] | None = None):
+    """(table, selectable fields, send_time units per second) for each readable message table."""
+    for table in MESSAGE_TABLES:
+        if not table_exists(connection, table):
+            continue
+        columns = table_columns(connection, table)
+        if not {"conversation_id", "sender_id", "content_type", "send_time"} <= columns:
+            continue
+        time_scale = (time_scales or {}).get(table)
+        if time_scale is None:
+            max_time_row = connection.execute(f'SELECT MAX(send_time) FROM "{table}"').fetchone()
+            time_scale = 1000 if max_time_row and int(max_time_row[0] or 0) > 20_000_000_000 else 1
+        yield table, [name for name in MESSAGE_FIELDS if name in columns], time_scale
+
+
+def _core_signature(snapshot: Path) -> str:
+    signature = {}
+    for name in CORE_NAMES:
+        try:
+            stat = (snapshot / name).stat()
+            signature[name] = [stat.st_size, stat.st_mtime_ns]
+        except OSError:
+            signature[name] = None
+    return json.dumps(signature, sort_keys=True)
+
+
+def _fill_metadata(cache: sqlite3.Connection, snapshot: Path) -> dict:
+    time_scales = {}
+    if (snapshot / "message.db").exists():
+        with connect(snapshot / "message.db") as connection:
+            time_scales = {table: time_scale for table, _, time_scale in message_tables(connection)}
+    sessions = load_sessions(snapshot)
+    users = load_users(snapshot)
+    members = load_member_names(snapshot)
+    cache.executescript(METADATA_CACHE_SCHEMA)
+    cache.executemany("INSERT INTO sessions(conversation_id, record) VALUES (?, ?)", ((cid, json.dumps(item, ensure_ascii=False)) for cid, item in sessions.items()))
+    cache.executemany(
+        "INSERT INTO users(user_id, display_name, record) VALUES (?, ?, ?)",
+        ((user_id, item.get("display_name"), json.dumps(item, ensure_ascii=False)) for user_id, item in users.items()),
+    )
+    cache.executemany("INSERT INTO members VALUES (?, ?, ?)", ((cid, user_id, name) for cid, names in members.items() for user_id, name in names.items()))
+    cache.executemany(
+        "INSERT INTO meta VALUES (?, ?)",
+        [("version", METADATA_CACHE_VERSION), ("signature", _core_signature(snapshot)), ("time_scales", json.dumps(time_scales))],
+    )
+    cache.commit()
+    return {"sessions": len(sessions), "users": len(users), "members": sum(map(len, members.values()))}
+
+
+def build_metadata_cache(snapshot: Path) -> dict:
+    """Scan session.db, user.db and the message tables once into metadata.db next to manifest.json."""
+    path = snapshot / METADATA_CACHE
+    partial = path.with_name(path.name + ".partial")
+    if partial.exists():
+        partial.unlink()
+    cache = sqlite3.connect(partial)
+    os.chmod(partial, 0o600)
+    try:
+        counts = _fill_metadata(cache, snapshot)
+    finally:
+        cache.close()
+    os.replace(partial, path)
+    return counts
+
+
+def open_metadata(snapshot: Path) -> sqlite3.Connection:
+    """Snapshot metadata cache: sessions, users, member names and per-table time scales.
+
+    Snapshots are never modified after decrypt, so metadata.db stays valid as long
+    as the core databases keep their size and mtime; otherwise it is rebuilt. A
+    snapshot that cannot be written to gets an in-memory copy for this process.
+    """
+    path = snapshot / METADATA_CACHE
+    for attempt in range(2):
+        if path.is_file():
+            connection = connect(path)
+            try:
+                meta = dict(connection.execute("SELECT key, value FROM meta").fetchall())
+                if meta.get("version") == METADATA_CACHE_VERSION and meta.get("signature") == _core_signature(snapshot):
+                    return connection
+            except sqlite3.Error:
+                pass
+            connection.close()
+        if attempt == 0:
+            try:
+                build_metadata_cache(snapshot)
+            except (OSError, sqlite3.Error):
+                break
+    connection = sqlite3.connect(":memory:")
+    connection.row_factory = sqlite3.Row
+    _fill_metadata(connection, snapshot)
+    return connection
+
+
+def metadata_time_scales(cache: sqlite3.Connection) -> dict[str, int]:
+    return json.loads(cache.execute("SELECT value FROM meta WHERE key='time_scales'").fetchone()[0])
+
+
+def metadata_sessions(cache: sqlite3.Connection) -> dict[str, dict]:
+    return {row[0]: json.loads(row[1]) for row in cache.execute("SELECT conversation_id, record FROM sessions ORDER BY position")}
+
+
+def metadata_users(cache: sqlite3.Connection) -> dict[int, dict]:
+    return {row[0]: json.loads(row[1]) for row in cache.execute("SELECT user_id, record FROM users ORDER BY position")}
+
+
+def _chunks(values: list, size: int = 500):
+    for index in range(0, len(values), size):
+        yield values[index : index + size]
+
+
+def metadata_names(cache: sqlite3.Connection, pairs: set[tuple[str, int]]) -> tuple[dict, dict, dict]:
+    """(sessions, users, members) restricted to the conversations and senders in `pairs`."""
+    sessions: dict[str, dict] = {}
+    users: dict[int, dict] = {}
+    members: dict[str, dict[int, str]] = {}
+    for chunk in _chunks(sorted({cid for cid, _ in pairs})):
+        marks = ",".join("?" * len(chunk))
+        for row in cache.execute(f"SELECT conversation_id, record FROM sessions WHERE conversation_id IN ({marks})", chunk):
+            sessions[row[0]] = json.loads(row[1])
+    for chunk in _chunks(sorted({user_id for _, user_id in pairs})):
+        marks = ",".join("?" * len(chunk))
+        for row in cache.execute(f"SELECT user_id, display_name FROM users WHERE user_id IN ({marks})", chunk):
+            users[row[0]] = {"display_name": row[1]}
+    for cid, user_id in pairs:
+        row = cache.execute("SELECT nick_name FROM members WHERE conversation_id=? AND user_id=?", (cid, user_id)).fetchone()
+        if row:
+            members.setdefault(cid, {})[user_id] = row[0]
+    return sessions, users, members
+
+
+def display_content(item: dict) -> str:
+    content = decode_content(item.get("content")) or decode_content(item.get("extra_content")) or decode_content(item.get("local_extra_content"))
+    content_type = int(item.get("content_type") or 0)
+    return content or f"[{TYPE_NAMES.get(content_type, f'未知类型 {content_type}')}]"
+
+
+def message_record(table: str, item: dict, content: str, sessions: dict, users: dict, members: dict) -> dict:
+    cid = str(item.get("conversation_id") or "")
+    sender_id = int(item.get("sender_id") or 0)
+    content_type = int(item.get("content_type") or 0)
+    return {
+        "source_table": table,
+        "message_id": int(item.get("message_id") or 0),
+        "server_id": int(item.get("server_id") or 0),
+        "sequence": int(item.get("sequence") or 0),
+        "conversation_id": cid,
+        "conversation": sessions.get(cid, {}).get("display_name") or cid,
+        "sender_id": sender_id,
+        "sender": members.get(cid, {}).get(sender_id) or users.get(sender_id, {}).get("display_name") or (str(sender_id) if sender_id else "系统"),
+        "content_type": content_type,
+        "type_name": TYPE_NAMES.get(content_type, f"未知({content_type})"),
+        "send_time": int(item.get("send_time") or 0),
+        "time": format_time(item.get("send_time")),
+        "content": content,
+    }
+
+
+def build_search_index(snapshot: Path) -> dict:
+    """Decode every message of the snapshot once into derived/search.db (FTS5 + time indexes)."""
+    started = time.perf_counter()
+    path = snapshot / SEARCH_INDEX
+    path.parent.mkdir(parents=True, exist_ok=True)
+    os.chmod(path.parent, 0o700)
+    partial = path.with_name(path.name + ".partial")
+    if partial.exists():
+        partial.unlink()
+    index = sqlite3.connect(partial)
+    os.chmod(partial, 0o600)
+    count = 0
+    try:
+        index.executescript(SEARCH_INDEX_SCHEMA)
+        with connect(snapshot / "message.db") as connection:
+            for table, fields, time_scale in message_tables(connection):
+                rows = []
+                for row in connection.execute(f'SELECT {",".join(fields)} FROM "{table}"'):
+                    item = dict(row)
+                    send_time = int(item.get("send_time") or 0)
+                    rows.append((
+                        table,
+                        int(item.get("message_id") or 0),
+                        int(item.get("server_id") or 0),
+                        int(item.get("sequence") or 0),
+                        str(item.get("conversation_id") or ""),
+                        int(item.get("sender_id") or 0),
+                        int(item.get("content_type") or 0),
+                        send_time,
+                        send_time * (1000 // time_scale),
+                        display_content(item),
+                    ))
+                    if len(rows) >= 5000:
+                        count += len(rows)
+                        index.executemany("INSERT INTO messages(source_table,message_id,server_id,sequence,conversation_id,sender_id,content_type,send_time,send_ms,content) VALUES (?,?,?,?,?,?,?,?,?,?)", rows)
+                        rows = []
+                count += len(rows)
+                index.executemany("INSERT INTO messages(source_table,message_id,server_id,sequence,conversation_id,sender_id,content_type,send_time,send_ms,content) VALUES (?,?,?,?,?,?,?,?,?,?)", rows)
+        index.executescript(SEARCH_INDEX_INDEXES)
+        try:
+            index.executescript(SEARCH_INDEX_FTS)
+            fts = "1"
+        except sqlite3.OperationalError:
+            # SQLite without FTS5/trigram: keyword search falls back to LIKE over the same table.
+            fts = "0"
+        index.executemany("INSERT INTO meta(key, value) VALUES (?, ?)", [("version", SEARCH_INDEX_VERSION), ("fts", fts), ("messages", str(count))])
+        index.commit()
+    finally:
+        index.close()
+    os.replace(partial, path)
+    return {"status": "ok", "messages": count, "fts": fts == "1", "seconds": round(time.perf_counter() - started, 3)}
+
+
+def open_search_index(snapshot: Path) -> tuple[sqlite3.Connection, bool] | None:
+    """(connection, fts available) for a finished search index of the current version, else None."""
+    path = snapshot / SEARCH_INDEX
+    if not path.is_file():
+        return None
+    connection = connect(path)
+    try:
+        meta = dict(connection.execute("SELECT key, value FROM meta").fetchall())
+    except sqlite3.Error:
+        connection.close()
+        return None
+    if meta.get("version") != SEARCH_INDEX_VERSION:
+        connection.close()
+        return None
+    return connection, meta.get("fts") == "1"
+
+
+def indexed_messages(connection: sqlite3.Connection, fts: bool, conversation_id: str | None, start: int | None, end: int | None, keyword: str | None, limit: int) -> list[dict]:
+    clauses = []
+    params: list = []
+    if conversation_id:
+        clauses.append("conversation_id=?")
+        params.append(conversation_id)
+    if start is not None:
+        clauses.append("send_ms>=?")
+        params.append(start * 1000)
+    if end is not None:
+        clauses.append("send_ms<=?")
+        params.append(end * 1000)
+    if keyword and fts and len(keyword) >= 3:
+        clauses.append("id IN (SELECT rowid FROM message_fts WHERE message_fts MATCH ?)")
+        params.append('"' + keyword.replace('"', '""') + '"')
+    elif keyword:
+        clauses.append("content LIKE ? ESCAPE '\\'")
+        params.append("%" + re.sub(r"([\\%_])", r"\\\1", keyword) + "%")
+    where = " WHERE " + " AND ".join(clauses) if clauses else ""
+    sql = f"SELECT * FROM messages{where} ORDER BY send_ms DESC, sequence DESC, message_id DESC"
+    lowered = keyword.lower() if keyword else None
+    rows = []
+    for row in connection.execute(sql, params):
+        # FTS and LIKE fold case slightly differently from str.lower(); keep the CLI's definition.
+        if lowered and lowered not in row["content"].lower():
+            continue
+        rows.append(dict(row))
+        if len(rows) >= limit:
+            break
+    rows.reverse()
+    return rows
+
+
+def _sort_key(item: dict) -> tuple[int, int, int]:
+    return int(item.get("send_time") or 0), int(item.get("sequence") or 0), int(item.get("message_id") or 0)
+
+
 def iter_messages(snapshot: Path, conversation_id: str | None, start: int | None, end: int | None, keyword: str | None, limit: int) -> list[dict]:
     path = snapshot / "message.db"
     if not path.exists():
         raise SystemExit(f"快照缺少 message.db: {snapshot}")
-    sessions = load_sessions(snapshot)
-    users = load_users(snapshot)
-    members = load_member_names(snapshot)
-    messages = []
+    cache = open_metadata(snapshot)
+    try:
+        opened = open_search_index(snapshot)
+        if opened is not None:
+            connection, fts = opened
+            try:
+                rows = indexed_messages(connection, fts, conversation_id, start, end, keyword, limit)
+            finally:
+                connection.close()
+            found = [(row["source_table"], row, row["content"]) for row in rows]
+        else:
+            found = scan_messages(path, metadata_time_scales(cache), conversation_id, start, end, keyword, limit)
+        pairs = {(str(item.get("conversation_id") or ""), int(item.get("sender_id") or 0)) for _, item, _ in found}
+        sessions, users, members = metadata_names(cache, pairs)
+    finally:
+        cache.close()
+    return [message_record(table, item, content, sessions, users, members) for table, item, content in found]
+
+
+def scan_messages(path: Path, time_scales: dict[str, int], conversation_id: str | None, start: int | None, end: int | None, keyword: str | None, limit: int) -> list[tuple[str, dict, str]]:
+    """Fallback for snapshots without derived/search.db (older ones, or `index` never run).
+
+    Only the newest rows of each table are scanned, so keyword matches beyond
+    the scan window are missed.
+    """
+    found = []
     with connect(path) as connection:
-        for table in MESSAGE_TABLES:
-            if not table_exists(connection, table):
-                continue
-            columns = table_columns(connection, table)
-            required = {"conversation_id", "sender_id", "content_type", "send_time"}
-            if not required <= columns:
-                continue
-            fields = [name for name in ("message_id", "server_id", "sequence", "sender_id", "conversation_id", "content_type", "send_time", "flag", "content", "extra_content", "local_extra_content") if name in columns]
+        for table, fields, time_scale in message_tables(connection, time_scales):
             clauses = []
             params = []
             if conversation_id:
                 clauses.append("conversation_id=?")
                 params.append(conversation_id)
-            max_time_row = connection.execute(f'SELECT MAX(send_time) FROM "{table}"').fetchone()
-            time_scale = 1000 if max_time_row and int(max_time_row[0] or 0) > 20_000_000_000 else 1
             if start is not None:
                 clauses.append("send_time>=?")
                 params.append(start * time_scale)
@@ -313,30 +688,124 @@ def iter_messages(snapshot: Path, conversation_id: str | None, start: int | None
             params.append(scan_limit)
             for row in connection.execute(sql, params):
                 item = dict(row)
-                cid = str(item.get("conversation_id") or "")
-                sender_id = int(item.get("sender_id") or 0)
-                content = decode_content(item.get("content")) or decode_content(item.get("extra_content")) or decode_content(item.get("local_extra_content"))
-                content_type = int(item.get("content_type") or 0)
-                display_content = content or f"[{TYPE_NAMES.get(content_type, f'未知类型 {content_type}')}]"
-                if keyword and keyword.lower() not in display_content.lower():
+                content = display_content(item)
+                if keyword and keyword.lower() not in content.lower():
                     continue
-                messages.append({
-                    "source_table": table,
-                    "message_id": int(item.get("message_id") or 0),
-                    "server_id": int(item.get("server_id") or 0),
-                    "sequence": int(item.get("sequence") or 0),
-                    "conversation_id": cid,
-                    "conversation": sessions.get(cid, {}).get("display_name") or cid,
-                    "sender_id": sender_id,
-                    "sender": members.get(cid, {}).get(sender_id) or users.get(sender_id, {}).get("display_name") or (str(sender_id) if sender_id else "系统"),
-                    "content_type": content_type,
-                    "type_name": TYPE_NAMES.get(content_type, f"未知({content_type})"),
-                    "send_time": int(item.get("send_time") or 0),
-                    "time": format_time(item.get("send_time")),
-                    "content": display_content,
-                })
-    messages.sort(key=lambda item: (item["send_time"], item["sequence"], item["message_id"]))
-    return messages[-limit:]
+                found.append((table, item, content))
+    found.sort(key=lambda entry: _sort_key(entry[1]))
+    return found[-limit:]
+
+
+def _range_clauses(column: str, conversation_id: str | None, start: int | None, end: int | None, scale: int) -> tuple[list[str], list]:
+    clauses, params = [], []
+    if conversation_id:
+        clauses.append("conversation_id=?")
+        params.append(conversation_id)
+    if start is not None:
+        clauses.append(f"{column}>=?")
+        params.append(start * scale)
+    if end is not None:
+        clauses.append(f"{column}<=?")
+        params.append(end * scale)
+    return clauses, params
+
+
+def _keyset_pages(connection: sqlite3.Connection, select: str, keys: list[str], clauses: list[str], params: list, page_size: int):
+    """Rows of `select` ordered by `keys`, fetched a page at a time and resumed after the last row seen.
+
+    `select` must end with the key expressions so each row carries its own cursor.
+    """
+    order = ", ".join(keys)
+    cursor = None
+    while True:
+        where = clauses + ([f"({order}) > ({','.join('?' * len(keys))})"] if cursor else [])
+        sql = f"{select}{' WHERE ' + ' AND '.join(where) if where else ''} ORDER BY {order} LIMIT ?"
+        rows = connection.execute(sql, [*params, *(cursor or ()), page_size]).fetchall()
+        if not rows:
+            return
+        yield from rows
+        cursor = tuple(rows[-1])[-len(keys):]
+
+
+def count_messages(snapshot: Path, cache: sqlite3.Connection, conversation_id: str | None, start: int | None, end: int | None) -> int:
+    opened = open_search_index(snapshot)
+    if opened is not None:
+        connection = opened[0]
+        try:
+            clauses, params = _range_clauses("send_ms", conversation_id, start, end, 1000)
+            where = " WHERE " + " AND ".join(clauses) if clauses else ""
+            return connection.execute(f"SELECT COUNT(*) FROM messages{where}", params).fetchone()[0]
+        finally:
+            connection.close()
+    total = 0
+    with closing(connect(snapshot / "message.db")) as connection:
+        for table, _, time_scale in message_tables(connection, metadata_time_scales(cache)):
+            clauses, params = _range_clauses("send_time", conversation_id, start, end, time_scale)
+            where = " WHERE " + " AND ".join(clauses) if clauses else ""
+            total += connection.execute(f'SELECT COUNT(*) FROM "{table}"{where}', params).fetchone()[0]
+    return total
+
+
+def stream_messages(snapshot: Path, cache: sqlite3.Connection, conversation_id: str | None, start: int | None, end: int | None, page_size: int = EXPORT_PAGE_SIZE):
+    """(table, row, content) for every matching message in (send_time, sequence, message_id) order.
+
+    Only one page per message table is held in memory. With derived/search.db the
+    merged, decoded messages table is paged directly; otherwise each source table
+    is paged by its own cursor and the three streams are merged with heapq.
+    """
+    opened = open_search_index(snapshot)
+    if opened is not None:
+        connection = opened[0]
+        try:
+            clauses, params = _range_clauses("send_ms", conversation_id, start, end, 1000)
+            keys = ["send_ms", "sequence", "message_id", "id"]
+            for row in _keyset_pages(connection, f"SELECT *, {', '.join(keys)} FROM messages", keys, clauses, params, page_size):
+                item = dict(row)
+                yield item["source_table"], item, item["content"]
+        finally:
+            connection.close()
+        return
+
+    def table_stream(connection: sqlite3.Connection, table: str, fields: list[str], time_scale: int):
+        clauses, params = _range_clauses("send_time", conversation_id, start, end, time_scale)
+        tail = [
+            "IFNULL(sequence, 0)" if "sequence" in fields else "0",
+            "IFNULL(message_id, 0)" if "message_id" in fields else "0",
+            "rowid",
+        ]
+        passes = [(["send_time IS NOT NULL"], ["send_time", *tail])]
+        if start is None and end is None:
+            # NULL never compares greater than a cursor, so rows without a send_time go first on their own.
+            passes.insert(0, (["send_time IS NULL"], tail))
+        for extra, keys in passes:
+            select = f'SELECT {",".join(fields)}, {", ".join(keys)} FROM "{table}"'
+            for row in _keyset_pages(connection, select, keys, clauses + extra, params, page_size):
+                item = dict(zip(fields, row))
+                yield (int(item.get("send_time") or 0) * (1000 // time_scale), int(row[-3]), int(row[-2])), table, item
+
+    with closing(connect(snapshot / "message.db")) as connection:
+        streams = [table_stream(connection, *spec) for spec in message_tables(connection, metadata_time_scales(cache))]
+        for _, table, item in heapq.merge(*streams, key=lambda entry: entry[0]):
+            yield table, item, display_content(item)
+
+
+def iter_message_records(snapshot: Path, conversation_id: str | None, start: int | None, end: int | None):
+    """Stream full message records; names are looked up once per new (conversation, sender) pair."""
+    sessions: dict[str, dict] = {}
+    users: dict[int, dict] = {}
+    members: dict[str, dict[int, str]] = {}
+    seen: set[tuple[str, int]] = set()
+    with closing(open_metadata(snapshot)) as cache:
+        for table, item, content in stream_messages(snapshot, cache, conversation_id, start, end):
+            pair = (str(item["conversation_id"] or ""), int(item["sender_id"] or 0))
+            if pair not in seen:
+                seen.add(pair)
+                found_sessions, found_users, found_members = metadata_names(cache, {pair})
+                sessions.update(found_sessions)
+                users.update(found_users)
+                for cid, names in found_members.items():
+                    members.setdefault(cid, {}).update(names)
+            yield message_record(table, item, content, sessions, users, members)
 
 
 def command_discover(args) -> None:
@@ -367,46 +836,198 @@ def decrypt_dataset(explicit: str | None, keys: dict) -> Path:
     return choose_dataset(None)
 
 
+def source_bytes(source: Path, apply_wal: bool) -> int:
+    wal_path = Path(str(source) + "-wal")
+    return source.stat().st_size + (wal_path.stat().st_size if apply_wal and wal_path.exists() else 0)
+
+
+def reusable_results(base: Path | None) -> dict[str, dict]:
+    if base is None:
+        return {}
+    with (base / "manifest.json").open(encoding="utf-8") as handle:
+        manifest = json.load(handle)
+    return {
+        item["database"]: item
+        for item in manifest.get("results", [])
+        if item.get("status") == "ok" and item.get("source_fingerprint") and (base / item["database"]).is_file()
+    }
+
+
+def reuse_one(relative: Path, base: Path, target: Path, previous: dict, fingerprint: dict) -> dict | None:
+    """Hard-link an unchanged plaintext database from the previous snapshot."""
+    target.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        os.link(base / relative, target)
+    except OSError:
+        return None
+    kept = {key: value for key, value in previous.items() if key not in ("seconds", "mb_per_s", "reused_from")}
+    return {**kept, "status": "ok", "source_fingerprint": fingerprint, "reused_from": base.name}
+
+
+def decrypt_one(relative: Path, source: Path, target: Path, key: bytes | None, apply_wal: bool, fingerprint: dict | None = None) -> dict:
+    started = time.perf_counter()
+    size = source_bytes(source, apply_wal)
+    with source.open("rb") as handle:
+        kind = database_format(handle.read(PAGE_SIZE))
+    if kind == "wecom-wxsqlite3-aes128" and key is None:
+        return {"database": str(relative), "status": "skipped", "reason": "missing key"}
+    try:
+        details = decrypt_database(source, target, key or bytes(16), apply_wal=apply_wal)
+    except Exception as exc:
+        return {"database": str(relative), "status": "failed", "reason": str(exc)}
+    elapsed = time.perf_counter() - started
+    return {
+        "database": str(relative),
+        "status": "ok",
+        **details,
+        "bytes": size,
+        "seconds": round(elapsed, 3),
+        "mb_per_s": round(size / 1_000_000 / elapsed, 1) if elapsed > 0 else None,
+        "source_fingerprint": fingerprint,
+    }
+
+
+def write_manifest(destination: Path, manifest: dict, *, final: bool) -> Path:
+    """Rewrite the in-progress manifest atomically; the final one is created exactly once."""
+    partial_path = destination / "manifest.json.partial"
+    if not final:
+        staging = destination / "manifest.json.tmp"
+        with staging.open("w", encoding="utf-8") as handle:
+            json.dump(manifest, handle, ensure_ascii=False, indent=2)
+            handle.write("\n")
+        os.chmod(staging, 0o600)
+        os.replace(staging, partial_path)
+        return partial_path
+    manifest_path = destination / "manifest.json"
+    with manifest_path.open("x", encoding="utf-8") as handle:
+        json.dump(manifest, handle, ensure_ascii=False, indent=2)
+        handle.write("\n")
+    os.chmod(manifest_path, 0o600)
+    if partial_path.exists():
+        partial_path.unlink()
+    return manifest_path
+
+
+def snapshot_search_index(destination: Path, base: Path | None, results: list[dict]) -> dict:
+    """Build derived/search.db for a new snapshot, or hard-link the base one when message.db was reused."""
+    message = next((item for item in results if item["database"] == "message.db"), None)
+    if message is None or message["status"] != "ok":
+        return {"status": "skipped", "reason": "message.db not decrypted"}
+    if message.get("reused_from") and base is not None:
+        opened = open_search_index(base)
+        if opened is not None:
+            opened[0].close()
+            target = destination / SEARCH_INDEX
+            target.parent.mkdir(parents=True, exist_ok=True)
+            os.chmod(target.parent, 0o700)
+            try:
+                os.link(base / SEARCH_INDEX, target)
+                return {"status": "ok", "reused_from": base.name}
+            except OSError:
+                pass
+    try:
+        return build_search_index(destination)
+    except sqlite3.Error as exc:
+        return {"status": "failed", "reason": str(exc)}
+
+
 def command_decrypt(args) -> None:
+    if args.jobs < 1:
+        raise SystemExit("--jobs 必须大于 0")
     keys = load_key_file(Path(args.key_file).expanduser() if args.key_file else None)
     dataset = decrypt_dataset(args.data_dir, keys)
     stamp = datetime.now().astimezone().strftime("%Y%m%d-%H%M%S-%f")
     destination = vault_root() / "snapshots" / f"{stamp}-{dataset_id(dataset)}"
     destination.mkdir(parents=True, exist_ok=False)
     os.chmod(destination, 0o700)
+    apply_wal = not args.no_wal
+    # Largest first so the big message.db starts early instead of becoming the tail.
+    databases = sorted(iter_databases(dataset), key=lambda item: source_bytes(item[1], apply_wal), reverse=True)
+    base = previous_snapshot(dataset_id(dataset)) if args.incremental else None
+    previous = reusable_results(base)
     results = []
-    for relative, source in iter_databases(dataset):
-        with source.open("rb") as handle:
-            kind = database_format(handle.read(PAGE_SIZE))
-        key = key_for_database(keys, relative)
-        if kind == "wecom-wxsqlite3-aes128" and key is None:
-            results.append({"database": str(relative), "status": "skipped", "reason": "missing key"})
-            continue
-        try:
-            details = decrypt_database(source, destination / relative, key or bytes(16), apply_wal=not args.no_wal)
-            results.append({"database": str(relative), "status": "ok", **details})
-        except Exception as exc:
-            results.append({"database": str(relative), "status": "failed", "reason": str(exc)})
     manifest = {
         "version": 1,
         "created_at": utc_now(),
         "dataset_id": dataset_id(dataset),
         "contains_plaintext_wecom_data": True,
-        "wal_merge_enabled": not args.no_wal,
+        "wal_merge_enabled": apply_wal,
+        "jobs": args.jobs,
+        "incremental": args.incremental,
+        "base_snapshot": base.name if base else None,
         "results": results,
     }
-    manifest_path = destination / "manifest.json"
-    with manifest_path.open("x", encoding="utf-8") as handle:
-        json.dump(manifest, handle, ensure_ascii=False, indent=2)
-        handle.write("\n")
-    os.chmod(manifest_path, 0o600)
+    started = time.perf_counter()
+
+    def record(result: dict) -> None:
+        results.append(result)
+        write_manifest(destination, manifest, final=False)
+        rate = f" {result['mb_per_s']} MB/s" if result.get("mb_per_s") is not None else ""
+        print(f"[{len(results)}/{len(databases)}] {result['database']} {result['status']}{rate}", file=sys.stderr)
+
+    tasks = []
+    for relative, source in databases:
+        key = key_for_database(keys, relative)
+        fingerprint = source_fingerprint(source, key, apply_wal)
+        earlier = previous.get(str(relative))
+        if earlier and earlier["source_fingerprint"] == fingerprint:
+            reused = reuse_one(relative, base, destination / relative, earlier, fingerprint)
+            if reused:
+                record(reused)
+                continue
+        tasks.append((relative, source, destination / relative, key, apply_wal, fingerprint))
+    if args.jobs == 1:
+        for task in tasks:
+            record(decrypt_one(*task))
+    else:
+        with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+            for future in as_completed([pool.submit(decrypt_one, *task) for task in tasks]):
+                record(future.result())
+
+    elapsed = time.perf_counter() - started
+    manifest["search_index"] = snapshot_search_index(destination, base, results)
+    try:
+        manifest["metadata_cache"] = {"status": "ok", **build_metadata_cache(destination)}
+    except (OSError, sqlite3.Error) as exc:
+        manifest["metadata_cache"] = {"status": "failed", "reason": str(exc)}
+    print(f"search index {manifest['search_index']['status']}", file=sys.stderr)
+    total_bytes = sum(item.get("bytes", 0) for item in results if item["status"] == "ok" and not item.get("reused_from"))
+    manifest["reused_databases"] = sorted(item["database"] for item in results if item.get("reused_from"))
+    manifest["total_bytes"] = total_bytes
+    manifest["elapsed_seconds"] = round(elapsed, 3)
+    manifest["mb_per_s"] = round(total_bytes / 1_000_000 / elapsed, 1) if elapsed > 0 else None
+    manifest_path = write_manifest(destination, manifest, final=True)
     failed = [item for item in results if item["status"] != "ok"]
-    output({"snapshot": str(destination), "decrypted": len(results) - len(failed), "not_decrypted": len(failed), "manifest": str(manifest_path)})
+    output({
+        "snapshot": str(destination),
+        "decrypted": len(results) - len(failed) - len(manifest["reused_databases"]),
+        "reused": len(manifest["reused_databases"]),
+        "not_decrypted": len(failed),
+        "search_index": manifest["search_index"]["status"],
+        "manifest": str(manifest_path),
+    })
+
+
+def command_index(args) -> None:
+    snapshot = snapshot_path(args.snapshot)
+    if not (snapshot / "message.db").exists():
+        raise SystemExit(f"快照缺少 message.db: {snapshot}")
+    opened = None if args.rebuild else open_search_index(snapshot)
+    if opened is not None:
+        connection, fts = opened
+        try:
+            count = connection.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+        finally:
+            connection.close()
+        output({"snapshot": str(snapshot), "status": "exists", "messages": count, "fts": fts})
+        return
+    output({"snapshot": str(snapshot), **build_search_index(snapshot)})
 
 
 def command_sessions(args) -> None:
     snapshot = snapshot_path(args.snapshot)
-    sessions = list(load_sessions(snapshot).values())
+    with closing(open_metadata(snapshot)) as cache:
+        sessions = list(metadata_sessions(cache).values())
     sessions.sort(key=lambda item: item["last_message_time"], reverse=True)
     if args.query:
         query = args.query.lower()
@@ -415,7 +1036,8 @@ def command_sessions(args) -> None:
 
 
 def command_contacts(args) -> None:
-    users = list(load_users(snapshot_path(args.snapshot)).values())
+    with closing(open_metadata(snapshot_path(args.snapshot))) as cache:
+        users = list(metadata_users(cache).values())
     if args.query:
         query = args.query.lower()
         users = [item for item in users if query in str(item.get("display_name", "")).lower() or query in str(item.get("account", "")).lower()]
@@ -425,7 +1047,10 @@ def command_contacts(args) -> None:
 
 def messages_for_args(args) -> tuple[dict | None, list[dict]]:
     snapshot = snapshot_path(args.snapshot)
-    session = resolve_session(args.chat, load_sessions(snapshot)) if getattr(args, "chat", None) else None
+    session = None
+    if getattr(args, "chat", None):
+        with closing(open_metadata(snapshot)) as cache:
+            session = resolve_session(args.chat, metadata_sessions(cache))
     messages = iter_messages(
         snapshot,
         session["conversation_id"] if session else None,
@@ -452,11 +1077,54 @@ def safe_name(value: str) -> str:
     return value[:100] or "wecom-export"
 
 
+EXPORT_SUFFIXES = {"markdown": "md", "json": "json", "jsonl": "jsonl"}
+
+
+def write_export(handle, fmt: str, session: dict, count: int, messages) -> int:
+    """Write messages one at a time as they arrive; returns how many were written."""
+    written = 0
+
+    def progress() -> None:
+        if written % 10000 == 0 or written == count:
+            print(f"[{written}/{count}] exported", file=sys.stderr)
+
+    if fmt == "markdown":
+        handle.write(f"# {session['display_name']}\n\n")
+        handle.write(f"- conversation_id: `{session['conversation_id']}`\n- messages: {count}\n\n")
+    elif fmt == "json":
+        # Same layout as json.dump(..., indent=2) of {"session", "count", "messages"}.
+        head = json.dumps({"session": session, "count": count}, ensure_ascii=False, indent=2)
+        handle.write(head[:-2] + ',\n  "messages": [')
+    for message in messages:
+        if fmt == "markdown":
+            content = message["content"].replace("\n", "\n  ")
+            handle.write(f"- {message['time']} · {message['sender']}\n  {content}\n")
+        elif fmt == "json":
+            item = json.dumps(message, ensure_ascii=False, indent=2).replace("\n", "\n    ")
+            handle.write(("," if written else "") + "\n    " + item)
+        else:
+            handle.write(json.dumps(message, ensure_ascii=False) + "\n")
+        written += 1
+        progress()
+    if fmt == "json":
+        handle.write("\n  ]\n}\n" if written else "]\n}\n")
+    return written
+
+
 def command_export(args) -> None:
-    session, messages = messages_for_args(args)
+    snapshot = snapshot_path(args.snapshot)
+    if args.all:
+        start, end = parse_time(args.start), parse_time(args.end)
+        with closing(open_metadata(snapshot)) as cache:
+            session = resolve_session(args.chat, metadata_sessions(cache))
+            count = count_messages(snapshot, cache, session["conversation_id"], start, end)
+        messages = iter_message_records(snapshot, session["conversation_id"], start, end)
+    else:
+        session, messages = messages_for_args(args)
+        count = len(messages)
     if session is None:
         raise SystemExit("export 需要指定会话")
-    suffix = "json" if args.format == "json" else "md"
+    suffix = EXPORT_SUFFIXES[args.format]
     if args.output:
         destination = Path(args.output).expanduser()
     else:
@@ -465,19 +1133,10 @@ def command_export(args) -> None:
     if destination.exists():
         raise SystemExit(f"拒绝覆盖已有文件: {destination}")
     destination.parent.mkdir(parents=True, exist_ok=True)
-    if args.format == "json":
-        with destination.open("x", encoding="utf-8") as handle:
-            json.dump({"session": session, "count": len(messages), "messages": messages}, handle, ensure_ascii=False, indent=2)
-            handle.write("\n")
-    else:
-        with destination.open("x", encoding="utf-8") as handle:
-            handle.write(f"# {session['display_name']}\n\n")
-            handle.write(f"- conversation_id: `{session['conversation_id']}`\n- messages: {len(messages)}\n\n")
-            for message in messages:
-                content = message["content"].replace("\n", "\n  ")
-                handle.write(f"- {message['time']} · {message['sender']}\n  {content}\n")
-    os.chmod(destination, 0o600)
-    output({"output": str(destination), "messages": len(messages), "contains_plaintext_wecom_data": True})
+    with destination.open("x", encoding="utf-8") as handle:
+        os.chmod(destination, 0o600)
+        written = write_export(handle, args.format, session, count, messages)
+    output({"output": str(destination), "messages": written, "contains_plaintext_wecom_data": True})
 
 
 def add_message_filters(parser, *, chat_required: bool) -> None:
@@ -506,8 +1165,15 @@ def main() -> int:
     command.add_argument("--data-dir")
     command.add_argument("--key-file")
     command.add_argument("--no-wal", action="store_true")
+    command.add_argument("--jobs", type=int, default=1, help="并行解密进程数；按库大小从大到小调度")
+    command.add_argument("--incremental", action="store_true", help="源库与 WAL 未变化时硬链接上一个快照的明文库")
     command.set_defaults(func=command_decrypt)
 
+    command = sub.add_parser("index", help="为已有快照建立消息全文/时间索引 derived/search.db")
+    command.add_argument("--snapshot")
+    command.add_argument("--rebuild", action="store_true")
+    command.set_defaults(func=command_index)
+
     command = sub.add_parser("sessions", help="列出会话")
     command.add_argument("--snapshot")
     command.add_argument("--query")
@@ -531,8 +1197,9 @@ def main() -> int:
 
     command = sub.add_parser("export", help="导出指定会话")
     add_message_filters(command, chat_required=True)
-    command.add_argument("--format", choices=("markdown", "json"), default="markdown")
+    command.add_argument("--format", choices=tuple(EXPORT_SUFFIXES), default="markdown", help="jsonl 每行一条消息")
     command.add_argument("--output")
+    command.add_argument("--all", action="store_true", help="按时间游标流式导出范围内全部消息，忽略 --limit，内存占用恒定")
     command.set_defaults(func=command_export)
 
     args = parser.parse_args()
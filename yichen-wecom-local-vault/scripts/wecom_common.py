@@ -9,7 +9,7 @@ import os
 from datetime import datetime
 from pathlib import Path
 
-from wecom_crypto import PAGE_SIZE, database_format, verify_key
+from wecom_crypto import PAGE_SIZE, database_format, page_one_header_matches, verify_key
 
 
 CONFIG_PATH = Path("~/.config/wecom-local-vault.json").expanduser()
@@ -136,14 +136,53 @@ def key_for_database(keys: dict, relative: Path) -> bytes | None:
     return key if len(key) == 16 else None
 
 
+class CandidateValidator:
+    """Validate many raw-key candidates against one dataset's encrypted page ones.
+
+    Every encrypted page one is read once up front, each distinct candidate is
+    checked at most once, and a candidate is rejected at the first database it
+    fails: a WeCom dataset shares one raw key (saved as global_key), and a wrong
+    key already fails the one-block header check on the first page.
+    """
+
+    def __init__(self, dataset: Path):
+        self.dataset = dataset
+        self.pages: list[tuple[str, bytes]] = []
+        for relative, path in iter_databases(dataset):
+            with path.open("rb") as handle:
+                page = handle.read(PAGE_SIZE)
+            if database_format(page) == "wecom-wxsqlite3-aes128":
+                self.pages.append((str(relative), page))
+        self.results: dict[bytes, list[str]] = {}
+
+    def validate(self, candidate: bytes) -> list[str]:
+        """Relative names of the encrypted databases the candidate opens; [] when any fails."""
+        known = self.results.get(candidate)
+        if known is not None:
+            return known
+        validated = []
+        for relative, page in self.pages:
+            if not (page_one_header_matches(candidate, page) and verify_key(candidate, page)):
+                validated = []
+                break
+            validated.append(relative)
+        self.results[candidate] = validated
+        return validated
+
+    def validate_many(self, candidates) -> dict[bytes, list[str]]:
+        """Validate a batch; returns {candidate: validated databases} for the distinct candidates."""
+        return {candidate: self.validate(candidate) for candidate in dict.fromkeys(candidates)}
+
+    def first_valid(self, candidates) -> tuple[bytes, list[str]] | None:
+        for candidate in dict.fromkeys(candidates):
+            validated = self.validate(candidate)
+            if validated:
+                return candidate, validated
+        return None
+
+
 def validate_candidate(candidate: bytes, dataset: Path) -> list[str]:
-    validated = []
-    for relative, path in iter_databases(dataset):
-        with path.open("rb") as handle:
-            page = handle.read(PAGE_SIZE)
-        if database_format(page) == "wecom-wxsqlite3-aes128" and verify_key(candidate, page):
-            validated.append(str(relative))
-    return validated
+    return CandidateValidator(dataset).validate(candidate)
 
 
 def save_validated_key(candidate: bytes, dataset: Path, validated: list[str], destination: Path | None = None) -> Path:
@@ -170,6 +209,31 @@ def save_validated_key(candidate: bytes, dataset: Path, validated: list[str], de
     return destination
 
 
+def source_fingerprint(path: Path, key: bytes | None, apply_wal: bool) -> dict:
+    """Cheap change detector for a source database and the WAL merged into it."""
+    stat = path.stat()
+    wal_path = Path(str(path) + "-wal")
+    wal_stat = wal_path.stat() if apply_wal and wal_path.exists() else None
+    return {
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "wal_size": wal_stat.st_size if wal_stat else 0,
+        "wal_mtime_ns": wal_stat.st_mtime_ns if wal_stat else 0,
+        "key_sha256_12": hashlib.sha256(key).hexdigest()[:12] if key else "",
+    }
+
+
+def previous_snapshot(dataset: str, root: Path | None = None) -> Path | None:
+    """Latest finished snapshot of the same dataset, if any."""
+    snapshots = (root or vault_root()) / "snapshots"
+    if not snapshots.exists():
+        return None
+    candidates = sorted(
+        path for path in snapshots.glob(f"*-{dataset}") if path.is_dir() and (path / "manifest.json").exists()
+    )
+    return candidates[-1] if candidates else None
+
+
 def latest_snapshot(root: Path | None = None) -> Path:
     snapshots = (root or vault_root()) / "snapshots"
     candidates = sorted(path for path in snapshots.glob("*") if path.is_dir()) if snapshots.exists() else []
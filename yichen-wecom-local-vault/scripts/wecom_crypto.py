@@ -4,8 +4,12 @@
 from __future__ import annotations
 
 import hashlib
+import io
+import mmap
 import os
 import struct
+import threading
+from contextlib import contextmanager
 from pathlib import Path
 
 from Crypto.Cipher import AES
@@ -43,21 +47,51 @@ def database_format(page: bytes) -> str:
     return "unknown"
 
 
+_IV_WORDS = struct.Struct("<4I")
+# IVs depend only on the page number, never on the key, so one table serves every database
+# decrypted in this process. 2**18 pages (4 MiB of IVs) covers the first 1 GiB of any database;
+# later pages derive their IV directly.
+IV_TABLE_PAGES = 1 << 18
+_IV_TABLE_STEP = 4096
+_IV_TABLE = b""
+_IV_TABLE_LOCK = threading.Lock()
+
+
 def _lcg_step(value: int) -> int:
     quotient = value // 52774
     value = 40692 * (value - 52774 * quotient) - 3791 * quotient
     return value if value >= 0 else value + 2147483399
 
 
-def page_iv(page_number: int) -> bytes:
-    if page_number < 1:
-        raise ValueError("page_number must be >= 1")
+def _derive_page_iv(page_number: int) -> bytes:
     value = page_number + 1
-    output = bytearray()
+    words = []
     for _ in range(4):
         value = _lcg_step(value)
-        output.extend(struct.pack("<I", value & 0xFFFFFFFF))
-    return hashlib.md5(output).digest()
+        words.append(value & 0xFFFFFFFF)
+    return hashlib.md5(_IV_WORDS.pack(*words)).digest()
+
+
+def _grow_iv_table(page_number: int) -> None:
+    global _IV_TABLE
+    with _IV_TABLE_LOCK:
+        have = len(_IV_TABLE) // 16
+        if page_number <= have:
+            return
+        want = min(IV_TABLE_PAGES, -(-page_number // _IV_TABLE_STEP) * _IV_TABLE_STEP)
+        # Rebinding a new bytes object keeps lock-free readers consistent.
+        _IV_TABLE = _IV_TABLE + b"".join(_derive_page_iv(number) for number in range(have + 1, want + 1))
+
+
+def page_iv(page_number: int) -> bytes:
+    if page_number < 1:
+        raise ValueError("page_number must be >= 1")
+    if page_number > IV_TABLE_PAGES:
+        return _derive_page_iv(page_number)
+    end = page_number * 16
+    if end > len(_IV_TABLE):
+        _grow_iv_table(page_number)
+    return _IV_TABLE[end - 16 : end]
 
 
 def page_key(raw_key: bytes, page_number: int) -> bytes:
@@ -116,7 +150,21 @@ def verify_key(raw_key: bytes, page_one: bytes) -> bool:
     return plain[100] in (0x02, 0x05, 0x0A, 0x0D)
 
 
-def _wal_frames(wal_bytes: bytes, page_size: int) -> list[tuple[int, int, bytes]]:
+def page_one_header_matches(raw_key: bytes, page_one: bytes) -> bool:
+    """Cheap pre-check for verify_key: decrypt only the first CBC block of page 1.
+
+    decrypt_page() compares the first 8 plaintext bytes with the retained header
+    fragment, so a wrong key is rejected here without decrypting the other 254
+    blocks of the page.
+    """
+    if len(raw_key) != 16 or len(page_one) < 32 or not has_wecom_header_shape(page_one):
+        return False
+    block = page_one[8:16] + page_one[24:32]
+    return AES.new(page_key(raw_key, 1), AES.MODE_CBC, page_iv(1)).decrypt(block)[:8] == page_one[16:24]
+
+
+def _wal_frame_offsets(wal_bytes, page_size: int) -> list[tuple[int, int, int]]:
+    """Return (page_number, commit_pages, data_offset) for committed WAL frames."""
     if len(wal_bytes) < 32:
         return []
     magic = int.from_bytes(wal_bytes[:4], "big")
@@ -127,7 +175,7 @@ def _wal_frames(wal_bytes: bytes, page_size: int) -> list[tuple[int, int, bytes]
         return []
     salt = wal_bytes[16:24]
     frame_size = 24 + page_size
-    frames: list[tuple[int, int, bytes]] = []
+    frames: list[tuple[int, int, int]] = []
     offset = 32
     while offset + frame_size <= len(wal_bytes):
         header = wal_bytes[offset : offset + 24]
@@ -138,7 +186,7 @@ def _wal_frames(wal_bytes: bytes, page_size: int) -> list[tuple[int, int, bytes]
         if header[8:16] != salt:
             offset += frame_size
             continue
-        frames.append((page_number, commit_pages, wal_bytes[offset + 24 : offset + frame_size]))
+        frames.append((page_number, commit_pages, offset + 24))
         offset += frame_size
     last_commit = -1
     for index, (_, commit_pages, _) in enumerate(frames):
@@ -147,51 +195,95 @@ def _wal_frames(wal_bytes: bytes, page_size: int) -> list[tuple[int, int, bytes]
     return frames[: last_commit + 1] if last_commit >= 0 else []
 
 
-def decrypt_database_bytes(source_bytes: bytes, raw_key: bytes, *, wal_bytes: bytes | None = None) -> tuple[bytes, dict]:
-    """Decrypt an in-memory database and merge committed WAL frames."""
-    if len(source_bytes) < PAGE_SIZE or len(source_bytes) % PAGE_SIZE:
+def _wal_frames(wal_bytes: bytes, page_size: int) -> list[tuple[int, int, bytes]]:
+    return [
+        (page_number, commit_pages, wal_bytes[offset : offset + page_size])
+        for page_number, commit_pages, offset in _wal_frame_offsets(wal_bytes, page_size)
+    ]
+
+
+def _wal_overlay(wal_bytes, page_size: int) -> tuple[dict[int, int], int, int | None]:
+    """Index the last committed WAL frame per page and the committed page count."""
+    latest: dict[int, int] = {}
+    final_pages = None
+    frames = _wal_frame_offsets(wal_bytes, page_size)
+    for page_number, commit_pages, offset in frames:
+        latest[page_number] = offset
+        if commit_pages:
+            final_pages = commit_pages
+    return latest, len(frames), final_pages
+
+
+def _decrypt_stream(source, raw_key: bytes, wal, output) -> dict:
+    """Write every output page exactly once, from the WAL overlay or the base file."""
+    if len(source) < PAGE_SIZE or len(source) % PAGE_SIZE:
         raise ValueError(f"database size is not a whole number of {PAGE_SIZE}-byte pages")
-    source_format = database_format(source_bytes[:PAGE_SIZE])
+    source_format = database_format(source[:PAGE_SIZE])
     if source_format == "unknown":
         raise ValueError("unsupported database format")
 
-    result = bytearray()
-    for page_index in range(len(source_bytes) // PAGE_SIZE):
-        page = source_bytes[page_index * PAGE_SIZE : (page_index + 1) * PAGE_SIZE]
-        result.extend(page if source_format == "sqlite" else decrypt_page(raw_key, page, page_index + 1))
-
-    wal_applied = 0
-    final_size = None
-    for page_number, commit_pages, page in _wal_frames(wal_bytes or b"", PAGE_SIZE):
-        plain_page = page if source_format == "sqlite" else decrypt_page(raw_key, page, page_number)
-        offset = (page_number - 1) * PAGE_SIZE
-        if len(result) < offset + PAGE_SIZE:
-            result.extend(bytes(offset + PAGE_SIZE - len(result)))
-        result[offset : offset + PAGE_SIZE] = plain_page
-        wal_applied += 1
-        if commit_pages:
-            final_size = commit_pages * PAGE_SIZE
-    if final_size is not None:
-        del result[final_size:]
+    source_pages = len(source) // PAGE_SIZE
+    overlay, wal_applied, final_pages = _wal_overlay(wal if wal is not None else b"", PAGE_SIZE)
+    output_pages = max([source_pages, *overlay])
+    if final_pages is not None:
+        output_pages = min(output_pages, final_pages)
+    output.truncate(output_pages * PAGE_SIZE)
+    output.seek(0)
+    encrypted = source_format != "sqlite"
+    blank = bytes(PAGE_SIZE)
+    for page_number in range(1, output_pages + 1):
+        if page_number in overlay:
+            offset = overlay[page_number]
+            page = wal[offset : offset + PAGE_SIZE]
+        elif page_number <= source_pages:
+            page = source[(page_number - 1) * PAGE_SIZE : page_number * PAGE_SIZE]
+        else:
+            output.write(blank)
+            continue
+        output.write(decrypt_page(raw_key, page, page_number) if encrypted else page)
 
-    details = {
+    return {
         "source_format": source_format,
-        "pages": len(source_bytes) // PAGE_SIZE,
+        "pages": source_pages,
         "wal_frames_applied": wal_applied,
-        "output_bytes": len(result),
+        "output_bytes": output_pages * PAGE_SIZE,
     }
-    return bytes(result), details
+
+
+def decrypt_database_bytes(source_bytes: bytes, raw_key: bytes, *, wal_bytes: bytes | None = None) -> tuple[bytes, dict]:
+    """Decrypt an in-memory database and merge committed WAL frames."""
+    output = io.BytesIO()
+    details = _decrypt_stream(source_bytes, raw_key, wal_bytes, output)
+    return output.getvalue(), details
+
+
+@contextmanager
+def _mapped(path: Path | None):
+    if path is None or not path.exists() or path.stat().st_size == 0:
+        yield None
+        return
+    with path.open("rb") as handle, mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ) as view:
+        yield view
 
 
 def decrypt_database(source: Path, destination: Path, raw_key: bytes, *, apply_wal: bool = True) -> dict:
-    """Create a new plaintext snapshot without modifying or replacing the source."""
+    """Create a new plaintext snapshot without modifying or replacing the source.
+
+    The source and WAL are memory-mapped and decrypted page by page straight
+    into a preallocated destination, so memory use does not grow with the
+    database size.
+    """
     if destination.exists():
         raise FileExistsError(f"refusing to overwrite existing output: {destination}")
-    wal_path = Path(str(source) + "-wal")
-    wal_bytes = wal_path.read_bytes() if apply_wal and wal_path.exists() else None
-    plaintext, details = decrypt_database_bytes(source.read_bytes(), raw_key, wal_bytes=wal_bytes)
+    wal_path = Path(str(source) + "-wal") if apply_wal else None
     destination.parent.mkdir(parents=True, exist_ok=True)
-    with destination.open("xb") as output:
-        output.write(plaintext)
+    with _mapped(source) as source_view, _mapped(wal_path) as wal_view:
+        with destination.open("xb") as output:
+            try:
+                details = _decrypt_stream(source_view if source_view is not None else b"", raw_key, wal_view, output)
+            except BaseException:
+                output.close()
+                destination.unlink()
+                raise
     os.chmod(destination, 0o600)
     return details